@@ -110,15 +110,31 @@ def setup_command(config, mirror):
                    'ffmpeg understands. This can also be a single video file.')
 @click.option('-e', '--exclude', type=str, multiple=True,
               help='Exclude directory or file. Excludes any directory or file that contains the given string')
+@click.option('--chunk-minutes', type=click.FloatRange(min=0), default=0,
+              help='Split videos longer than this many minutes into chunks starting on keyframes, each processed by '
+                   'a separate task. Requires ffprobe. Cannot be used with --clean, as every chunk needs the video '
+                   'in s3. Default 0 does not split videos.')
+@click.option('--schedule', type=click.Choice(['input', 'lpt']), default='input',
+              help='Order to submit videos in: input submits them in the order they are found, lpt submits the '
+                   'longest videos first to shorten the job, and reports the estimated time per task. lpt uses the '
+                   'video durations if ffprobe is installed, otherwise the file sizes. With --upload, each video is '
+                   'submitted once it and all the longer videos are uploaded.')
 @common_args.job_option
 @common_args.cluster_option
 @common_args.dry_run_option
+@common_args.upload_workers_option
+@common_args.max_bandwidth_option
+@common_args.verify_checksum_option
 @cfg_option
 @common_args.args
-def ecs_process(config, upload, clean, cluster, job, input, exclude, dry_run, args):
+def ecs_process(config, upload, clean, cluster, job, input, exclude, chunk_minutes, schedule, dry_run, upload_workers,
+                max_bandwidth, verify_checksum, args):
     """
      (optional) upload, then batch process in an ECS cluster
     """
+    # the chunks of a video run in separate tasks in any order, so none of them can remove the video
+    if clean and chunk_minutes:
+        raise click.UsageError('--clean cannot be used with --chunk-minutes')
     custom_config = init(log_prefix="dsai_ecsprocess", config=config)
     session_maker = init_db(custom_config)
     input_path = Path(input)
@@ -134,23 +150,41 @@ def ecs_process(config, upload, clean, cluster, job, input, exclude, dry_run, ar
     videos = custom_config.check_videos(input_path, exclude)
     tags = custom_config.get_tags(f'Video uploaded from {input} by user {user_name} ')
 
-    total_submitted = 0
-    for v in videos:
-        loaded = False
-        if upload and not loaded:
-            if dry_run:
-                info(f'Dry run: Uploading {v.name} to S3 bucket {video_bucket}')
-            else:
-                upload_tag.video_data([v], urlparse(f's3://{video_bucket}'), tags)
-
-        if not loaded:
-            if dry_run:
-                info(f'Dry run: Submitting {v.name} to cluster for processing with job {job}, cluster {cluster},processor {processor}, user {user_name}, clean {clean}, args {args}')
+    # skip any videos already submitted in this job, e.g. when restarting an interrupted submission
+    videos = process.pending_videos(session_maker, job, videos)
+
+    if schedule == 'lpt':
+        num_tasks = 1 if dry_run else process.running_tasks(cluster)
+        if num_tasks == 0:
+            warn(f'No tasks running in {cluster}; estimating for a single task')
+        videos = process.schedule_lpt(videos, max(num_tasks, 1), chunk_minutes)
+
+    if dry_run:
+        if upload and videos:
+            upload_tag.video_data(videos, urlparse(f's3://{video_bucket}'), tags, dry_run)
+        for v in videos:
+            info(f'Dry run: Submitting {v.name} to cluster for processing with job {job}, cluster {cluster},processor {processor}, user {user_name}, clean {clean}, args {args}')
+            if chunk_minutes:
+                info(f'Dry run: {v.name} chunks {process.video_chunks(v, chunk_minutes)}')
+        total_submitted = len(videos)
+    else:
+        # submit each video as soon as it is uploaded so the cluster can start processing while uploads continue;
+        # uploads complete in any order, so with lpt each video is held until the longer videos are submitted
+        submitter = process.BatchSubmitter(session_maker, resources, job, user_name, clean, args,
+                                           chunk_minutes=chunk_minutes, order=videos if schedule == 'lpt' else None)
+        submitter.start()
+        try:
+            if upload and videos:
+                upload_tag.video_data(videos, urlparse(f's3://{video_bucket}'), tags, dry_run, upload_workers,
+                                      max_bandwidth, verify_checksum, on_complete=submitter.submit)
             else:
-                process.batch_run(session_maker, resources, v, job, user_name, clean, args)
-            total_submitted += 1
-        else:
-            warn(f'Video {v.name} has already been processed and loaded...skipping')
+                for v in videos:
+                    submitter.submit(v)
+        finally:
+            submitter.close()
+        total_submitted = submitter.num_submitted
+        if submitter.failed:
+            err(f'Failed to submit {len(submitter.failed)} videos: {[v.name for v in submitter.failed]}')
 
     info(f'==== Submitted {total_submitted} videos to {processor} for processing =====')
 
@@ -187,8 +221,12 @@ def ecs_shutdown(config, cluster):
 @common_args.args
 @common_args.job_option
 @common_args.config_s3_option
+@common_args.upload_workers_option
+@common_args.max_bandwidth_option
+@common_args.verify_checksum_option
 @cfg_option
-def process_command(config, dry_run, input, exclude, input_s3, output_s3, model_s3, config_s3, job, instance_type, args):
+def process_command(config, dry_run, input, exclude, input_s3, output_s3, model_s3, config_s3, job, instance_type,
+                    upload_workers, max_bandwidth, verify_checksum, args):
     """
      upload video(s) then process with a model
     """
@@ -209,7 +247,8 @@ def process_command(config, dry_run, input, exclude, input_s3, output_s3, model_
     if bucket.create(input_s3, tags, dry_run) and bucket.create(output_s3, tags, dry_run):
 
         videos = custom_config.check_videos(input_path, exclude)
-        input_s3, size_gb = upload_tag.video_data(videos, input_s3, tags, dry_run)
+        input_s3, size_gb = upload_tag.video_data(videos, input_s3, tags, dry_run, upload_workers, max_bandwidth,
+                                                  verify_checksum)
 
         # size in GB of the input data should never be < 1
         if size_gb < 1:
@@ -253,7 +292,10 @@ def process_command(config, dry_run, input, exclude, input_s3, output_s3, model_
               help='Path to the folder with video files to upload. These can be either mp4 or mov files that '
                    'ffmpeg understands.  This can also be a single video file.')
 @click.option('--s3', type=str, help='S3 bucket to upload to, e.g. s3://902005-video-in-dev', required=True)
-def upload_command(config, input, s3):
+@common_args.upload_workers_option
+@common_args.max_bandwidth_option
+@common_args.verify_checksum_option
+def upload_command(config, input, s3, upload_workers, max_bandwidth, verify_checksum):
     """
     Upload videos
     """
@@ -263,7 +305,8 @@ def upload_command(config, input, s3):
     tags = custom_config.get_tags(f'Uploaded {input} to {s3}')
     bucket.create(input_s3, tags)
     videos = custom_config.check_videos(Path(input))
-    upload_tag.video_data(videos, input_s3, tags)
+    upload_tag.video_data(videos, input_s3, tags, num_workers=upload_workers, max_bandwidth_mbs=max_bandwidth,
+                          verify_checksum=verify_checksum)
 
 
 @cli.command(name="train")
@@ -12,8 +12,8 @@ from deepsea_ai.commands.monitor_utils import log_scaling_activities, log_queue_
 from deepsea_ai.database.job.misc import JobType
 from deepsea_ai.database.report_generator import create_report
 from deepsea_ai.logger import info, warn, err
-from deepsea_ai.database.job.database import Job, Media
-from deepsea_ai.database.job.database_helper import json_b64_decode
+from deepsea_ai.database.job.database import Job
+from deepsea_ai.database.job.database_helper import json_b64_decode, get_status_counts, status_from_counts
 
 default_update_period = 60 * 30  # 30 minutes
 
@@ -73,11 +73,14 @@ class Monitor(Thread):
                         # Get all jobs with the job type ECS
                         jobs_in_clusters = db.query(Job).filter(Job.job_type == JobType.ECS).all()
 
-                        # Get all media in the jobs that are in the cluster
+                        # Count the media in each status of all the jobs in one query
+                        counts = get_status_counts(db)
                         for job in jobs_in_clusters:
-                            medias = db.query(Media).filter(Media.job_id == job.id).all()
-                            info(f"Found {len(medias)} media in job {job.name}")
-                            if len(medias) > 0:  # if there are media in the cluster, create a report
+                            job_counts = counts.get(job.id, {})
+                            num_media = sum(job_counts.values())
+                            info(f"Found {num_media} media in job {job.name} {status_from_counts(job_counts)} "
+                                 f"{job_counts}")
+                            if num_media > 0:  # if there are media in the cluster, create a report
                                 create_report(job, self.report_path, self.resources)
 
                 info(f'Checking again in {self.update_period} seconds. Ctrl-C to stop.')
@@ -4,14 +4,14 @@
 
 import json
 from datetime import datetime
-from pathlib import Path
+from typing import Dict, List, Tuple
 
 import boto3
 from botocore.exceptions import ClientError
 from sqlalchemy.orm import Session, sessionmaker
 
-from deepsea_ai.database.job import Job, Status
-from deepsea_ai.database.job.database_helper import update_media, json_b64_decode
+from deepsea_ai.database.job import Job, Media, Status
+from deepsea_ai.database.job.database_helper import update_medias, json_b64_decode, max_query_params
 from deepsea_ai.logger import info, err, exception, debug
 
 
@@ -91,19 +91,119 @@ def update_job(db: Session, sqs_message: dict, cluster: str, status: str):
     :param cluster: The cluster the job is running on
     :param status: The status of the video, either QUEUED, SUCCESS, or FAILED
     """
-    job = db.query(Job).filter_by(name=sqs_message['job_name'], engine=cluster).first()
+    apply_messages(db, [(sqs_message, status)], cluster)
+
+
+def apply_messages(db: Session, messages: List[Tuple[dict, str]], cluster: str) -> int:
+    """
+    Apply the video status in a list of queue messages to the database. The messages are grouped by job, and only
+    the newest message of each video is applied; the media of each job are fetched in one query. A video split into
+    chunks has a message per chunk, and its status combines the status of all its chunks. Changes are committed with
+    the transaction of the session.
+    :param db: Database session
+    :param messages: List of the message from the queue and the status of its video, either QUEUED, SUCCESS, or FAILED
+    :param cluster: The cluster the jobs are running on
+    :return: The number of videos updated
+    """
+    # keep the newest message for each video in each job, and collect the status of each chunk of split videos
+    newest = {}
+    chunks = {}
+    for sqs_message, status in messages:
+        timestamp = datetime.strptime(sqs_message['timestamp'], '%Y%m%dT%H%M%S')
+        key = (sqs_message['job_name'], sqs_message['video'])
+        # the processor passes the metadata sent with the video through unchanged, so it identifies the chunk
+        metadata = json_b64_decode(sqs_message['metadata_b64']) if 'metadata_b64' in sqs_message else {}
+        if 'chunk' in metadata:
+            chunk_num, num_chunks = metadata['chunk'].split('/')
+            submission = chunks.setdefault(key, {}).setdefault(metadata.get('message_uuid'), {
+                'num_chunks': int(num_chunks), 'timestamp': timestamp, 'status': {}})
+            submission['timestamp'] = max(submission['timestamp'], timestamp)
+            # a chunk that failed once failed, even if it was retried
+            if submission['status'].get(chunk_num) != Status.FAILED:
+                submission['status'][chunk_num] = status
+            continue
+        if key not in newest or newest[key]['timestamp'] <= timestamp:
+            update = {'name': sqs_message['video'], 'status': status, 'timestamp': timestamp}
+            if 'metadata_b64' in sqs_message:
+                update['metadata_b64'] = sqs_message['metadata_b64']
+            newest[key] = update
+
+    updates = {}
+    for (job_name, _), update in newest.items():
+        updates.setdefault(job_name, []).append(update)
+    for job_name, _ in chunks:
+        updates.setdefault(job_name, [])
+
+    jobs = {job.name: job for job in db.query(Job).filter(Job.engine == cluster, Job.name.in_(list(updates.keys())))}
+
+    num_updated = 0
+    for job_name, job_updates in updates.items():
+        job = jobs.get(job_name)
+        if job is None:
+            err(f'Job {job_name} not found in database.')
+            # Add the job to the database
+            job = Job(name=job_name, engine=cluster, job_type='ECS')
+            db.add(job)
+        else:
+            info(f'Found job {job.name} running on {cluster} in cache.')
+        job_chunks = {video: submissions for (name, video), submissions in chunks.items() if name == job_name}
+        if job_chunks:
+            job_updates = job_updates + chunk_updates(db, job, job_chunks)
+        num_updated += update_medias(db, job, job_updates)
+
+    return num_updated
 
-    if job is None:
-        err(f'Job {sqs_message["job_name"]} not found in database.')
-        # Add the job to the database
-        job = Job(name=sqs_message['job_name'], engine=cluster, job_type='ECS')
-        db.add(job)
-    else:
-        info(f'Found job {job.name} running on {cluster} in cache.')
 
-    # get the timestamp from the message and convert it to a datetime
-    timestamp = datetime.strptime(sqs_message['timestamp'], '%Y%m%dT%H%M%S')
-    update_media(db, job, sqs_message["video"], status, timestamp=timestamp, metadata_b64=sqs_message['metadata_b64'])
+def chunk_updates(db: Session, job: Job, chunks: Dict[str, Dict[str, dict]]) -> List[dict]:
+    """
+    Combine the status of the chunks of split videos in a job with the status of the chunks already in the database.
+    A video fails if any of its chunks fails, succeeds once all its chunks have, and is running until then. Chunks
+    of an earlier submission of a video, with a different message uuid, are ignored.
+    :param db: Database session
+    :param job: The job
+    :param chunks: Dictionary by video name of the chunks of each submission of the video by message uuid, each with
+    the number of chunks, the newest message timestamp and the status of each chunk by chunk number
+    :return: List of updates to apply with update_medias
+    """
+    if job.id is None:
+        db.flush()
+
+    names = list(chunks.keys())
+    media = {}
+    for i in range(0, len(names), max_query_params):
+        for m in db.query(Media).filter(Media.job_id == job.id, Media.name.in_(names[i:i + max_query_params])):
+            media[m.name] = m
+
+    updates = []
+    for video, submissions in chunks.items():
+        m = media.get(video)
+        if m is not None and m.message_uuid:
+            if m.message_uuid not in submissions:
+                debug(f'Ignoring chunks of an earlier submission of {video}')
+                continue
+            submission = submissions[m.message_uuid]
+        else:
+            submission = max(submissions.values(), key=lambda s: s['timestamp'])
+
+        metadata = json_b64_decode(m.metadata_b64) if m is not None and m.metadata_b64 else {}
+        chunk_status = dict(metadata.get('chunk_status', {}))
+        for chunk_num, status in submission['status'].items():
+            if chunk_status.get(chunk_num) != Status.FAILED:
+                chunk_status[chunk_num] = status
+
+        num_chunks = submission['num_chunks']
+        statuses = list(chunk_status.values())
+        if Status.FAILED in statuses:
+            status = Status.FAILED
+        elif statuses.count(Status.SUCCESS) >= num_chunks:
+            status = Status.SUCCESS
+        else:
+            status = Status.RUNNING
+        info(f'{video} has {statuses.count(Status.SUCCESS)} of {num_chunks} chunks done, '
+             f'{statuses.count(Status.FAILED)} failed')
+        updates.append({'name': video, 'status': status, 'num_chunks': num_chunks, 'chunk_status': chunk_status})
+
+    return updates
 
 
 def log_queue_status(session_maker: sessionmaker, resources: dict) -> dict:
@@ -120,6 +220,7 @@ def log_queue_status(session_maker: sessionmaker, resources: dict) -> dict:
     processor = resources['PROCESSOR']
     num_messages_visible = {}
     num_messages_invisible = {}
+    messages = []
 
     try:
         for q in queues:
@@ -132,13 +233,7 @@ def log_queue_status(session_maker: sessionmaker, resources: dict) -> dict:
             if q == 'TRACK_QUEUE':
                 info(f'{processor}:{q} number of processed videos: '
                      f'{response["Attributes"]["ApproximateNumberOfMessages"]}')
-                messages = fetch_and_parse(client, resources[q])
-                if messages:
-                    with session_maker() as db:
-                        for message in messages:
-                            update_job(db, message, cluster, Status.SUCCESS)
-                        db.flush()
-                        db.commit()
+                messages += [(message, Status.SUCCESS) for message in fetch_and_parse(client, resources[q])]
 
             if q == 'VIDEO_QUEUE':
                 info(f'{processor}:{q} number of videos to process: '
@@ -157,13 +252,12 @@ def log_queue_status(session_maker: sessionmaker, resources: dict) -> dict:
             if q == 'DEAD_QUEUE':
                 info(f'{processor}:{q} number of failed videos: '
                      f'{response["Attributes"]["ApproximateNumberOfMessages"]}')
-                messages = fetch_and_parse(client, resources[q])
-                if messages:
-                    with session_maker() as db:
-                        for message in messages:
-                            update_job(db, message, cluster, Status.FAILED)
-                        db.flush()
-                        db.commit()
+                messages += [(message, Status.FAILED) for message in fetch_and_parse(client, resources[q])]
+
+        # apply the completed and failed videos in a single transaction
+        if messages:
+            with session_maker.begin() as db:
+                apply_messages(db, messages, cluster)
 
     except ClientError as e:
         exception(e)
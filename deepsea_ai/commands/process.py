@@ -2,26 +2,39 @@
 # Filename: commands/process.py
 # Description: Process a collection of videos with the SageMaker ScriptProcessor
 
+import heapq
+import math
 import os
 import inspect
+import subprocess
 import uuid
 
 import boto3
 import json
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from queue import Queue, Empty
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple
 from sqlalchemy.orm import Session, sessionmaker
 from deepsea_ai.config import config as cfg
 from deepsea_ai.commands.upload_tag import get_prefix
-from deepsea_ai.database.job.database import Job, Media, PydanticJobWithMedias
-from deepsea_ai.database.job.database_helper import update_media, json_b64_encode
-from deepsea_ai.database.job.misc import Status, JobType
-from deepsea_ai.logger import debug, info, err
+from deepsea_ai.database.job.database import Job, Media
+from deepsea_ai.database.job.database_helper import update_medias, json_b64_encode, get_submitted_media
+from deepsea_ai.database.job.misc import Status, JobType, media_fingerprint
+from deepsea_ai.logger import debug, info, err, warn
 
 from sagemaker.processing import ScriptProcessor, ProcessingInput, ProcessingOutput
 
 code_path = Path(os.path.abspath(inspect.getfile(inspect.currentframe())))
 
+max_batch_size = 10  # maximum number of messages in a single SQS send_message_batch request
+default_max_in_flight = 4  # number of batches to send concurrently
+default_chunk_overlap_secs = 10  # seconds each chunk of a video overlaps the next to stitch the tracks together
+default_keyframe_search_secs = 60  # seconds after each chunk cut point to probe for a keyframe
+
 
 def script_processor_run(session_maker: sessionmaker, dry_run: bool, input_s3: tuple, output_s3: tuple, model_s3: tuple,
                          volume_size_gb: int, instance_type: str, custom_config: cfg.Config,
@@ -65,9 +78,7 @@ def script_processor_run(session_maker: sessionmaker, dry_run: bool, input_s3: t
     info(f"Job name: {job_name}")
 
     def log_fini(db: Session, j: Job, status: str, **kwargs):
-        j_p = PydanticJobWithMedias.from_orm(j)
-        for m in j_p.media:
-            update_media(db, j, m.name, status, **kwargs)
+        update_medias(db, j, [dict(name=m.name, status=status, **kwargs) for m in j.media])
 
     if not dry_run:
         # get a list of videos in the input bucket
@@ -101,7 +112,6 @@ def script_processor_run(session_maker: sessionmaker, dry_run: bool, input_s3: t
                           'max_runtime_in_seconds': 172800,
                           'tags': tags,
                           'arguments': arguments,
-                          'processing_job_arn': '',
                           'error': ''
                       }))
             job.media.append(m)
@@ -135,42 +145,417 @@ def script_processor_run(session_maker: sessionmaker, dry_run: bool, input_s3: t
         debug(f"Script processor dry run for inputs s3://{input_s3.netloc}/{input_s3.path.lstrip('/')}")
 
 
+def pending_videos(session_maker: sessionmaker, job_name: str, videos: List[Path]) -> List[Path]:
+    """
+    Filter out videos already submitted in a job, using the job cache as a submission ledger. A video is skipped if it
+    is QUEUED, RUNNING or SUCCESS in the job with the same content fingerprint, so an interrupted submission
+    can be restarted without duplicating work in the cluster.
+    :param session_maker: Session maker to connect to the job cache
+    :param job_name: Name of the job
+    :param videos: Videos to submit
+    :return: Videos that still need to be submitted
+    """
+    with session_maker.begin() as db:
+        submitted = get_submitted_media(db, job_name)
+
+    pending = []
+    for v in videos:
+        name = f"{get_prefix(v)}/{v.name}"
+        if name in submitted and submitted[name] == media_fingerprint(v):
+            debug(f'{name} already submitted in job {job_name}...skipping')
+        else:
+            pending.append(v)
+
+    num_skipped = len(videos) - len(pending)
+    if num_skipped > 0:
+        info(f'Skipping {num_skipped} videos already submitted in job {job_name}')
+    return pending
+
+
+def keyframe_times(video_path: Path, start_secs: float, search_secs: float) -> Optional[List[float]]:
+    """
+    Get the times of the keyframes of a video in a time range with ffprobe, reading only the packet headers in
+    that range
+    :param video_path: Path to the video
+    :param start_secs: Start of the range in seconds
+    :param search_secs: Length of the range in seconds
+    :return: Sorted keyframe times in seconds, or None if the video cannot be probed
+    """
+    try:
+        out = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-read_intervals',
+                              f'{start_secs:.6f}%+{search_secs:.6f}', '-show_entries', 'packet=pts_time,flags',
+                              '-of', 'csv=p=0', video_path.as_posix()],
+                             capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as ex:
+        warn(f'Cannot find the keyframes of {video_path}: {ex}')
+        return None
+    times = []
+    for line in out.splitlines():
+        pts_time, _, flags = line.partition(',')
+        # the read starts at the keyframe before start_secs
+        if 'K' in flags and pts_time not in ('', 'N/A') and float(pts_time) >= start_secs:
+            times.append(float(pts_time))
+    return sorted(times)
+
+
+def video_chunks(video_path: Path, chunk_minutes: float, overlap_secs: float = default_chunk_overlap_secs,
+                 search_secs: float = default_keyframe_search_secs) -> List[Tuple[float, Optional[float]]]:
+    """
+    Split a video into time chunks that start on a keyframe, so each chunk can be cut without re-encoding and
+    processed by a separate task. Each chunk runs overlap_secs into the next one to stitch the tracks together.
+    Only the packets just after each cut point are probed for the keyframe to cut on, and videos no longer than a
+    chunk are not probed at all.
+    :param video_path: Path to the video
+    :param chunk_minutes: Length of the chunks in minutes; 0 to not split the video
+    :param overlap_secs: Seconds each chunk overlaps the next
+    :param search_secs: Seconds after each cut point to look for a keyframe in
+    :return: List of the start and end of each chunk in seconds; the last chunk ends at None, the end of the video
+    """
+    if not chunk_minutes:
+        return [(0., None)]
+    chunk_secs = chunk_minutes * 60
+    duration = video_duration(video_path)
+    if duration is None or duration <= chunk_secs:
+        return [(0., None)]
+
+    starts = [0.]
+    cut_secs = chunk_secs
+    while cut_secs < duration - overlap_secs:
+        keyframes = keyframe_times(video_path, cut_secs, search_secs)
+        if keyframes is None:
+            # the last chunk runs to the end of the video
+            break
+        if not keyframes:
+            # no keyframe close to the cut point; look further along
+            cut_secs += search_secs
+            continue
+        if keyframes[0] >= duration - overlap_secs:
+            break
+        starts.append(keyframes[0])
+        cut_secs = keyframes[0] + chunk_secs
+    return [(start, starts[i + 1] + overlap_secs if i + 1 < len(starts) else None) for i, start in enumerate(starts)]
+
+
+def video_duration(video_path: Path) -> Optional[float]:
+    """
+    Get the duration of a video with ffprobe, reading only the container header
+    :param video_path: Path to the video
+    :return: Duration in seconds, or None if the video cannot be probed
+    """
+    try:
+        out = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0',
+                              video_path.as_posix()], capture_output=True, text=True, check=True).stdout
+        return float(out.strip())
+    except (OSError, ValueError, subprocess.CalledProcessError) as ex:
+        debug(f'Cannot find the duration of {video_path}: {ex}')
+        return None
+
+
+def processing_costs(videos: List[Path]) -> Tuple[Dict[Path, float], str]:
+    """
+    Estimate the time to process each video from its duration. If any of the videos cannot be probed, e.g. ffprobe is
+    not installed, the file sizes are used instead so all the estimates are in the same unit.
+    :param videos: Videos to estimate
+    :return: Dictionary of video to its estimated cost, and the unit of the costs: seconds or bytes
+    """
+    durations = {v: video_duration(v) for v in videos}
+    if all(d is not None for d in durations.values()):
+        return durations, 'seconds'
+    warn('Cannot find the duration of all videos; scheduling by file size')
+    return {v: float(v.stat().st_size) for v in videos}, 'bytes'
+
+
+def estimate_makespan(costs: List[float], num_tasks: int) -> float:
+    """
+    Estimate the time for a number of tasks to process jobs taken from a queue in the given order; each job
+    goes to the first task that becomes free
+    :param costs: Cost of each job in the order it is queued
+    :param num_tasks: Number of tasks processing the queue
+    :return: Cost of the busiest task
+    """
+    loads = [0.] * max(num_tasks, 1)
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def running_tasks(cluster: str) -> int:
+    """
+    Count the tasks running in an ECS cluster. The cluster ARN is found by its name, as in ecsshutdown
+    :param cluster: Name of the cluster, e.g. the name of the stack it was created with
+    :return: Number of running tasks, or 1 if the cluster or its tasks cannot be listed
+    """
+    ecs = boto3.client('ecs')
+    try:
+        cluster_arn = None
+        for page in ecs.get_paginator('list_clusters').paginate():
+            cluster_arn = next((c for c in page['clusterArns'] if cluster in c), None)
+            if cluster_arn:
+                break
+        if cluster_arn is None:
+            warn(f'Cluster {cluster} not found; estimating for a single task')
+            return 1
+        paginator = ecs.get_paginator('list_tasks')
+        pages = paginator.paginate(cluster=cluster_arn, desiredStatus='RUNNING')
+        return sum(len(page['taskArns']) for page in pages)
+    except ClientError as ex:
+        warn(f'Cannot list the tasks running in {cluster}: {ex}; estimating for a single task')
+        return 1
+
+
+def schedule_lpt(videos: List[Path], num_tasks: int, chunk_minutes: float = 0) -> List[Path]:
+    """
+    Order videos longest first, so the longest videos do not start last and hold up the end of the job, and report
+    the estimated makespan against the original order
+    :param videos: Videos to schedule
+    :param num_tasks: Number of tasks processing the videos
+    :param chunk_minutes: Length of the chunks the videos are split into in minutes; 0 if not split
+    :return: Videos in longest-processing-time-first order
+    """
+    if not videos:
+        return videos
+    costs, unit = processing_costs(videos)
+    ordered = sorted(videos, key=lambda v: costs[v], reverse=True)
+
+    def jobs(order: List[Path]) -> List[float]:
+        # each chunk of a split video is a separate job
+        if not chunk_minutes or unit != 'seconds':
+            return [costs[v] for v in order]
+        chunk_secs = chunk_minutes * 60
+        split = []
+        for v in order:
+            num_chunks = max(1, math.ceil(costs[v] / chunk_secs))
+            split += [chunk_secs] * (num_chunks - 1) + [costs[v] - chunk_secs * (num_chunks - 1)]
+        return split
+
+    def fmt(cost: float) -> str:
+        return f'{cost / 3600:.2f} hours of video' if unit == 'seconds' else f'{cost / 1e9:.2f} GB'
+
+    before = estimate_makespan(jobs(videos), num_tasks)
+    after = estimate_makespan(jobs(ordered), num_tasks)
+    info(f'Scheduled {len(videos)} videos longest first; {fmt(sum(costs.values()))} in total')
+    info(f'Estimated makespan for {num_tasks} tasks: {fmt(after)} per task, {fmt(before)} in the input order')
+    return ordered
+
+
+class BatchSubmitter(Thread):
+    """
+    Submits videos to the ECS cluster as they become ready, e.g. as soon as each upload completes.
+    Videos that arrive together are sent in the same batch. With an order, e.g. longest first, a ready video is
+    held until all the videos before it in the order have been submitted.
+    """
+
+    def __init__(self, session_maker: sessionmaker, resources: dict, job_name: str, user_name: str, clean: bool,
+                 args: str, linger_secs: float = 1.0, chunk_minutes: float = 0, order: List[Path] = None):
+        """
+        :param session_maker: Session maker to connect to the job cache
+        :param resources: Dictionary of resources in the cluster
+        :param job_name: Name of the job
+        :param user_name: Name of the user submitting the job
+        :param clean: Clean up the video from s3 after processing
+        :param args: Arguments to pass to the processor
+        :param linger_secs: Time to wait for more videos to fill a batch before sending it
+        :param chunk_minutes: Split videos into chunks of this many minutes, each processed separately; 0 to not split
+        :param order: Order to submit the videos in, or None to submit each video as soon as it is ready
+        """
+        Thread.__init__(self, daemon=True)
+        self.session_maker = session_maker
+        self.resources = resources
+        self.job_name = job_name
+        self.user_name = user_name
+        self.clean = clean
+        self.args = args
+        self.linger_secs = linger_secs
+        self.chunk_minutes = chunk_minutes
+        self.queue = Queue()
+        self.order = order
+        self.next_index = 0
+        self.ready = set()
+        self.lock = Lock()
+        self.num_submitted = 0
+        self.failed = []
+        self.error = None
+
+        # resolve the queue once for all the batches
+        self.sqs = boto3.client('sqs')
+        self.queue_url = self.sqs.get_queue_url(QueueName=resources['VIDEO_QUEUE'])['QueueUrl']
+
+    def submit(self, video_path: Path):
+        """
+        Queue a video for submission, along with any videos after it in the order that were waiting on it;
+        safe to call from any thread
+        """
+        if self.order is None:
+            self.queue.put(video_path)
+            return
+        with self.lock:
+            self.ready.add(video_path)
+            while self.next_index < len(self.order) and self.order[self.next_index] in self.ready:
+                self.queue.put(self.order[self.next_index])
+                self.ready.discard(self.order[self.next_index])
+                self.next_index += 1
+
+    def close(self):
+        """
+        Submit any remaining videos, including videos still waiting on an earlier video that never became ready,
+        e.g. if its upload failed, and wait for the submitter to finish
+        """
+        if self.order is not None:
+            with self.lock:
+                for video_path in self.order[self.next_index:]:
+                    if video_path in self.ready:
+                        self.queue.put(video_path)
+                self.ready.clear()
+                self.next_index = len(self.order)
+        self.queue.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        done = False
+        while not done:
+            # block until the next video is ready, then collect any others that arrive shortly after it
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                break
+            while len(batch) < max_batch_size:
+                try:
+                    video_path = self.queue.get(timeout=self.linger_secs)
+                except Empty:
+                    break
+                if video_path is None:
+                    done = True
+                    break
+                batch.append(video_path)
+
+            try:
+                failed = batch_submit(self.session_maker, self.resources, batch, self.job_name, self.user_name,
+                                      self.clean, self.args, chunk_minutes=self.chunk_minutes, sqs=self.sqs,
+                                      queue_url=self.queue_url)
+                self.failed += failed
+                self.num_submitted += len(batch) - len(failed)
+            except Exception as ex:
+                err(f'Failed to submit {[v.name for v in batch]}: {ex}')
+                self.error = ex
+                self.failed += batch
+
+
 def batch_run(session_maker: sessionmaker, resources: dict, video_path: Path, job_name: str, user_name: str, clean: bool, args: str):
     """
-    Process a collection of videos in with a cluster in the Elastic Container Service [ECS]
+    Process a single video with a cluster in the Elastic Container Service [ECS]
     """
-    # the queue to submit the processing message to
-    queue_name = resources['VIDEO_QUEUE']
+    batch_submit(session_maker, resources, [video_path], job_name, user_name, clean, args)
 
-    # Get the service resource
-    sqs = boto3.resource('sqs')
 
-    prefix_path = get_prefix(video_path)
+def batch_submit(session_maker: sessionmaker, resources: dict, videos: List[Path], job_name: str, user_name: str,
+                 clean: bool, args: str, max_in_flight: int = default_max_in_flight,
+                 chunk_minutes: float = 0, sqs=None, queue_url: str = None) -> List[Path]:
+    """
+    Process a collection of videos with a cluster in the Elastic Container Service [ECS].
+    Messages are sent in batches of 10 with several batches in flight, and the videos are recorded in the
+    job cache in a single transaction. Long videos can be split into chunks, each sent in its own message. A video
+    with only some of its chunks sent is recorded as failed with the chunks that were not sent, so the chunks that
+    were are still tracked, and is returned with the videos that failed to submit.
+    :param session_maker: Session maker to connect to the job cache
+    :param resources: Dictionary of resources in the cluster
+    :param videos: Videos to submit
+    :param job_name: Name of the job
+    :param user_name: Name of the user submitting the job
+    :param clean: Clean up the video from s3 after processing
+    :param args: Arguments to pass to the processor
+    :param max_in_flight: Maximum number of batches to send concurrently
+    :param chunk_minutes: Split videos into chunks of this many minutes, each processed separately; 0 to not split
+    :param sqs: SQS client to send the messages with; created if None
+    :param queue_url: URL of the video queue, e.g. resolved once by the caller for many calls; resolved if None
+    :return: List of videos that failed to submit
+    """
+    # the queue to submit the processing message to
+    queue_name = resources['VIDEO_QUEUE']
 
-    # Setup message dict
-    # Generate a unique uuid to track the video processing
-    message_uuid = str(uuid.uuid4())
-    message_dict = {"video": f"{prefix_path}/{video_path.name}",
-                    "clean": "True" if clean else "False",
-                    "user_name": user_name,
-                    "metadata_b64": json_b64_encode({"message_uuid": message_uuid}),
-                    "job_name": job_name}
+    # Resolve the queue once for all messages
+    if sqs is None:
+        sqs = boto3.client('sqs')
+    if queue_url is None:
+        queue_url = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
 
-    # If args are provided, add them to the message dict
+    # Strip off the quotes
     if args:
-        # Strip off the quotes
         args = args.strip('"')
-        message_dict["args"] = args
-
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
-    json_object = json.dumps(message_dict, indent=4)
 
-    # Create a message group based on the time and the video name
-    group_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{video_path.name}"
-
-    # Create a new message
-    response = queue.send_message(MessageBody=json_object, MessageGroupId=group_id)
-    info(f"Message queued to {queue_name}. MessageId: {response.get('MessageId')}")
+    # Setup a message per video, or per chunk of a video, each with a unique uuid to track the video processing
+    entries = {}
+    for video_path in videos:
+        prefix_path = get_prefix(video_path)
+        message_uuid = str(uuid.uuid4())
+        fingerprint = media_fingerprint(video_path)
+        chunks = video_chunks(video_path, chunk_minutes)
+        if clean and len(chunks) > 1:
+            warn(f'Not cleaning {video_path.name} from s3 as it is split into {len(chunks)} chunks')
+        for c, (start_secs, end_secs) in enumerate(chunks):
+            metadata = {"message_uuid": message_uuid}
+            # every chunk needs the video, so a split video is never cleaned
+            message_dict = {"video": f"{prefix_path}/{video_path.name}",
+                            "clean": "True" if clean and len(chunks) == 1 else "False",
+                            "user_name": user_name,
+                            "job_name": job_name}
+
+            # If the video is split, add the time range of the chunk to the message dict
+            if len(chunks) > 1:
+                chunk = {"chunk": f"{c + 1}/{len(chunks)}", "start_secs": start_secs}
+                if end_secs is not None:
+                    chunk["end_secs"] = end_secs
+                message_dict.update(chunk)
+                metadata.update(chunk)
+            message_dict["metadata_b64"] = json_b64_encode(metadata)
+
+            # If args are provided, add them to the message dict
+            if args:
+                message_dict["args"] = args
+
+            # Create a message group based on the time, the video name and the chunk
+            group_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{video_path.name}"
+            if len(chunks) > 1:
+                group_id += f"-{c + 1}"
+
+            i = str(len(entries))
+            entries[i] = {'video_path': video_path,
+                          'message_uuid': message_uuid,
+                          'fingerprint': fingerprint,
+                          'num_chunks': len(chunks),
+                          'chunk': c + 1,
+                          'entry': {'Id': i,
+                                    'MessageBody': json.dumps(message_dict, indent=4),
+                                    'MessageGroupId': group_id}}
+
+    def send(batch: List[str]) -> dict:
+        try:
+            return sqs.send_message_batch(QueueUrl=queue_url, Entries=[entries[i]['entry'] for i in batch])
+        except Exception as ex:
+            return {'Failed': [{'Id': i, 'Code': type(ex).__name__, 'Message': str(ex)} for i in batch]}
+
+    ids = list(entries.keys())
+    batches = [ids[i:i + max_batch_size] for i in range(0, len(ids), max_batch_size)]
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        responses = list(executor.map(send, batches))
+
+    queued = {}
+    unsent = {}
+    failed = []
+    for response in responses:
+        for s in response.get('Successful', []):
+            e = entries[s['Id']]
+            info(f"Message for {e['video_path'].name} queued to {queue_name}. MessageId: {s['MessageId']}")
+            queued[e['video_path']] = e
+        for f in response.get('Failed', []):
+            e = entries[f['Id']]
+            err(f"Failed to queue {e['video_path'].name} to {queue_name}: {f.get('Code')} {f.get('Message')}")
+            unsent.setdefault(e['video_path'], []).append(e['chunk'])
+            if e['video_path'] not in failed:
+                failed.append(e['video_path'])
+
+    if not queued:
+        return failed
 
     with session_maker.begin() as db:
         # Add the job to the database if it doesn't exist
@@ -181,11 +566,26 @@ def batch_run(session_maker: sessionmaker, resources: dict, video_path: Path, jo
                           name=job_name,
                           job_type=JobType.ECS)
                 db.add(job)
+                info(f"Added job {job.name} running on {resources['CLUSTER']} to cache.")
         except Exception as ex:
             err(f"Failed to add job {job_name} to cache: {ex}")
             raise ex
 
-    with session_maker.begin() as db:
-        job = db.query(Job).filter(Job.name == job_name).first()
-        info(f"Added job {job.name} running on {resources['CLUSTER']} to cache.")
-        update_media(db, job, f"{prefix_path}/{video_path.name}", Status.QUEUED, message_uuid=message_uuid)
\ No newline at end of file
+        updates = []
+        for video_path, e in queued.items():
+            update = {'name': f"{get_prefix(video_path)}/{video_path.name}", 'status': Status.QUEUED,
+                      'message_uuid': e['message_uuid'], 'fingerprint': e['fingerprint']}
+            if e['num_chunks'] > 1:
+                # the status of each chunk is tracked from its own message; start over on a resubmission
+                update['num_chunks'] = e['num_chunks']
+                update['chunk_status'] = {}
+                # a video with only some chunks queued cannot complete, but its queued chunks still run
+                if video_path in unsent:
+                    warn(f"Only queued {e['num_chunks'] - len(unsent[video_path])} of {e['num_chunks']} chunks "
+                         f"of {video_path.name}; recording it as failed")
+                    update['status'] = Status.FAILED
+                    update['chunk_status'] = {str(c): Status.FAILED for c in unsent[video_path]}
+            updates.append(update)
+        update_medias(db, job, updates)
+
+    return failed
@@ -2,23 +2,284 @@
 # Filename: commands/upload_tag.py
 # Description: Bucket upload and tagging utility
 
+import hashlib
+import threading
+
 import botocore
 import boto3
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from urllib.parse import urlparse
-from deepsea_ai.logger import info, err, critical, exception
+from typing import Callable
+from urllib.parse import urlparse, urlencode, quote
+from boto3.s3.transfer import TransferConfig, ProgressCallbackInvoker, create_transfer_manager
+from deepsea_ai.logger import info, err, warn, critical, exception
 
 from . import bucket
 
+MB = 1024 * 1024
+default_upload_workers = 4  # number of files to upload concurrently
+default_max_bandwidth_mbs = 62  # total MB/s across all upload workers
+default_part_size_mb = 64  # multipart upload part size
+default_parts_per_worker = 4  # number of parts in flight per upload worker
+
+
+class UploadProgress:
+    """
+    Thread-safe progress and throughput report for a single file upload
+    """
+
+    def __init__(self, path: Path, size_bytes: int, report_percent: int = 10):
+        """
+        :param path: Path to the file being uploaded
+        :param size_bytes: Size of the file in bytes
+        :param report_percent: Report progress every report_percent percent
+        """
+        self.path = path
+        self.size_bytes = max(size_bytes, 1)
+        self.report_percent = report_percent
+        self.bytes_seen = 0
+        self.next_report = report_percent
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_transferred: int):
+        with self.lock:
+            self.bytes_seen += bytes_transferred
+            percent = 100 * self.bytes_seen / self.size_bytes
+            if percent >= self.next_report:
+                info(f'{self.path.name} {percent:.0f}% {self.bytes_seen / MB:.1f}/{self.size_bytes / MB:.1f} MB '
+                     f'at {self.throughput():.1f} MB/s')
+                while self.next_report <= percent:
+                    self.next_report += self.report_percent
+
+    def throughput(self) -> float:
+        """
+        :return: Average throughput in MB/s since the upload started
+        """
+        elapsed = max(time.time() - self.start, 1e-6)
+        return self.bytes_seen / MB / elapsed
+
+
+def transfer_config(num_workers: int = default_upload_workers,
+                    max_bandwidth_mbs: int = default_max_bandwidth_mbs,
+                    part_size_mb: int = default_part_size_mb) -> TransferConfig:
+    """
+    Create the transfer configuration shared by all upload workers
+    :param num_workers: Number of files uploaded concurrently
+    :param max_bandwidth_mbs: Total bandwidth budget in MB/s across all workers; 0 or None for unlimited
+    :param part_size_mb: Multipart part size in MB
+    :return: TransferConfig
+    """
+    part_size = part_size_mb * MB
+    return TransferConfig(multipart_threshold=part_size,
+                          multipart_chunksize=part_size,
+                          max_concurrency=max(num_workers, 1) * default_parts_per_worker,
+                          max_bandwidth=max_bandwidth_mbs * MB if max_bandwidth_mbs else None)
+
+
+def upload_file(manager, path: Path, bucket_name: str, key: str, extra_args: dict = None, retries: int = 10):
+    """
+    Upload a single file with a shared transfer manager, retrying on failure
+    :param manager: Transfer manager shared across all uploads
+    :param path: Path to the local file
+    :param bucket_name: Bucket to upload to
+    :param key: Key of the object to create
+    :param extra_args: Extra arguments passed to the upload, e.g. Tagging
+    :param retries: Number of times to retry the upload
+    """
+    for retry in range(retries):
+        try:
+            info(f'Uploading {path} to s3://{bucket_name}/{key}...')
+            progress = UploadProgress(path, path.stat().st_size)
+            future = manager.upload(path.as_posix(), bucket_name, key, extra_args=extra_args,
+                                    subscribers=[ProgressCallbackInvoker(progress)])
+            future.result()
+            info(f'File {path} uploaded successfully at {progress.throughput():.1f} MB/s')
+            return
+        except FileNotFoundError:
+            info(f"Local file '{path}' not found.")
+            exception(f"Error uploading {path} to s3.")
+            time.sleep(60)
+        except botocore.exceptions.EndpointConnectionError as e:
+            info(f'Network error: {e} Retrying every 60 seconds...')
+            time.sleep(60)
+        except TimeoutError as e:
+            exception(f'Timeout error {e}. Retrying every 60 seconds...')
+            time.sleep(60)
+        except Exception as e:
+            exception(f'Error uploading {e} {path} to s3. Retrying every 60 seconds...')
+            time.sleep(60)
+
+    critical(f"Error uploading {path} to s3 after {retries} retries. Aborting.")
+    raise Exception(f"Error uploading {path} to s3 after {retries} retries. Aborting.")
+
+
+def list_objects(s3, bucket_name: str, prefixes: set) -> tuple:
+    """
+    List the objects under one or more prefixes with a paginated ListObjectsV2, instead of one request per object
+    :param s3: S3 client
+    :param bucket_name: Bucket to list
+    :param prefixes: Prefixes to list
+    :return: Dictionary of key to (size in bytes, ETag), and the set of prefixes there is no permission to list
+    """
+    index = {}
+    denied = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    for prefix in sorted(prefixes):
+        try:
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    index[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ["403", "AccessDenied"]:
+                warn(f'No permission to list s3://{bucket_name}/{prefix}: {e}')
+                denied.add(prefix)
+                continue
+            raise
+    info(f'Found {len(index)} objects in s3://{bucket_name} under {sorted(prefixes)}')
+    return index, denied
+
+
+def key_prefix(key: str) -> str:
+    """
+    Get the prefix listed by list_objects for a key, e.g. 2022/02/1423/ for 2022/02/1423/video.mp4
+    """
+    return key.rsplit('/', 1)[0] + '/' if '/' in key else ''
+
+
+def local_etag(path: Path, part_size: int = None) -> str:
+    """
+    Compute the ETag S3 assigns to a file uploaded with the given multipart part size. Only valid for objects
+    uploaded without SSE-KMS encryption and with the same part size.
+    :param path: Path to the local file
+    :param part_size: Multipart part size in bytes, or None for a file uploaded in a single request
+    :return: The expected ETag
+    """
+    md5s = []
+    with open(path.as_posix(), 'rb') as f:
+        if part_size is None:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(MB), b''):
+                md5.update(chunk)
+            return md5.hexdigest()
+        for chunk in iter(lambda: f.read(part_size), b''):
+            md5s.append(hashlib.md5(chunk).digest())
+
+    # files smaller than the part size are uploaded in a single request
+    if path.stat().st_size < part_size:
+        return md5s[0].hex() if md5s else hashlib.md5(b'').hexdigest()
+    return f'{hashlib.md5(b"".join(md5s)).hexdigest()}-{len(md5s)}'
+
+
+def etag_part_sizes(size: int, etag: str, part_size: int) -> list:
+    """
+    Get the multipart part sizes that could have produced an object's ETag, from the number of parts in its
+    -N suffix, so objects uploaded with a different part size, e.g. the 8 MB parts of earlier versions, can be
+    verified
+    :param size: Size of the object in bytes
+    :param etag: ETag of the object
+    :param part_size: Multipart part size in bytes of this upload
+    :return: Candidate part sizes in bytes, or [None] if the object was uploaded in a single request
+    """
+    if '-' not in etag:
+        return [None]
+    num_parts = int(etag.rsplit('-', 1)[1])
+    # the part size this upload uses, the boto3 default, then the smallest whole number of MB giving num_parts parts
+    candidates = [part_size, 8 * MB, -(-size // (num_parts * MB)) * MB]
+    sizes = []
+    for p in candidates:
+        if p > 0 and -(-size // p) == num_parts and p not in sizes:
+            sizes.append(p)
+    return sizes
+
+
+def needs_upload(path: Path, key: str, index: dict, verify_checksum: bool = False,
+                 part_size: int = default_part_size_mb * MB) -> bool:
+    """
+    Check if a local file needs to be uploaded by comparing it to the object listing
+    :param path: Path to the local file
+    :param key: Key of the object in the bucket
+    :param index: Dictionary of key to (size in bytes, ETag) from list_objects
+    :param verify_checksum: If true, also compare the local checksum to the ETag
+    :param part_size: Multipart part size in bytes used to compute the checksum
+    :return: True if the file is missing, truncated or different in the bucket
+    """
+    if key not in index:
+        return True
+
+    size, etag = index[key]
+    local_size = path.stat().st_size
+    if size != local_size:
+        warn(f'Found {key} with size {size} but {path} is {local_size} bytes; likely a partial upload. Uploading again')
+        return True
+
+    if verify_checksum and not any(etag == local_etag(path, p) for p in etag_part_sizes(size, etag, part_size)):
+        warn(f'Found {key} but its checksum {etag} does not match {path}. Uploading again')
+        return True
 
-def video_data(videos: list[Path], input_s3: tuple, tags: dict, dry_run: bool = False):
+    return False
+
+
+def tagging_query(tags: dict) -> str:
+    """
+    Encode tags as the URL query string expected by the Tagging argument of an upload
+    :param tags: Tags as a list of Key/Value dictionaries
+    :return: URL encoded tags, e.g. mbari%3Aowner=duane&mbari%3Astage=test
+    """
+    return urlencode([(t['Key'], t['Value']) for t in tags], quote_via=quote)
+
+
+def tags_match(existing: list, tags: list) -> bool:
+    """
+    Check if the tags on an object already match the tags to apply. Deletion dates are generated per run
+    so they match if they fall on the same day.
+    :param existing: Tag set on the object as a list of Key/Value dictionaries
+    :param tags: Tags to apply as a list of Key/Value dictionaries
+    :return: True if the object does not need to be tagged again
+    """
+    existing_dict = {t['Key']: t['Value'] for t in existing}
+    tags_dict = {t['Key']: t['Value'] for t in tags}
+    if existing_dict.keys() != tags_dict.keys():
+        return False
+    for key, value in tags_dict.items():
+        if key.endswith(':deletion-date'):
+            if existing_dict[key][:8] != value[:8]:
+                return False
+        elif existing_dict[key] != value:
+            return False
+    return True
+
+
+def tag_existing(s3, bucket_name: str, key: str, tags: list):
+    """
+    Tag an object already in the bucket, skipping the update if it already carries the tags
+    :param s3: S3 client
+    :param bucket_name: Bucket of the object
+    :param key: Key of the object
+    :param tags: Tags to apply as a list of Key/Value dictionaries
+    """
+    existing = s3.get_object_tagging(Bucket=bucket_name, Key=key)['TagSet']
+    if tags_match(existing, tags):
+        info(f'Tags on s3://{bucket_name}/{key} are up to date ...skipping tagging')
+        return
+    info(f'Tagging s3://{bucket_name}/{key} with {tags}...')
+    s3.put_object_tagging(Bucket=bucket_name, Key=key, Tagging={'TagSet': tags})
+
+
+def video_data(videos: list[Path], input_s3: tuple, tags: dict, dry_run: bool = False,
+               num_workers: int = default_upload_workers, max_bandwidth_mbs: int = default_max_bandwidth_mbs,
+               verify_checksum: bool = False, on_complete: Callable[[Path], None] = None):
     """
      Does an upload and tagging of a collection of videos to S3
     :param videos: Array of video files in the input_path to upload
     :param input_s3: Base bucket to upload to, e.g. 902005-video-in-dev
     :param tags: Tags to assign to the video
     :param dry_run: If true, do not upload or tag
+    :param num_workers: Number of videos to upload concurrently
+    :param max_bandwidth_mbs: Total upload bandwidth budget in MB/s shared by all workers; 0 for unlimited
+    :param verify_checksum: If true, compare local checksums to existing objects to decide whether to upload
+    :param on_complete: Called with each video as soon as it is uploaded and tagged, e.g. to submit it for processing
     :return: Uploaded bucket path, Size in GB of video data
     """
     if dry_run:
@@ -27,73 +288,47 @@ def video_data(videos: list[Path], input_s3: tuple, tags: dict, dry_run: bool =
         return urlparse(f's3://{input_s3.netloc}/{get_prefix(videos[0])}/', allow_fragments=True), 0
 
     s3 = boto3.client('s3')
-    s3_resource = boto3.resource('s3')
+    config = transfer_config(num_workers, max_bandwidth_mbs)
+    info(f'Uploading {len(videos)} videos with {num_workers} workers, part size {config.multipart_chunksize / MB:.0f} MB, '
+         f'bandwidth limit {max_bandwidth_mbs if max_bandwidth_mbs else "unlimited"} MB/s')
 
-    # upload and tag the video objects individually
-    uploaded_videos = []
-    size_gb = 1
-    max_bandwidth = 62 * 1024 * 1024 # 62 MB/s
-    for v in videos:
-        # add the size of the video to the total
-        size_gb += v.stat().st_size /(1024**3)
-        prefix_path = get_prefix(v)
-
-        if input_s3.path:
-            target_prefix = f"{input_s3.path}/{prefix_path.lstrip('/')}/{v.name}"
-        else:
-            target_prefix = f"{prefix_path.lstrip('/')}/{v.name}"
+    # index the existing objects with a single listing per prefix, rather than checking each video
+    target_keys = {v: get_target_key(input_s3, v) for v in videos}
+    index, denied = list_objects(s3, input_s3.netloc, {key_prefix(key) for key in target_keys.values()})
 
-        info(f'Checking {v} in s3://{input_s3.netloc}/{target_prefix}...')
-        uploaded_videos.append(f"s3://{input_s3.netloc}/{target_prefix}")
-
-        # check if the video exists in s3
-        try:
-            s3_resource.Object(input_s3.netloc, target_prefix).load()
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "403":
-                info(f'Found s3://{input_s3.netloc}/{target_prefix} but do not have permission to access it. Continuing...')
-                continue
-            if e.response['Error']['Code'] == "404":
-                upload_success = False
-                # The video does not exist so upload and retry
-                for retry in range(10):
-                    try:
-                        info(f'Uploading {v} to s3://{input_s3.netloc}/{target_prefix}...')
-                        s3.upload_file(v.as_posix(), input_s3.netloc, target_prefix,
-                                       Config=boto3.s3.transfer.TransferConfig(max_bandwidth=max_bandwidth))
-                        upload_success = True
-                        info(f'File {v} uploaded successfully')
-                        break
-                    except FileNotFoundError:
-                        info(f"Local file '{v}' not found.")
-                        exception(f"Error uploading {v} to s3.")
-                        time.sleep(60)
-                    except botocore.exceptions.EndpointConnectionError as e:
-                        info(f'Network error: {e} Retrying every 60 seconds...')
-                        time.sleep(60)
-                    except TimeoutError as e:
-                        exception(f'Timeout error {e}. Retrying every 60 seconds...')
-                        time.sleep(60)
-                    except Exception as e:
-                        exception(f'Error uploading {e} {v} to s3. Retrying every 60 seconds...')
-                        time.sleep(60)
-
-                if not upload_success:
-                    critical(f"Error uploading {v} to s3 after {retry} retries. Aborting.")
-                    raise Exception(f"Error uploading {v} to s3 after {retry} retries. Aborting.")
-            else:
-                exception(e)
-                raise
+    def upload_and_tag(v: Path, target_prefix: str):
+        if key_prefix(target_prefix) in denied:
+            info(f'No permission to check s3://{input_s3.netloc}/{target_prefix}. Skipping upload. Continuing...')
+        elif needs_upload(v, target_prefix, index, verify_checksum, config.multipart_chunksize):
+            # tag in the upload request itself to avoid a separate tagging request
+            upload_file(manager, v, input_s3.netloc, target_prefix, extra_args={'Tagging': tagging_query(tags)})
         else:
-            # the video does exist.
             info(f'Found s3://{input_s3.netloc}/{target_prefix} ...skipping upload')
+            tag_existing(s3, input_s3.netloc, target_prefix, tags)
 
-        try:
-            # tag it
-            info(f'Tagging {v} with {tags}...')
-            s3.put_object_tagging(Bucket=input_s3.netloc, Key=f'{target_prefix}', Tagging={'TagSet': tags})
-        except Exception as error:
-            raise error
+        if on_complete:
+            on_complete(v)
+
+    # upload and tag the video objects concurrently, sharing a single transfer manager so the bandwidth budget
+    # and part upload threads are shared across all workers
+    uploaded_videos = []
+    size_gb = 1
+    start = time.time()
+    with create_transfer_manager(s3, config) as manager, ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = []
+        for v in videos:
+            # add the size of the video to the total
+            size_gb += v.stat().st_size / (1024 ** 3)
+            target_prefix = target_keys[v]
+            uploaded_videos.append(f"s3://{input_s3.netloc}/{target_prefix}")
+            futures.append(executor.submit(upload_and_tag, v, target_prefix))
+
+        for future in as_completed(futures):
+            future.result()
+
+    elapsed = time.time() - start
+    info(f'Finished {len(videos)} videos {size_gb - 1:.2f} GB in {elapsed:.1f} seconds '
+         f'({(size_gb - 1) * 1024 / max(elapsed, 1e-6):.1f} MB/s)')
 
     # If only one video was uploaded, return the video path
     if len(uploaded_videos) == 1:
@@ -115,41 +350,35 @@ def training_data(data: [Path], input: tuple, tags: dict, training_prefix: str):
 
     # upload and tag the video objects individually
     s3 = boto3.client('s3')
-    s3_resource = boto3.resource('s3')
 
     for d in data:
         if not d.exists():
             err(f"Error: {d} does not exist")
             exit(-1)
 
+    # all the data needs to be under the same prefix for training so index it with a single listing
+    index, denied = list_objects(s3, input.netloc, {f'{training_prefix}/'})
+    if denied:
+        raise Exception(f'No permission to list s3://{input.netloc}/{training_prefix}/')
+
     for d in data:
-        # check if the data exists in s3
-        # all the data needs to be under the same prefix for training
         target_prefix = f'{training_prefix}/{d.name}'
-        try:
-            s3_resource.Object(input.netloc, target_prefix).load()
-        except botocore.exceptions.ClientError as e:
-            info(f'{e} {d} does not exist in s3://{input.netloc}/{target_prefix}. Uploading...')
-            if e.response['Error']['Code'] == "404":
-                # The data does not exist so upload
-                try:
-                    with open(d.as_posix(), "rb") as f:
-                        info(f'Uploading {d} to s3://{input.netloc}/{target_prefix}...')
-                        s3.upload_fileobj(f, input.netloc, target_prefix)
-                except Exception as error:
-                    error(f"Error {error} uploading to s3")
-            else:
-                raise
+        if needs_upload(d, target_prefix, index):
+            # The data does not exist or is incomplete so upload and tag it in the same request
+            try:
+                with open(d.as_posix(), "rb") as f:
+                    info(f'Uploading {d} to s3://{input.netloc}/{target_prefix}...')
+                    s3.upload_fileobj(f, input.netloc, target_prefix, ExtraArgs={'Tagging': tagging_query(tags)})
+            except Exception as error:
+                err(f"Error {error} uploading to s3")
         else:
             # the data already exist so skip over it
-            info(f'Found s3://{input.path}/{target_prefix} ...skipping upload')
-
-        try:
-            # tag it
-            s3.put_object_tagging(Bucket=input.netloc, Key=target_prefix, Tagging={'TagSet': tags})
-        except Exception as error:
-            exception(error)
-            raise error
+            info(f'Found s3://{input.netloc}/{target_prefix} ...skipping upload')
+            try:
+                tag_existing(s3, input.netloc, target_prefix, tags)
+            except Exception as error:
+                exception(error)
+                raise error
 
     output = urlparse(f"s3://{input.netloc}/{training_prefix}/")
     size_gb = bucket.size(output)
@@ -157,6 +386,19 @@ def training_data(data: [Path], input: tuple, tags: dict, training_prefix: str):
     return output, size_gb
 
 
+def get_target_key(input_s3: tuple, video: Path) -> str:
+    """
+    Get the key a video is uploaded to in the bucket
+    :param input_s3: Base bucket to upload to
+    :param video: Path to the video
+    :return: Key of the video in the bucket
+    """
+    prefix_path = get_prefix(video)
+    if input_s3.path:
+        return f"{input_s3.path}/{prefix_path.lstrip('/')}/{video.name}"
+    return f"{prefix_path.lstrip('/')}/{video.name}"
+
+
 def get_prefix(path: Path):
     """
     Get the prefix from a path, stripping away any volume or drive information
@@ -4,6 +4,8 @@
 
 import click
 
+from deepsea_ai.commands.upload_tag import default_upload_workers, default_max_bandwidth_mbs
+
 # Common arguments for processing commands
 job_option = click.option('--job', type=str, required=True,
                           help='Name of the job, e.g. DiveV4361 benthic outline')
@@ -17,3 +19,11 @@ dry_run_option = click.option('--dry-run', is_flag=True, default=False,
 config_s3_option = click.option('--config-s3', type=str,
                                 help='S3 location of tracking algorithm config yaml file')
 args = click.option('--args', type=str, help='Arguments to pass directly to the docker image ')
+upload_workers_option = click.option('--upload-workers', type=int, default=default_upload_workers,
+                                     help=f'Number of videos to upload concurrently. Default {default_upload_workers}.')
+max_bandwidth_option = click.option('--max-bandwidth', type=int, default=default_max_bandwidth_mbs,
+                                    help='Total upload bandwidth limit in MB/s shared across all upload workers; '
+                                         f'0 for unlimited. Default {default_max_bandwidth_mbs}.')
+verify_checksum_option = click.option('--verify-checksum', is_flag=True, default=False,
+                                      help='Compare the checksum of local videos to those already in S3 and upload '
+                                           'again on mismatch. By default only the size is compared.')
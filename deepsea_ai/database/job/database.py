@@ -5,23 +5,34 @@
 from typing import List
 
 from pydantic_sqlalchemy import sqlalchemy_to_pydantic
-from sqlalchemy import Column, ForeignKey, Integer, String, create_engine, func, TIMESTAMP
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, create_engine, event, func, TIMESTAMP
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship, sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool
 
 from deepsea_ai.config.config import Config
-from deepsea_ai.database.job.misc import JobType, Status
-from deepsea_ai.logger import info
+from deepsea_ai.database.job.misc import JobType, Status, json_b64_decode
+from deepsea_ai.logger import info, debug
 
 Base = declarative_base()
 
+# Version of the schema, stored in the sqlite user_version of the database; bump it when adding a migration step
+schema_version = 1
+
+# Media metadata fields stored in their own columns rather than in the metadata_b64 blob
+media_columns = ('message_uuid', 'processing_job_arn', 'fingerprint')
+
+busy_timeout_secs = 30  # time to wait for another writer, e.g. the monitor thread, to release the database
+pool_size = 5  # connections kept open to the database
+
 
 class JobBase(Base):
     __abstract__ = True
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    name = Column(String, nullable=False)
-    engine = Column(String, nullable=False)
-    job_type = Column(String, nullable=False, default=JobType.SAGEMAKER)
+    name = Column(String, nullable=False, index=True)
+    engine = Column(String, nullable=False, index=True)
+    job_type = Column(String, nullable=False, default=JobType.SAGEMAKER, index=True)
     createdAt = Column(TIMESTAMP(timezone=True),
                        nullable=False, server_default=func.now())
 
@@ -31,7 +42,10 @@ class MediaBase(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
-    status = Column(String, nullable=False, default=Status.UNKNOWN)
+    status = Column(String, nullable=False, default=Status.UNKNOWN, index=True)
+    message_uuid = Column(String, nullable=True, index=True)
+    processing_job_arn = Column(String, nullable=True)
+    fingerprint = Column(String, nullable=True)
     metadata_b64 = Column(String, nullable=True)
     createdAt = Column(TIMESTAMP(timezone=True),
                        nullable=False, server_default=func.now())
@@ -50,6 +64,10 @@ class Media(MediaBase):
 
     job_id = Column(Integer, ForeignKey("job.id", ondelete="CASCADE"))
 
+    # a media is unique by name in a job; the index also serves lookups of all the media in a job
+    __table_args__ = (Index('ix_media_job_id_name', 'job_id', 'name', unique=True),
+                      Index('ix_media_job_id_status', 'job_id', 'status'))
+
 
 PydanticJob = sqlalchemy_to_pydantic(Job)
 PydanticMedia = sqlalchemy_to_pydantic(Media)
@@ -59,11 +77,71 @@ class PydanticJobWithMedias(PydanticJob):
     media: List[PydanticMedia] = []
 
 
-def init_db(cfg: Config, reset: bool = False) -> sessionmaker:
+def migrate(engine: Engine):
+    """
+    Migrate a job cache database created by an older version in place. Adds the media metadata columns, fills them
+    from the metadata of each media, removes duplicate media in a job keeping the newest, and adds the indexes.
+    :param engine: The database engine
+    """
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+        if version >= schema_version:
+            return
+        info(f'Migrating job cache database from version {version} to {schema_version}')
+
+        columns = [row[1] for row in conn.exec_driver_sql('PRAGMA table_info(media)')]
+        for column in media_columns:
+            if column not in columns:
+                conn.exec_driver_sql(f'ALTER TABLE media ADD COLUMN {column} VARCHAR')
+
+        rows = conn.exec_driver_sql('SELECT id, metadata_b64 FROM media WHERE metadata_b64 IS NOT NULL').fetchall()
+        for media_id, metadata_b64 in rows:
+            try:
+                metadata = json_b64_decode(metadata_b64)
+            except ValueError:
+                continue
+            values = {k: metadata[k] for k in media_columns if metadata.get(k)}
+            if values:
+                conn.execute(Media.__table__.update().where(Media.id == media_id).values(**values))
+
+        result = conn.exec_driver_sql('DELETE FROM media WHERE id NOT IN (SELECT MAX(id) FROM media GROUP BY job_id, name)')
+        if result.rowcount:
+            info(f'Removed {result.rowcount} duplicate media from the job cache')
+
+        for table in [Job.__table__, Media.__table__]:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        conn.exec_driver_sql(f'PRAGMA user_version = {schema_version}')
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Tune each new connection to the job cache. The write-ahead log lets readers, e.g. the monitor, run while another
+    connection writes, and a synchronous level of NORMAL only syncs the log at checkpoints, which is safe in WAL mode.
+    Writers wait for the lock for up to busy_timeout_secs instead of failing.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={busy_timeout_secs * 1000}')
+    cursor.close()
+
+
+def log_sql(conn, cursor, statement, parameters, context, executemany):
+    """
+    Log each SQL statement at the debug level
+    """
+    debug(f'{statement} {parameters}')
+
+
+def init_db(cfg: Config, reset: bool = False, echo: bool = None) -> sessionmaker:
     """
     Initialize the job cache database
     :param cfg: The configuration
     :param reset: Whether to reset the database
+    :param echo: Whether to log each SQL statement at the debug level; None to use the echo_sql setting in the
+    [database] section of the configuration
     :return: A sessionmaker
     """
     job_db_path = cfg.job_db_path
@@ -75,9 +153,19 @@ def init_db(cfg: Config, reset: bool = False) -> sessionmaker:
     # Name the database based on the account number to avoid collisions
     db = f'{job_db_path}/sqlite_job_cache_{account}.db'
     info(f"Initializing job cache database in {job_db_path} as {db}")
-    engine = create_engine(f"sqlite:///{db}", connect_args={"check_same_thread": False}, echo=True)
+    # Keep a pool of connections open so the monitor thread and the submission do not reopen the database for
+    # every session
+    engine = create_engine(f"sqlite:///{db}",
+                           connect_args={"check_same_thread": False, "timeout": busy_timeout_secs},
+                           poolclass=QueuePool, pool_size=pool_size)
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    if echo is None:
+        echo = cfg.parser.getboolean('database', 'echo_sql', fallback=False)
+    if echo:
+        event.listen(engine, 'before_cursor_execute', log_sql)
 
     Base.metadata.create_all(engine, tables=[Job.__table__, Media.__table__])
+    migrate(engine)
 
     if reset:
         # Clear the database
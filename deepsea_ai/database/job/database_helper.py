@@ -2,81 +2,92 @@
 # Filename: database/job/database_helper.py
 # Description: Job database
 
-import json
-import base64
+from collections import Counter
 from datetime import datetime
-from sqlalchemy.orm import Session
+from typing import Dict, List, Optional
 
-from deepsea_ai.database.job.database import Job, PydanticJobWithMedias, Media
-from deepsea_ai.database.job.misc import Status
-from deepsea_ai.logger import info
+from sqlalchemy import func
+from sqlalchemy.orm import Session, object_session
 
+from deepsea_ai.database.job.database import Job, Media, media_columns
+from deepsea_ai.database.job.misc import Status, json_b64_encode, json_b64_decode
+from deepsea_ai.logger import info
 
-def json_b64_encode(obj):
-    """
-    Convert a JSON object to a base64 encoded string
-    :param obj: The JSON object to convert
-    :return: The base64 encoded string
-    """
-    json_str = json.dumps(obj)
-    encoded = base64.b64encode(json_str.encode()).decode()
-    return encoded
+# maximum number of names in a single IN query, below the sqlite limit on the number of query parameters
+max_query_params = 500
 
 
-def json_b64_decode(obj):
+def get_status_counts(db: Session, job_id: Optional[int] = None) -> Dict[int, Dict[str, int]]:
     """
-    Decode a base64 encoded JSON string
-    :param obj: The base64 encoded JSON string
-    :return: The decoded JSON object
+    Count the media in each status for one or all jobs in a single query on the (job_id, status) index
+    :param db: The database session
+    :param job_id: The id of the job to count, or None for all jobs
+    :return: Dictionary of job id to a dictionary of status to the number of media in that status
     """
-    decoded = base64.b64decode(obj).decode()
-    return json.loads(decoded)
+    query = db.query(Media.job_id, Media.status, func.count(Media.id)).group_by(Media.job_id, Media.status)
+    if job_id is not None:
+        query = query.filter(Media.job_id == job_id)
+
+    counts = {}
+    for media_job_id, status, count in query:
+        counts.setdefault(media_job_id, {})[status] = count
+    return counts
 
 
-def get_status(job: Job) -> bool:
+def status_from_counts(counts: Dict[str, int]) -> str:
     """
-    Get the status of a job
-    :param job: The job to get the status of
+    Get the status of a job from the number of its media in each status
+    :param counts: Dictionary of status to the number of media in that status
     :return: The status of the job
     """
-
-    # Get the status of all the medias
-    statuses = [m.status for m in job.media]
-
     # if any of the medias are RUNNING, the job should be RUNNING
-    if Status.RUNNING in statuses:
+    if counts.get(Status.RUNNING):
         return Status.RUNNING
 
     # if any the medias are QUEUED, the job should be QUEUED
-    if Status.QUEUED in statuses:
+    if counts.get(Status.QUEUED):
         return Status.QUEUED
 
     # if any of the statuses are FAILED, the job should be FAILED
-    if Status.FAILED in statuses:
+    if counts.get(Status.FAILED):
         return Status.FAILED
 
     # if all are SUCCESS, the job should be SUCCESS
-    num_success = statuses.count(Status.SUCCESS)
-    if num_success == len(statuses):
+    if counts.get(Status.SUCCESS, 0) == sum(counts.values()):
         return Status.SUCCESS
 
     return Status.UNKNOWN
 
 
+def job_status_counts(job: Job) -> Dict[str, int]:
+    """
+    Count the media of a job in each status. A job in a session is counted in the database without loading its
+    media; otherwise its media are counted.
+    :param job: The job
+    :return: Dictionary of status to the number of media in that status
+    """
+    db = object_session(job)
+    if db is not None and job.id is not None:
+        return get_status_counts(db, job.id).get(job.id, {})
+    return dict(Counter(m.status for m in job.media))
+
+
+def get_status(job: Job) -> str:
+    """
+    Get the status of a job
+    :param job: The job to get the status of
+    :return: The status of the job
+    """
+    return status_from_counts(job_status_counts(job))
+
+
 def get_num_failed(job: Job) -> int:
     """
     Get the number of failed medias in a job
     :param job: The job to get the number of failed medias from
     :return: The number of failed medias in the job
     """
-
-    # Get the status of all the medias
-    statuses = [m.status for m in job.media]
-
-    # Count the number of FAILED medias
-    num_failed = statuses.count(Status.FAILED)
-
-    return num_failed
+    return job_status_counts(job).get(Status.FAILED, 0)
 
 
 def get_num_completed(job: Job) -> int:
@@ -85,14 +96,7 @@ def get_num_completed(job: Job) -> int:
     :param job: The job to get the number of failed medias from
     :return: The number of completed medias in the job
     """
-
-    # Get the status of all the medias
-    statuses = [m.status for m in job.media]
-
-    # Count the number of SUCCESS medias
-    num_completed = statuses.count(Status.SUCCESS)
-
-    return num_completed
+    return job_status_counts(job).get(Status.SUCCESS, 0)
 
 
 def get_job_by_name(db: Session, job_name: str) -> Job:
@@ -103,6 +107,25 @@ def get_job_by_name(db: Session, job_name: str) -> Job:
     return db.query(Job).filter(Job.name == job_name).first()
 
 
+def get_submitted_media(db: Session, job_name: str) -> dict:
+    """
+    Get the media in a job that have already been submitted and do not need to be submitted again, i.e. those
+    that are QUEUED, RUNNING or SUCCESS
+    :param db: The database session
+    :param job_name: The name of the job
+    :return: Dictionary of media name to its content fingerprint, or None if no fingerprint was recorded
+    """
+    job = get_job_by_name(db, job_name)
+    if job is None:
+        return {}
+
+    submitted = {}
+    for m in job.media:
+        if m.status in [Status.QUEUED, Status.RUNNING, Status.SUCCESS]:
+            submitted[m.name] = m.fingerprint
+    return submitted
+
+
 def get_job_by_uuid(db: Session, job_uuid: str) -> Job:
     """
     Get a job from the database by its uuid
@@ -111,9 +134,75 @@ def get_job_by_uuid(db: Session, job_uuid: str) -> Job:
     return db.query(Job).filter(Job.uuid == job_uuid).first()
 
 
+def kwargs_metadata(kwargs: dict) -> dict:
+    """
+    Get the media metadata in the keyword arguments of an update, either encoded in metadata_b64 or as the arguments
+    :param kwargs: The keyword arguments of the update
+    :return: The metadata
+    """
+    if 'metadata_b64' in kwargs:
+        return json_b64_decode(kwargs['metadata_b64'])
+    return {key: value for key, value in kwargs.items() if key != 'timestamp'}
+
+
+def set_media_metadata(media: Media, metadata: dict):
+    """
+    Set the metadata of a media, storing the fields with their own columns, e.g. the message_uuid, in those columns
+    :param media: The media to update
+    :param metadata: The metadata
+    """
+    metadata = dict(metadata)
+    for key in media_columns:
+        value = metadata.pop(key, None)
+        if value:
+            setattr(media, key, value)
+    media.metadata_b64 = json_b64_encode(metadata)
+
+
+def apply_media_update(db: Session, job: Job, media: Optional[Media], video_name: str, status: str,
+                       kwargs: dict) -> Optional[Media]:
+    """
+    Apply a status update to a media, or add the media to the job if it does not exist
+    :param db: The database session
+    :param job: The job
+    :param media: The media to update, or None to add it
+    :param video_name: The name of the video to update
+    :param status: The status of the video
+    :param kwargs: Additional metadata, and optionally the timestamp of the update
+    :return: The updated or added media, or None if the update is older than the last update of the media
+    """
+    if media is None:
+        info(f'A new media {video_name} was added to job {job.name} kwargs {kwargs}')
+        media = Media(name=video_name,
+                      status=status,
+                      job=job,
+                      updatedAt=datetime.utcnow())
+        set_media_metadata(media, kwargs_metadata(kwargs))
+        db.add(media)
+        return media
+
+    # Only update if the timestamp is newer than the last update
+    if 'timestamp' in kwargs and media.updatedAt and media.updatedAt > kwargs['timestamp']:
+        info(f'Not updating media {video_name} in job {job.name} because the timestamp is older.')
+        return None
+
+    # Update the media status, timestamp and any additional kwargs
+    media.status = status
+    media.updatedAt = datetime.utcnow()
+
+    # Merge the metadata in the kwargs into the existing metadata, keeping fields such as the
+    # submission fingerprint that are not in the update
+    metadata_json = json_b64_decode(media.metadata_b64) if media.metadata_b64 else {}
+    metadata_json.update(kwargs_metadata(kwargs))
+    set_media_metadata(media, metadata_json)
+    return media
+
+
 def update_media(db: Session, job: Job, video_name: str, status: str, **kwargs):
     """
     Update a video in a job. If the video does not exist, add it to the job.
+    The video is found by its name in the job through the unique (job_id, name) index, without loading the other
+    media in the job. The change is committed with the transaction of the session.
     :param db: The database session
     :param job: The job
     :param video_name: The name of the video to update
@@ -121,63 +210,50 @@ def update_media(db: Session, job: Job, video_name: str, status: str, **kwargs):
     """
     info(f'Updating media {video_name} to {status}')
 
-    # Set kwargs to empty dict if None
-    kwargs = kwargs or {}
-
-    # If there are additional kwargs, search by them and the name
-    media = None
-    if kwargs:
-        if 'metadata_b64' in kwargs:
-            # Find the media with the matching metadata
-            media = [m for m in job.media if m.metadata_b64 == kwargs['metadata_b64'] and m.name == video_name]
-        else:
-            for key, value in kwargs.items():
-                for m in job.media:
-                    if m.metadata_b64 and json_b64_decode(m.metadata_b64)[key] == value and m.name == video_name:
-                        info(f'Found media matching {video_name} and {key} {value} in job {job.name}')
-                        media = m
-                        break
-    if not media:  # can't find by metadata, try by name
-        media = [m for m in job.media if m.name == video_name]
-
-    if media:
-        if len(media) > 0:
-            media = media[0]
+    # A job added in this session needs an id to search its media
+    if job.id is None:
+        db.flush()
 
+    media = db.query(Media).filter(Media.job_id == job.id, Media.name == video_name).one_or_none()
+    if media is None:
+        apply_media_update(db, job, None, video_name, status, kwargs)
+    else:
         info(f'Found media {video_name} in job {job.name}')
+        if apply_media_update(db, job, media, video_name, status, kwargs) is not None:
+            db.flush()
+
 
-        # Update the media status, timestamp and any additional kwargs
-        # Only update if the timestamp is newer than the last update
-        if 'timestamp' in kwargs:
-            if media.updatedAt > kwargs['timestamp']:
-                info(f'Not updating media {video_name} in job {job.name} because the timestamp is older.')
-                return
-
-        media.status = status
-        media.updatedAt = datetime.utcnow()
-
-        # add metadata if there was one in the kwargs
-        if 'metadata_b64' in kwargs:
-            media.metadata_b64 = kwargs['metadata_b64']
-        else:
-            media.metadata_b64 = json_b64_encode(kwargs)
-
-        # Update the metadata
-        metadata_json = json_b64_decode(media.metadata_b64)
-        for key, value in kwargs.items():
-            if key in metadata_json:
-                metadata_json[key] = value
-        media.metadata_b64 = json_b64_encode(metadata_json)
-
-        db.commit()
+def update_medias(db: Session, job: Job, updates: List[dict]) -> int:
+    """
+    Apply a list of status updates to the videos in a job, adding any videos that do not exist. The videos are
+    fetched in one query and the changes are flushed together, in the transaction of the session.
+    :param db: The database session
+    :param job: The job
+    :param updates: List of updates, each a dictionary with the name and status of the video and any additional
+    metadata and timestamp as in update_media, applied in order
+    :return: The number of updates applied
+    """
+    if not updates:
+        return 0
+
+    if job.id is None:
         db.flush()
 
-    else:
-        info(f'A new media {video_name} was added to job {job.name} kwargs {kwargs}')
-        new_media = Media(name=video_name,
-                          status=status,
-                          job=job,
-                          metadata_b64=json_b64_encode(kwargs),
-                          updatedAt=datetime.utcnow())
-        db.add(new_media)
-        job.media.append(new_media)
+    names = list({u['name'] for u in updates})
+    media = {}
+    for i in range(0, len(names), max_query_params):
+        batch = names[i:i + max_query_params]
+        for m in db.query(Media).filter(Media.job_id == job.id, Media.name.in_(batch)):
+            media[m.name] = m
+
+    num_applied = 0
+    for update in updates:
+        kwargs = {key: value for key, value in update.items() if key not in ('name', 'status')}
+        m = apply_media_update(db, job, media.get(update['name']), update['name'], update['status'], kwargs)
+        if m is not None:
+            media[update['name']] = m
+            num_applied += 1
+
+    db.flush()
+    info(f'Applied {num_applied} of {len(updates)} media updates to job {job.name}')
+    return num_applied
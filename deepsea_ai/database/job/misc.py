@@ -2,7 +2,12 @@
 # Filename: database/job/misc.py
 # Description: Misc. job database functions
 
+import base64
 import hashlib
+import json
+from pathlib import Path
+
+fingerprint_bytes = 64 * 1024  # bytes read from the start and end of a file to fingerprint it
 
 
 class Status:
@@ -19,9 +24,45 @@ class JobType:
     DOCKER = "DOCKER"
 
 
+def json_b64_encode(obj):
+    """
+    Convert a JSON object to a base64 encoded string
+    :param obj: The JSON object to convert
+    :return: The base64 encoded string
+    """
+    json_str = json.dumps(obj)
+    encoded = base64.b64encode(json_str.encode()).decode()
+    return encoded
+
+
+def json_b64_decode(obj):
+    """
+    Decode a base64 encoded JSON string
+    :param obj: The base64 encoded JSON string
+    :return: The decoded JSON object
+    """
+    decoded = base64.b64decode(obj).decode()
+    return json.loads(decoded)
+
+
 def job_hash(job: str) -> str:
     """
     Hash the job name and cluster to create a unique identifier for the job
     """
     md5val = hashlib.md5(job.encode('latin')).hexdigest()
     return f"{md5val[:8]}-{md5val[8:12]}-{md5val[12:16]}-{md5val[16:20]}-{md5val[20:]}".upper()
+
+
+def media_fingerprint(path: Path) -> str:
+    """
+    Fingerprint the content of a media file from its size and the bytes at its start and end. This is cheap
+    enough to run on every video in a large directory, and changes if a video is replaced or truncated.
+    """
+    size = path.stat().st_size
+    md5 = hashlib.md5(str(size).encode('latin'))
+    with open(path.as_posix(), 'rb') as f:
+        md5.update(f.read(fingerprint_bytes))
+        if size > fingerprint_bytes:
+            f.seek(max(size - fingerprint_bytes, fingerprint_bytes))
+            md5.update(f.read(fingerprint_bytes))
+    return md5.hexdigest()
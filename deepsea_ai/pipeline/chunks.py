@@ -0,0 +1,132 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/chunks.py
+# Description: Cuts a time chunk out of a video, and stitches the tracks of the chunks of a video back together
+import base64
+import json
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from .tracks import track_dtype
+
+# Minimum IoU for detections of two chunks in the same overlap frame to be the same object
+default_iou_thres = 0.5
+
+
+@dataclass
+class Chunk:
+    num: int
+    num_chunks: int
+    start_secs: float
+    end_secs: Optional[float]
+
+
+def decode_chunk(metadata_b64: Optional[str]) -> Optional[Chunk]:
+    """
+    Decode the time chunk of a video from the base64 encoded json metadata that ecsprocess sends with each message
+    :param metadata_b64: Metadata of the message, or None if it has none
+    :return: The chunk, or None if the message is for the whole video
+    """
+    if not metadata_b64:
+        return None
+    metadata = json.loads(base64.b64decode(metadata_b64).decode())
+    if 'chunk' not in metadata:
+        return None
+    num, num_chunks = (int(n) for n in metadata['chunk'].split('/'))
+    end_secs = metadata.get('end_secs')
+    return Chunk(num, num_chunks, float(metadata.get('start_secs', 0.)), float(end_secs) if end_secs else None)
+
+
+def cut_chunk(video_path: Path, start_secs: float, end_secs: float, out_path: Path):
+    """
+    Copy a time range of a video to a new file without re-encoding. The chunks are planned to start on a keyframe,
+    so the copy starts exactly at start_secs.
+    :param video_path: Path to the video
+    :param start_secs: Start of the chunk in seconds
+    :param end_secs: End of the chunk in seconds, or None for the end of the video
+    :param out_path: Path to the chunk video to create
+    """
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-ss', f'{start_secs:.6f}']
+    if end_secs is not None:
+        cmd += ['-to', f'{end_secs:.6f}']
+    cmd += ['-i', video_path.as_posix(), '-map', '0:v:0', '-c', 'copy', '-avoid_negative_ts', 'make_zero',
+            out_path.as_posix()]
+    subprocess.run(cmd, check=True)
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Compute the IoU between two sets of detections
+    :param a: Structured array of detections with x, y, width and height fields
+    :param b: Structured array of detections with x, y, width and height fields
+    :return: len(a) x len(b) array of IoU
+    """
+    ax1, ay1 = a['x'][:, None], a['y'][:, None]
+    ax2, ay2 = ax1 + a['width'][:, None], ay1 + a['height'][:, None]
+    bx1, by1 = b['x'][None, :], b['y'][None, :]
+    bx2, by2 = bx1 + b['width'][None, :], by1 + b['height'][None, :]
+    inter = np.clip(np.minimum(ax2, bx2) - np.maximum(ax1, bx1), 0, None) * \
+        np.clip(np.minimum(ay2, by2) - np.maximum(ay1, by1), 0, None)
+    union = (a['width'] * a['height'])[:, None] + (b['width'] * b['height'])[None, :] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.)
+
+
+def merge_chunks(chunks: List[np.ndarray], iou_thres: float = default_iou_thres) -> np.ndarray:
+    """
+    Stitch the tracks of consecutive chunks of a video into tracks of the whole video. Each chunk overlaps the
+    start of the next one; a track of the next chunk continues a track of the merged tracks if its detections in the
+    overlap frames match the detections of that track in at least half the frames where it appears. The merged
+    tracks keep the detections of the earlier chunk in the overlap frames.
+    :param chunks: Structured arrays of the detections of each chunk in order, with frame numbers of the whole video
+    :param iou_thres: Minimum IoU for two detections in the same frame to match
+    :return: Structured array of the merged detections sorted by frame, with track ids unique over the whole video
+    """
+    merged = np.empty(0, dtype=track_dtype)
+    next_id = 0
+
+    for chunk in chunks:
+        chunk = chunk[np.argsort(chunk['frame'], kind='stable')]
+        if len(chunk) == 0:
+            continue
+        overlap_end = merged['frame'].max() if len(merged) else -1
+        in_overlap = chunk['frame'] <= overlap_end
+
+        # count the overlap frames where each pair of tracks match
+        votes = {}
+        frames = {}
+        for frame in np.unique(chunk['frame'][in_overlap]).tolist():
+            ours = merged[merged['frame'] == frame]
+            theirs = chunk[chunk['frame'] == frame]
+            for track_id in theirs['track_id'].tolist():
+                frames[track_id] = frames.get(track_id, 0) + 1
+            if len(ours) == 0:
+                continue
+            iou = box_iou(theirs, ours)
+            # greedy one to one matching by IoU
+            while iou.size and iou.max() >= iou_thres:
+                i, j = np.unravel_index(np.argmax(iou), iou.shape)
+                key = (int(theirs['track_id'][i]), int(ours['track_id'][j]))
+                votes[key] = votes.get(key, 0) + 1
+                iou[i, :] = -1
+                iou[:, j] = -1
+
+        # continue each track of this chunk with the merged track it matched most, if it matched often enough
+        remap = {}
+        taken = set()
+        for (theirs, ours), count in sorted(votes.items(), key=lambda v: -v[1]):
+            if theirs not in remap and ours not in taken and count * 2 >= frames[theirs]:
+                remap[theirs] = ours
+                taken.add(ours)
+        for track_id in np.unique(chunk['track_id']).tolist():
+            if track_id not in remap:
+                remap[track_id] = next_id
+                next_id += 1
+
+        rest = chunk[~in_overlap].copy()
+        rest['track_id'] = np.array([remap[t] for t in rest['track_id'].tolist()], dtype=np.int32)
+        merged = np.concatenate([merged, rest])
+
+    return merged
@@ -0,0 +1,327 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/cpu_engine.py
+# Description: Frame-batched detection and tracking for CPU-only nodes
+import argparse
+import queue
+import shlex
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+
+from .engine import Watchdog
+from .sampling import FrameSampler
+from .supervisor import TrackerResult, default_stall_secs
+from .video_reader import OpenCVReader, FFmpegReader
+
+# Defaults from the StrongSort track.py script
+default_imgsz = 640
+default_conf_thres = 0.25
+default_iou_thres = 0.45
+default_max_det = 1000
+default_reid_weights = 'weights/osnet_x0_25_msmt17.pt'
+default_strongsort_config = 'strong_sort/configs/strong_sort.yaml'
+
+
+class TrackArgsParser(argparse.ArgumentParser):
+    """
+    Parses the track.py options the batch tracker supports, raising ValueError instead of exiting on an error
+    """
+
+    def error(self, message):
+        raise ValueError(message)
+
+
+def parse_track_args(args: str) -> dict:
+    """
+    Parse the track.py options in args into BatchTracker keyword arguments
+    :param args: Additional track.py arguments, e.g. '--conf-thres 0.1 --imgsz 1280'
+    :return: Dictionary of the BatchTracker keyword arguments set in args
+    :raises ValueError: If args has an option the batch tracker does not support
+    """
+    parser = TrackArgsParser(prog='track.py', add_help=False)
+    parser.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int)
+    parser.add_argument('--conf-thres', type=float)
+    parser.add_argument('--iou-thres', type=float)
+    parser.add_argument('--max-det', type=int)
+    parser.add_argument('--classes', nargs='+', type=int)
+    parser.add_argument('--agnostic-nms', action='store_true', default=None)
+    parser.add_argument('--device', type=str)
+    opt, unknown = parser.parse_known_args(shlex.split(args or ''))
+    if unknown:
+        raise ValueError(f'Unsupported track.py arguments with --cpu-batch: {" ".join(unknown)}')
+    if opt.device is not None and opt.device != 'cpu':
+        raise ValueError(f'--cpu-batch only runs on the cpu, not device {opt.device}')
+    if opt.imgsz is not None:
+        if len(set(opt.imgsz)) != 1:
+            raise ValueError(f'--cpu-batch requires a square --imgsz, not {opt.imgsz}')
+        opt.imgsz = opt.imgsz[0]
+    return {k: v for k, v in vars(opt).items() if v is not None and k != 'device'}
+
+
+class FrameDecoder(threading.Thread):
+    """
+    Decodes and letterboxes the frames of a video in a background thread, so decoding overlaps with inference
+    """
+
+    def __init__(self, reader, imgsz: int, stride: int, max_queued: int, sampler: FrameSampler = None):
+        """
+        :param reader: Video reader to decode the frames with, e.g. an OpenCVReader or FFmpegReader
+        :param imgsz: Size of the square network input
+        :param stride: Model stride the input is padded to
+        :param max_queued: Maximum number of decoded frames waiting on inference
+        :param sampler: Selects the frames to decode; None for every frame
+        """
+        super().__init__(daemon=True)
+        from yolov5.utils.augmentations import letterbox
+        self.letterbox = letterbox
+        self.imgsz = imgsz
+        self.stride = stride
+        self.reader = reader
+        self.total_frames = reader.total_frames
+        self.fps = reader.fps
+        self.sampler = sampler or FrameSampler()
+        self.sampler.reset()
+        self.frames = queue.Queue(maxsize=max_queued)
+        self.stopped = threading.Event()
+        self.error = None
+
+    def put(self, frame) -> bool:
+        """
+        Queue a frame, waiting for space unless the decoder is stopped
+        :return: True if the frame was queued, False if the decoder was stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(frame, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stop(self):
+        """
+        Stop decoding and discard the queued frames, e.g. when inference fails before all the frames are read
+        """
+        self.stopped.set()
+        while True:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                break
+
+    def run(self):
+        try:
+            frame_idx = 0
+            while True:
+                target = self.sampler.next_frame(frame_idx, self.fps)
+                if target is None:
+                    break
+                # seek over long gaps, and grab without decoding over short ones
+                if target - frame_idx > self.fps:
+                    self.reader.seek(target)
+                    frame_idx = target
+                while frame_idx < target and self.reader.grab():
+                    frame_idx += 1
+                if frame_idx < target:
+                    break
+                im0 = self.reader.read()
+                if im0 is None:
+                    break
+                if not self.sampler.changed(im0):
+                    frame_idx += 1
+                    continue
+                # pad every frame to the full square so the frames can be batched
+                im = self.letterbox(im0, self.imgsz, stride=self.stride, auto=False)[0]
+                im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+                if not self.put((frame_idx, im0, im)):
+                    break
+                frame_idx += 1
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.reader.release()
+            self.put(None)
+
+    def batches(self, batch_size: int, timeout: float = None, on_frame: Callable[[], None] = None):
+        """
+        Iterate over the decoded frames in batches
+        :param batch_size: Number of frames per batch; the last batch may be smaller
+        :param timeout: Seconds to wait for the next frame before raising TimeoutError, or None to wait forever
+        :param on_frame: Function called for each decoded frame, e.g. to report progress to a watchdog
+        :return: Iterator of lists of (frame index, original frame, letterboxed frame) tuples
+        """
+        batch = []
+        while True:
+            try:
+                frame = self.frames.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f'No frame decoded for {timeout:.0f} seconds')
+            if on_frame:
+                on_frame()
+            if frame is None:
+                break
+            batch.append(frame)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        if self.error:
+            raise self.error
+
+
+class BatchTracker:
+    """
+    Runs the YOLOv5 detector on batches of frames on the CPU and tracks the detections with StrongSort, writing the
+    tracks in the same layout the tracks parser reads: frame track_id x y width height confidence class_name.
+    The detector is loaded once and reused for all the videos.
+    """
+
+    def __init__(self, yolo_weights: Path, reid_weights: Path = None, config_strongsort: Path = None,
+                 track_dir: Path = None, batch_size: int = 8, num_threads: int = None, imgsz: int = default_imgsz,
+                 conf_thres: float = default_conf_thres, iou_thres: float = default_iou_thres,
+                 max_det: int = default_max_det, classes: List[int] = None, agnostic_nms: bool = False,
+                 sampler: FrameSampler = None, decoder: str = 'opencv', decode_width: int = None,
+                 decode_threads: int = 0, hwaccel: str = None):
+        """
+        :param yolo_weights: Path to the YOLOv5 weights
+        :param reid_weights: Path to the StrongSort ReID weights; defaults to the track.py default
+        :param config_strongsort: Path to the StrongSort config yaml; defaults to the track.py default
+        :param track_dir: Path to the directory with track.py and its yolov5 and strong_sort packages
+        :param batch_size: Number of frames per detector forward pass
+        :param num_threads: Number of intra-op threads for torch; defaults to the number of cores
+        :param imgsz: Size of the square network input
+        :param conf_thres: Detection confidence threshold
+        :param iou_thres: Non-max suppression IoU threshold
+        :param max_det: Maximum number of detections per frame
+        :param classes: Class indexes to keep, or None for all the classes
+        :param agnostic_nms: True for class-agnostic non-max suppression
+        :param sampler: Selects the frames to detect and track; None for every frame
+        :param decoder: Video decoder; opencv or ffmpeg
+        :param decode_width: Width the ffmpeg decoder downscales the frames to; None for the full size
+        :param decode_threads: Number of ffmpeg decoding threads; 0 to let ffmpeg choose
+        :param hwaccel: ffmpeg hardware acceleration method; None for software decoding
+        """
+        track_dir = (track_dir or Path.cwd()).resolve()
+        for path in [track_dir, track_dir / 'yolov5', track_dir / 'strong_sort']:
+            if path.as_posix() not in sys.path:
+                sys.path.append(path.as_posix())
+
+        import torch
+        from yolov5.models.common import DetectMultiBackend
+        from yolov5.utils import general
+        from strong_sort.utils.parser import get_config
+        from strong_sort.strong_sort import StrongSORT
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.torch = torch
+        self.general = general
+        self.scale_boxes = getattr(general, 'scale_boxes', None) or general.scale_coords
+        self.get_config = get_config
+        self.StrongSORT = StrongSORT
+
+        self.device = torch.device('cpu')
+        self.model = DetectMultiBackend(Path(yolo_weights), device=self.device)
+        self.imgsz = general.check_img_size(imgsz, s=self.model.stride)
+        self.model.warmup(imgsz=(batch_size, 3, self.imgsz, self.imgsz))
+        self.names = self.model.names
+        self.reid_weights = Path(reid_weights or track_dir / default_reid_weights)
+        self.config_strongsort = Path(config_strongsort or track_dir / default_strongsort_config)
+        self.batch_size = batch_size
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+        self.classes = classes
+        self.agnostic_nms = agnostic_nms
+        self.sampler = sampler
+        self.decoder = decoder
+        self.decode_width = decode_width
+        self.decode_threads = decode_threads
+        self.hwaccel = hwaccel
+
+    def new_tracker(self):
+        """
+        Create a StrongSort tracker for a video
+        """
+        cfg = self.get_config()
+        cfg.merge_from_file(self.config_strongsort.as_posix())
+        return self.StrongSORT(self.reid_weights, self.device, False,
+                               max_dist=cfg.STRONGSORT.MAX_DIST,
+                               max_iou_distance=cfg.STRONGSORT.MAX_IOU_DISTANCE,
+                               max_age=cfg.STRONGSORT.MAX_AGE,
+                               n_init=cfg.STRONGSORT.N_INIT,
+                               nn_budget=cfg.STRONGSORT.NN_BUDGET,
+                               mc_lambda=cfg.STRONGSORT.MC_LAMBDA,
+                               ema_alpha=cfg.STRONGSORT.EMA_ALPHA)
+
+    def run(self, video_path: Path, tracks_path: Path, stall_secs: float = default_stall_secs,
+            max_secs: float = None, on_timeout: Callable[[str], None] = None, poll_secs: float = 1) -> TrackerResult:
+        """
+        Detect and track the objects in a video. Waiting on the decoder times out after stall_secs, and the same
+        watchdog as the resident tracker exits the process if decoding, detection or tracking make no progress for
+        stall_secs, or the run takes longer than max_secs, as inference cannot be stopped
+        :param video_path: Path to the video
+        :param tracks_path: Path to the .txt file to write the tracks to
+        :param stall_secs: Seconds with no decoded or tracked frame before the process exits
+        :param max_secs: Maximum seconds the run can take, or None for no limit
+        :param on_timeout: Function called with the reason before exiting, e.g. to fail the video
+        :param poll_secs: Seconds between checks of the run
+        :return: The result of the run with the frames processed per second
+        """
+        start = time.monotonic()
+        torch = self.torch
+        if self.decoder == 'ffmpeg':
+            reader = FFmpegReader(video_path, self.decode_width, self.decode_threads, self.hwaccel)
+        else:
+            reader = OpenCVReader(video_path)
+        decoder = FrameDecoder(reader, self.imgsz, int(self.model.stride), max_queued=2 * self.batch_size,
+                               sampler=self.sampler)
+        decoder.start()
+        strongsort = self.new_tracker()
+        prev_frame = None
+        frames = 0
+        tracks_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # stop the decoder if tracking fails, so it does not block on a full queue
+        try:
+            with open(tracks_path, 'w') as f, torch.no_grad(), \
+                    Watchdog(stall_secs, max_secs, on_timeout, poll_secs) as watchdog:
+                for batch in decoder.batches(self.batch_size, stall_secs, watchdog.progress):
+                    im = torch.from_numpy(np.ascontiguousarray(np.stack([b[2] for b in batch]))).float() / 255
+                    pred = self.model(im)
+                    pred = self.general.non_max_suppression(pred, self.conf_thres, self.iou_thres, self.classes,
+                                                            self.agnostic_nms, max_det=self.max_det)
+
+                    # the tracker is sequential, so update it frame by frame in order
+                    for (frame_idx, im0, _), det in zip(batch, pred):
+                        if prev_frame is not None and hasattr(strongsort, 'tracker') and \
+                                hasattr(strongsort.tracker, 'camera_update'):
+                            strongsort.tracker.camera_update(prev_frame, im0)
+                        prev_frame = im0
+
+                        if len(det):
+                            det[:, :4] = self.scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
+                            xywhs = self.general.xyxy2xywh(det[:, 0:4])
+                            outputs = strongsort.update(xywhs, det[:, 4], det[:, 5], im0)
+                            for x1, y1, x2, y2, track_id, cls, conf in (o[:7] for o in outputs):
+                                # report the boxes in the full size video when the decoder downscaled the frames
+                                x1, y1, x2, y2 = (v * reader.scale for v in (x1, y1, x2, y2))
+                                name = str(self.names[int(cls)]).replace(' ', '_')
+                                f.write(f'{frame_idx + 1} {int(track_id)} {x1:g} {y1:g} {x2 - x1:g} {y2 - y1:g} '
+                                        f'{conf:g} {name}\n')
+                        else:
+                            strongsort.increment_ages()
+                        frames += 1
+                        watchdog.progress()
+        finally:
+            decoder.stop()
+            decoder.join()
+
+        elapsed = time.monotonic() - start
+        fps = frames / elapsed if elapsed > 0 else 0.
+        return TrackerResult(returncode=0, frames=frames, total_frames=decoder.total_frames, fps=fps, output='')
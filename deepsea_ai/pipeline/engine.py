@@ -0,0 +1,136 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/engine.py
+# Description: Runs the StrongSort track.py script in-process, keeping the detector loaded between videos
+import importlib
+import os
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Callable, List
+
+from .supervisor import TrackerResult, default_stall_secs
+
+
+class Watchdog:
+    """
+    Exits the whole process if no progress is reported for too long, for trackers that run in this process and
+    cannot be killed like the track.py subprocess
+    """
+
+    def __init__(self, stall_secs: float = default_stall_secs, max_secs: float = None,
+                 on_timeout: Callable[[str], None] = None, poll_secs: float = 1):
+        """
+        :param stall_secs: Seconds with no progress before the process exits
+        :param max_secs: Maximum seconds the run can take, or None for no limit
+        :param on_timeout: Function called with the reason before exiting, e.g. to fail the video
+        :param poll_secs: Seconds between checks of the run
+        """
+        self.stall_secs = stall_secs
+        self.max_secs = max_secs
+        self.on_timeout = on_timeout
+        self.poll_secs = poll_secs
+        self.last_progress = time.monotonic()
+        self.done = threading.Event()
+
+    def __enter__(self):
+        self.start = self.last_progress = time.monotonic()
+        threading.Thread(target=self.watch, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.done.set()
+
+    def progress(self):
+        """
+        Report progress, e.g. a detector forward pass
+        """
+        self.last_progress = time.monotonic()
+
+    def watch(self):
+        while not self.done.wait(self.poll_secs):
+            now = time.monotonic()
+            if now - self.last_progress > self.stall_secs:
+                reason = f'No progress for {now - self.last_progress:.0f} seconds'
+            elif self.max_secs is not None and now - self.start > self.max_secs:
+                reason = f'Exceeded {self.max_secs} seconds'
+            else:
+                continue
+            print(f'Stopping tracker. {reason}')
+            try:
+                if self.on_timeout:
+                    self.on_timeout(reason)
+            finally:
+                sys.stdout.flush()
+                os._exit(1)
+
+
+class ResidentTracker:
+    """
+    Imports track.py once and runs it for each video in this process, so torch is imported and the YOLOv5 detector
+    is loaded and initialized only once per container. StrongSort is still created for each video, as it holds the
+    track state of the video. A run cannot be killed like the track.py subprocess, so a watchdog exits the whole
+    process if the detector makes no progress for too long.
+    """
+
+    def __init__(self, track_dir: Path = None):
+        """
+        :param track_dir: Path to the directory with track.py; defaults to the working directory
+        """
+        track_dir = (track_dir or Path.cwd()).resolve()
+        if track_dir.as_posix() not in sys.path:
+            sys.path.insert(0, track_dir.as_posix())
+        self.track = importlib.import_module('track')
+        self.models = {}
+        self.watchdog = None
+
+        # load each detector once and reuse it for the following videos
+        detector = self.track.DetectMultiBackend
+
+        def load_detector(weights, *args, **kwargs):
+            key = (str(weights), repr(args), repr(sorted(kwargs.items())))
+            if key not in self.models:
+                model = detector(weights, *args, **kwargs)
+                # each forward pass of the detector is progress for the watchdog
+                forward = model.forward
+
+                def watched_forward(*args, **kwargs):
+                    if self.watchdog:
+                        self.watchdog.progress()
+                    return forward(*args, **kwargs)
+
+                model.forward = watched_forward
+                self.models[key] = model
+            return self.models[key]
+
+        self.track.DetectMultiBackend = load_detector
+
+    def run(self, track_args: List[str], stall_secs: float = default_stall_secs, max_secs: float = None,
+            on_timeout: Callable[[str], None] = None, poll_secs: float = 1) -> TrackerResult:
+        """
+        Run track.py on a video. If the detector makes no progress for stall_secs, or the run takes longer than
+        max_secs, on_timeout is called with the reason and the process exits, as the run cannot be stopped
+        :param track_args: Command line arguments for track.py
+        :param stall_secs: Seconds with no detector forward pass before the process exits
+        :param max_secs: Maximum seconds the run can take, or None for no limit
+        :param on_timeout: Function called with the reason before exiting, e.g. to fail the video
+        :param poll_secs: Seconds between checks of the run
+        :return: The result of the run; returncode is non-zero if the tracker failed
+        """
+        argv = sys.argv
+        try:
+            with Watchdog(stall_secs, max_secs, on_timeout, poll_secs) as self.watchdog:
+                sys.argv = ['track.py'] + track_args
+                opt = self.track.parse_opt()
+                self.track.run(**vars(opt))
+            return TrackerResult(returncode=0, frames=0, total_frames=0, fps=0., output='')
+        except (Exception, SystemExit) as ex:
+            # argparse exits on invalid arguments; that only fails this video
+            output = traceback.format_exc()
+            print(output)
+            return TrackerResult(returncode=1, frames=0, total_frames=0, fps=0., output=output,
+                                 reason=f'Tracker failed: {ex!r}')
+        finally:
+            self.watchdog = None
+            sys.argv = argv
@@ -0,0 +1,127 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/frame_writer.py
+# Description: Writes visual events aggregated by frame in the same format as deepsea-track
+import gzip
+import io
+import json
+import tarfile
+import time
+from pathlib import Path
+
+
+class FrameWriter:
+    """
+    Streams visual events into one f<frame>.json file per frame. Events must arrive in frame order; each frame
+    file is written exactly once, when the events for the next frame start or the writer is closed.
+    """
+
+    def __init__(self, output_path: Path):
+        """
+        :param output_path: Path to the directory to write the frame files to
+        """
+        self.output_path = output_path
+        self.frame_num = -1
+        self.visual_events = []
+        self.num_frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, frame_num: int, visual_event: dict):
+        """
+        Add a visual event, writing the previous frame if this event starts a new frame
+        :param frame_num: Frame number of the event
+        :param visual_event: Dictionary with the bounding box, class name, confidence, etc. of the event
+        """
+        if frame_num != self.frame_num:
+            self.flush()
+            self.frame_num = frame_num
+        self.visual_events.append(["visualevent", visual_event])
+
+    def write_frame(self, frame_num: int, visual_events: list):
+        """
+        Add all the visual events of a frame
+        :param frame_num: Frame number of the events
+        :param visual_events: List of visual event dictionaries
+        """
+        for visual_event in visual_events:
+            self.add(frame_num, visual_event)
+
+    def flush(self):
+        """
+        Write the events for the current frame, if any
+        """
+        if len(self.visual_events) == 0:
+            return
+        self.write(f"f{self.frame_num:06}.json", ["visualevents", self.visual_events])
+        self.num_frames += 1
+        self.visual_events = []
+
+    def write(self, name: str, data):
+        """
+        Write a json file
+        :param name: Name of the file
+        :param data: Data to serialize to json
+        """
+        with open(self.output_path / name, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+    def close(self):
+        """
+        Write the last frame
+        """
+        self.flush()
+
+
+class TarFrameWriter(FrameWriter):
+    """
+    Streams the frame files straight into a gzip compressed tar archive so they are never staged on disk.
+    """
+
+    def __init__(self, tar_path: Path, arcname: str, compress_level: int = 1):
+        """
+        :param tar_path: Path to the .tar.gz archive to create
+        :param arcname: Name of the directory in the archive to write the files to
+        :param compress_level: gzip compression level from 1 (fastest) to 9 (smallest)
+        """
+        super().__init__(Path(arcname))
+        self.fileobj = open(tar_path, 'wb')
+        self.gzip = gzip.GzipFile(filename='', mode='wb', fileobj=self.fileobj, compresslevel=compress_level)
+        self.tar = tarfile.open(fileobj=self.gzip, mode='w|')
+
+    def write(self, name: str, data):
+        self.add_bytes(name, json.dumps(data).encode('utf-8'))
+
+    def add_bytes(self, name: str, data: bytes):
+        """
+        Add a file to the archive
+        :param name: Name of the file
+        :param data: Contents of the file
+        """
+        info = tarfile.TarInfo((self.output_path / name).as_posix())
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def add_file(self, path: Path, name: str = None):
+        """
+        Add a file on disk to the archive after the frames added so far
+        :param path: Path to the file
+        :param name: Name of the file in the archive; defaults to the file name
+        """
+        self.flush()
+        self.tar.add(path.as_posix(), arcname=(self.output_path / (name or path.name)).as_posix())
+
+    def close(self):
+        """
+        Write the last frame and finish the archive
+        """
+        try:
+            super().close()
+        finally:
+            self.tar.close()
+            self.gzip.close()
+            self.fileobj.close()
@@ -0,0 +1,183 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/model_cache.py
+# Description: Persistent on-host cache of models and tracker configurations downloaded from S3
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+# Set MODEL_CACHE_DIR to a mounted volume to share the cache across container restarts
+cache_dir_env = 'MODEL_CACHE_DIR'
+cache_max_gb_env = 'MODEL_CACHE_MAX_GB'
+default_cache_max_gb = 20
+
+manifest_name = 'manifest.json'
+
+
+def file_sha256(path: Path) -> str:
+    """
+    Compute the sha256 digest of a file
+    :param path: Path to the file
+    :return: Hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ModelCache:
+    """
+    Cache of S3 objects keyed by their bucket, key and VersionId or ETag, so a changed object is downloaded again.
+    Tar files are stored unpacked. Each entry has a manifest with the sha256 digest of its files, which is checked
+    before the entry is used, and the least recently used entries are evicted when the cache is over its size limit.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        """
+        :param root: Path to the cache directory
+        :param max_bytes: Maximum size of the cache in bytes
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Create the cache from the MODEL_CACHE_DIR and MODEL_CACHE_MAX_GB environment variables
+        :return: The cache, or None if MODEL_CACHE_DIR is not set
+        """
+        if cache_dir_env not in os.environ:
+            return None
+        max_gb = float(os.environ.get(cache_max_gb_env, default_cache_max_gb))
+        return cls(Path(os.environ[cache_dir_env]), int(max_gb * 1024 ** 3))
+
+    def entry_path(self, bucket: str, key: str, version: str) -> Path:
+        """
+        Get the path to the cache entry of an object
+        :param bucket: Bucket name
+        :param key: prefix/key to the object
+        :param version: VersionId or ETag of the object
+        """
+        digest = hashlib.sha256(f'{bucket}/{key}@{version}'.encode('utf-8')).hexdigest()[:32]
+        return self.root / digest
+
+    def get(self, s3, bucket: str, key: str) -> Path:
+        """
+        Get an object from the cache, downloading it on a miss
+        :param s3: boto3 S3 client
+        :param bucket: Bucket name
+        :param key: prefix/key to the object
+        :return: Path to the cache entry directory with the object, or its contents if it is a tar file
+        """
+        head = s3.head_object(Bucket=bucket, Key=key)
+        version = head.get('VersionId') or head['ETag'].strip('"')
+        entry = self.entry_path(bucket, key, version)
+
+        if self.verify(entry):
+            print(f'Using cached s3://{bucket}/{key} in {entry}')
+            self.touch(entry)
+            return entry
+
+        shutil.rmtree(entry, ignore_errors=True)
+        download_path = Path(tempfile.mkdtemp(dir=self.root, prefix='.download-'))
+        try:
+            local_path = download_path / Path(key).name
+            print(f'Downloading s3://{bucket}/{key} to {local_path.as_posix()}')
+            s3.download_file(bucket, key, local_path.as_posix())
+
+            if local_path.suffix == '.gz' or local_path.suffix == '.tar':
+                print(f'Unpacking {local_path}...')
+                with tarfile.open(local_path) as tar:
+                    tar.extractall(download_path)
+                local_path.unlink()
+
+            files = sorted(f for f in download_path.rglob('*') if f.is_file())
+            manifest = {
+                'bucket': bucket,
+                'key': key,
+                'version': version,
+                'files': {f.relative_to(download_path).as_posix(): file_sha256(f) for f in files},
+                'size': sum(f.stat().st_size for f in files),
+            }
+            with open(download_path / manifest_name, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=4)
+
+            # another container may have filled the same entry in the meantime
+            try:
+                download_path.rename(entry)
+            except OSError:
+                if not self.verify(entry):
+                    raise
+        finally:
+            shutil.rmtree(download_path, ignore_errors=True)
+
+        self.touch(entry)
+        self.evict(keep=entry)
+        return entry
+
+    def verify(self, entry: Path) -> bool:
+        """
+        Check the files of a cache entry match its manifest
+        :param entry: Path to the cache entry
+        :return: True if the entry is complete and intact
+        """
+        manifest_path = entry / manifest_name
+        if not manifest_path.exists():
+            return False
+        try:
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            return all((entry / name).is_file() and file_sha256(entry / name) == sha256
+                       for name, sha256 in manifest['files'].items())
+        except (OSError, ValueError, KeyError) as ex:
+            print(f'Invalid cache entry {entry}: {ex}')
+            return False
+
+    @staticmethod
+    def touch(entry: Path):
+        """
+        Mark a cache entry as used
+        """
+        now = time.time_ns()
+        os.utime(entry / manifest_name, ns=(now, now))
+
+    def entries(self) -> list:
+        """
+        Get the cache entries, least recently used first
+        :return: List of (last used time, size in bytes, path) tuples
+        """
+        entries = []
+        for entry in self.root.iterdir():
+            manifest_path = entry / manifest_name
+            if entry.name.startswith('.') or not manifest_path.exists():
+                continue
+            try:
+                with open(manifest_path, encoding='utf-8') as f:
+                    size = json.load(f)['size']
+                entries.append((manifest_path.stat().st_mtime, size, entry))
+            except (OSError, ValueError, KeyError):
+                continue
+        return sorted(entries)
+
+    def evict(self, keep: Path = None):
+        """
+        Remove the least recently used entries until the cache is within its size limit
+        :param keep: Path to an entry to never evict
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for last_used, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            print(f'Evicting {entry} from the model cache, last used {time.ctime(last_used)}')
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,87 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/post_process.py
+# Description: Saves the results of tracked videos in background workers while the next video is tracked
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+class LockedProcessor:
+    """
+    Wraps a queue processor so it can be shared by the prefetcher, the post-processing workers and the main loop.
+    The calls that read or update the queue state are not thread safe, so they are made one at a time. Downloads,
+    uploads and cleanup are left unlocked so they overlap with each other and with the queue updates.
+    """
+    locked_methods = {'has_video', 'message_run', 'message_fail'}
+
+    def __init__(self, processor):
+        """
+        :param processor: Queue processor to wrap
+        """
+        self.processor = processor
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.processor, name)
+        if name not in self.locked_methods:
+            return attr
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+class PostProcessor:
+    """
+    Saves the results of each tracked video, then removes its temporary directory and cleans it from the queue
+    processor. With workers, videos are post-processed in the background, with at most workers videos waiting
+    to limit disk use. Any failure is kept in failures for the caller to stop on.
+    """
+
+    def __init__(self, processor, save, workers: int = 0):
+        """
+        :param processor: Queue processor to report the results to; must be safe to call from several threads
+        :param save: Function to save the results of a video, called with the processor, the video and the arguments
+        passed to submit
+        :param workers: Number of videos to post-process in the background; 0 post-processes each video on submit
+        """
+        self.processor = processor
+        self.save = save
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self.pending = threading.BoundedSemaphore(max(workers, 1))
+        self.failures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(wait=True)
+
+    def submit(self, video, video_tmp_path: Path, *args):
+        """
+        Post-process a video, waiting for a free worker if all are busy
+        :param video: Video the tracker ran on
+        :param video_tmp_path: Temporary directory of the video, removed once its results are saved
+        :param args: Arguments to pass to the save function
+        """
+        self.pending.acquire()
+        if self.workers > 0:
+            self.executor.submit(self.run, video, video_tmp_path, *args)
+        else:
+            self.run(video, video_tmp_path, *args)
+
+    def run(self, video, video_tmp_path: Path, *args):
+        try:
+            self.save(self.processor, video, *args)
+            # clean temp input and output dirs
+            shutil.rmtree(video_tmp_path, ignore_errors=True)
+            self.processor.clean(video)
+        except Exception as ex:
+            print(f'System failure exception {ex} saving {video.name}')
+            self.failures.append((video, ex))
+        finally:
+            self.pending.release()
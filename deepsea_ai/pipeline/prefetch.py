@@ -0,0 +1,109 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/prefetch.py
+# Description: Fetches the next queued video in the background while the current one is tracked
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Default fraction of the volume that must be free before the next video is prefetched
+default_min_free = 0.25
+
+
+class Prefetcher:
+    """
+    Wraps a queue processor to fetch videos into their own temporary directory. When enabled, the next video is
+    fetched in a background thread as soon as the current one is handed out, unless that would leave less than
+    min_free of the volume free, in which case it is fetched when it is needed.
+    """
+
+    def __init__(self, processor, tmp_path: Path, debug: bool, enabled: bool = True,
+                 min_free: float = default_min_free):
+        """
+        :param processor: Queue processor to fetch the videos from
+        :param tmp_path: Path to create the per-video temporary directories in
+        :param debug: Debugging flag passed to the queue processor
+        :param enabled: True to fetch the next video in the background
+        :param min_free: Fraction of the volume that must be free to fetch in the background
+        """
+        self.processor = processor
+        self.tmp_path = tmp_path
+        self.debug = debug
+        self.enabled = enabled
+        self.min_free = min_free
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        self.executor.shutdown(wait=True)
+
+    def release(self):
+        """
+        Fail any video prefetched but never handed out, e.g. on shutdown, so it does not stay queued as running,
+        and remove its temporary directory
+        """
+        if self.future is None:
+            return
+        future, self.future = self.future, None
+        try:
+            video, video_tmp_path = future.result()
+        except Exception as ex:
+            print(f'System failure exception {ex} prefetching the next video')
+            return
+        if video is not None:
+            print(f'Failing {video.name}; it was prefetched but not processed before shutdown')
+            self.processor.message_fail(video, 'Prefetched but not processed before shutdown')
+            shutil.rmtree(video_tmp_path, ignore_errors=True)
+
+    def has_video(self) -> bool:
+        """
+        Check if there is a video fetched or waiting to be fetched
+        """
+        return self.future is not None or self.processor.has_video()
+
+    def has_space(self) -> bool:
+        """
+        Check if there is enough free space on the volume to fetch a video in the background
+        """
+        usage = shutil.disk_usage(self.tmp_path)
+        return usage.free >= self.min_free * usage.total
+
+    def fetch(self):
+        """
+        Fetch the next video into a new temporary directory with in and out subdirectories
+        :return: The video, or None if there are no more videos, and the path to its temporary directory
+        """
+        video_tmp_path = Path(tempfile.mkdtemp(dir=self.tmp_path))
+        (video_tmp_path / 'in').mkdir()
+        (video_tmp_path / 'out').mkdir()
+        video = self.processor.next(video_tmp_path / 'out', self.debug)
+        if video is None:
+            shutil.rmtree(video_tmp_path, ignore_errors=True)
+        return video, video_tmp_path
+
+    def next(self, on_next=None):
+        """
+        Get the next video, and start fetching the one after it in the background
+        :param on_next: Function called with the video before the one after it starts fetching, e.g. to mark it
+        running while the queue processor is still free
+        :return: The video, or None if there are no more videos, and the path to its temporary directory
+        """
+        if self.future is not None:
+            future, self.future = self.future, None
+            video, video_tmp_path = future.result()
+        else:
+            video, video_tmp_path = self.fetch()
+
+        if video is not None and on_next:
+            on_next(video)
+
+        if video is not None and self.enabled and self.processor.has_video():
+            if self.has_space():
+                self.future = self.executor.submit(self.fetch)
+            else:
+                print(f'Less than {self.min_free:.0%} of {self.tmp_path} is free; not prefetching the next video')
+        return video, video_tmp_path
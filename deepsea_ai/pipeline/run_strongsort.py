@@ -9,17 +9,28 @@ import json
 import signal
 import tarfile
 import os
+import shlex
 import shutil
-import subprocess
 import sys
+import traceback
 from pathlib import Path
 from urllib.parse import urlparse
-import uuid
 from pipeline import queue_processor
 from pipeline import __version__
+from pipeline.frame_writer import FrameWriter, TarFrameWriter
+from pipeline.chunks import cut_chunk, decode_chunk, merge_chunks, default_iou_thres
+from pipeline.cpu_engine import BatchTracker, parse_track_args
+from pipeline.engine import ResidentTracker
+from pipeline.model_cache import ModelCache
+from pipeline.post_process import LockedProcessor, PostProcessor
+from pipeline.prefetch import Prefetcher, default_min_free
+from pipeline.sampling import FrameSampler, parse_window
+from pipeline.supervisor import supervise, default_stall_secs, TrackerResult
+from pipeline.video_reader import probe
+from pipeline.tracks import load_tracks, track_uuids, group_by_frame, visual_events, save_npz, save_tracks, \
+    renumber_frames
 
 # If running in AWS, we must define the inputs/outputs per the spec
-from pipeline.data_models import generate_uuids, parse_events
 
 if 'AWS_CONTAINER_CREDENTIALS_RELATIVE_URI' in os.environ:
     default_input = '/opt/ml/processing/input'
@@ -34,7 +45,15 @@ stop_flag = False
 # A known pretrained model
 default_model_s3 = 's3://902005-public/models/yolov5x_mbay_benthic_model.tar.gz'  # yolov5 model
 
-MAX_TIMEOUT_SECS = 3 * 60 * 60  # maximum time a file should take to process is 3 hours
+
+def parse_windows(values: tuple) -> list:
+    """
+    Parse the --window options
+    """
+    try:
+        return [parse_window(v) for v in values]
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
 
 
 @click.group(context_settings={'help_option_names': ['-h', '--help']})
@@ -60,10 +79,53 @@ def cli():
               help='S3 path to the trained model tar gz file - must contain a valid YOLOv5 Pytorch model. ')
 @click.option('--debug', is_flag=True, help='Debugging flag. Skips processing and downloading of the model.')
 @click.option('--args', type=str, help='Additional arguments to pass to strong sort track.py script')
-def process_command(config_s3, reid_weights, input, output, model_s3, debug, args):
+@click.option('--track-format', type=click.Choice(['json', 'npz']), default='json', show_default=True,
+              help='Format to save the tracks in. json saves one f<frame>.json file per frame compatible with '
+                   'deepsea-track; npz saves a single compressed tracks.npz file indexed by frame')
+@click.option('--stream-tar', is_flag=True,
+              help='Stream the json frame files into a single frames.tar.gz in the results instead of writing one '
+                   'file per frame to disk. Has no effect with --track-format npz')
+@click.option('--compress-level', type=click.IntRange(1, 9), default=1, show_default=True,
+              help='gzip compression level of the streamed frames.tar.gz from 1 (fastest) to 9 (smallest)')
+@click.option('--workers', type=click.IntRange(0), default=0, show_default=True,
+              help='Number of videos to post-process and save in the background while the next video is tracked. '
+                   '0 processes one video at a time')
+@click.option('--prefetch', is_flag=True, help='Fetch the next video in the background while the current one is tracked')
+@click.option('--min-free', type=click.FloatRange(0, 1), default=default_min_free, show_default=True,
+              help='Fraction of the volume that must be free to prefetch the next video')
+@click.option('--stall-minutes', type=click.FloatRange(min=0, min_open=True), default=default_stall_secs / 60,
+              show_default=True, help='Minutes the tracker can go without processing a frame before the video is failed. '
+                                      'With --resident or --cpu-batch, the process also exits')
+@click.option('--resident', is_flag=True,
+              help='Run track.py in this process, loading the detector once for all the videos instead of per video')
+@click.option('--cpu-batch', type=click.IntRange(0), default=0, show_default=True,
+              help='Detect and track on the CPU in-process, passing this many frames per detector forward pass. '
+                   '0 runs track.py instead. Only the --imgsz, --conf-thres, --iou-thres, --max-det, --classes, '
+                   '--agnostic-nms and --device cpu options of --args are supported in this mode')
+@click.option('--cpu-threads', type=click.IntRange(1), help='Number of threads for CPU inference. Defaults to all cores')
+@click.option('--stride', type=click.IntRange(1), default=1, show_default=True,
+              help='Detect and track every Nth frame')
+@click.option('--window', 'windows', multiple=True, callback=lambda ctx, param, value: parse_windows(value),
+              help='Only detect and track frames in this time window, as START-END in seconds or HH:MM:SS, '
+                   'e.g. 00:10:00-00:25:00. Can be repeated. Requires --cpu-batch')
+@click.option('--scene-threshold', type=click.FloatRange(0, 1), default=0., show_default=True,
+              help='Skip frames whose mean absolute difference from the last tracked frame is below this fraction. '
+                   'Requires --cpu-batch')
+@click.option('--decoder', type=click.Choice(['opencv', 'ffmpeg']), default='opencv', show_default=True,
+              help='Video decoder for --cpu-batch. ffmpeg decodes with multiple threads in a separate process')
+@click.option('--decode-width', type=click.IntRange(2), help='Width for the ffmpeg decoder to downscale the frames to')
+@click.option('--decode-threads', type=click.IntRange(0), default=0, show_default=True,
+              help='Number of ffmpeg decoding threads. 0 lets ffmpeg choose')
+@click.option('--hwaccel', type=str, help='ffmpeg hardware acceleration method, e.g. auto, cuda or vaapi')
+def process_command(config_s3, reid_weights, input, output, model_s3, debug, args, track_format, stream_tar,
+                    compress_level, workers, prefetch, min_free, stall_minutes, resident, cpu_batch, cpu_threads,
+                    stride, windows, scene_threshold, decoder, decode_width, decode_threads, hwaccel):
     """
     Process a collection of videos either from an input folder, or from a sqs queue
     """
+    # only the batch tracker selects the frames it reads
+    if (windows or scene_threshold) and not cpu_batch:
+        raise click.UsageError('--window and --scene-threshold require --cpu-batch')
     signal.signal(signal.SIGTERM, sigterm_handler)
     global stop_flag
     print(f'{__version__}')
@@ -71,169 +133,259 @@ def process_command(config_s3, reid_weights, input, output, model_s3, debug, arg
     input_path = Path(input)
     output_path = Path(output)
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    processor = queue_processor.QueueProcessor(input_path, output_path)
+    # the processor is shared with the prefetch and post-processing threads
+    processor = LockedProcessor(queue_processor.QueueProcessor(input_path, output_path))
+    sampler = FrameSampler(stride, windows, scene_threshold)
+    # fail before any video is taken from the queue if the batch tracker cannot honor the arguments
+    cpu_args = {}
+    if cpu_batch:
+        try:
+            cpu_args = parse_track_args(args.strip('"') if args else None)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex), param_hint='--args')
 
     # download and setup the model once in a temp dir
     download_fini = False
+    tracker = None
     with tempfile.TemporaryDirectory() as model_temp_dir:
 
-        # strongsort track.py requires separate input/output so let's create that here
-        with tempfile.TemporaryDirectory() as in_tmp_dir:
-            in_tmp_path = Path(in_tmp_dir) / 'in'
-            in_tmp_path.mkdir()
-            out_tmp_path = Path(in_tmp_dir) / 'out'
-            out_tmp_path.mkdir()
+        # strongsort track.py requires separate input/output so let's create that here; each video gets its own
+        # directories so a video can be post-processed while the next one is fetched and tracked
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                PostProcessor(processor, save_results, workers) as post_processor, \
+                Prefetcher(processor, Path(tmp_dir), debug, prefetch, min_free) as prefetcher:
 
-            while processor.has_video() and not stop_flag:
+            while prefetcher.has_video() and not stop_flag and not post_processor.failures:
                 try:
-                    # start fetching new video
-                    video = processor.next(out_tmp_path, debug)
+                    # get the next video, mark it running and start fetching the one after it
+                    video, video_tmp_path = prefetcher.next(processor.message_run)
 
                     if video is None:
                         break
 
+                    in_tmp_path = video_tmp_path / 'in'
+
                     # only download the model if we have a video to process
                     if not debug and not download_fini:
                         download_fini = True
                         model_path, config_path = download_config(model_s3, config_s3, Path(model_temp_dir))
 
+                    start_utc = datetime.datetime.utcnow()
+
                     # output tar to save the results to
                     out_tar_path = Path(output_path) / f'{video.stem}.tracks.tar.gz'
-                    out_tar_path.parent.mkdir(parents=True, exist_ok=True)
 
-                    start_utc = datetime.datetime.utcnow()
+                    # a chunk of a long video is cut out without re-encoding and tracked on its own,
+                    # with its frames numbered from the start of the whole video
+                    source_path = video.input_path
+                    frame_offset = 0
+                    # the chunk is in the message metadata, which the queue processor passes through as is
+                    chunk = decode_chunk(getattr(video, 'metadata_b64', None))
+                    if chunk:
+                        source_path = video_tmp_path / 'chunk' / video.input_path.name
+                        source_path.parent.mkdir()
+                        cut_chunk(video.input_path, chunk.start_secs, chunk.end_secs, source_path)
+                        frame_offset = int(round(chunk.start_secs * probe(video.input_path)['fps']))
+                        out_tar_path = Path(output_path) / f'{video.stem}.chunk{chunk.num:03d}.tracks.tar.gz'
+                    out_tar_path.parent.mkdir(parents=True, exist_ok=True)
 
                     # Strip off the quotes
                     if args:
                         args = args.strip('"')
 
                     if not debug:
-                        cmd_track = f'python3 track.py ' \
-                                    f'--source {video.input_path} ' \
-                                    f'--project {in_tmp_path} ' \
-                                    f'--name {video.input_path.stem} ' \
-                                    f'--save-txt ' \
-                                    f'{args} '
+                        track_args = f'--source {source_path} ' \
+                                     f'--project {in_tmp_path} ' \
+                                     f'--name {video.input_path.stem} ' \
+                                     f'--save-txt ' \
+                                     f'{args or ""} '
                         if model_path:
-                            cmd_track += f'--yolo-weights {model_path} '
+                            track_args += f'--yolo-weights {model_path} '
                         if reid_weights:
-                            cmd_track += f'--strong-sort-weights {reid_weights} '
+                            track_args += f'--strong-sort-weights {reid_weights} '
                         if config_path:
-                            cmd_track += f'--config-strongsort {config_path} '
+                            track_args += f'--config-strongsort {config_path} '
+                        if stride > 1:
+                            track_args += f'--vid-stride {stride} '
+                        cmd_track = f'python3 track.py {track_args}'
                     else:
                         cmd_track = [f"echo track {input_path} && sleep 60"]
 
                     print(f'Running {cmd_track}')
-                    processor.message_run(video)
-                    track_proc = subprocess.Popen(cmd_track, shell=True)
-                    track_proc.wait(timeout=MAX_TIMEOUT_SECS)
-
-                    if track_proc.returncode != 0:
-                        processor.message_fail(video, track_proc.stdout)
+                    if cpu_batch and not debug:
+                        # batch frames through the detector on the CPU, loading it once for all the videos
+                        try:
+                            if tracker is None:
+                                tracker = BatchTracker(model_path, reid_weights, config_path, batch_size=cpu_batch,
+                                                       num_threads=cpu_threads, sampler=sampler, decoder=decoder,
+                                                       decode_width=decode_width, decode_threads=decode_threads,
+                                                       hwaccel=hwaccel, **cpu_args)
+                            stem = video.input_path.stem
+                            result = tracker.run(source_path, in_tmp_path / stem / 'tracks' / f'{stem}.txt',
+                                                 stall_secs=stall_minutes * 60,
+                                                 on_timeout=lambda reason: processor.message_fail(video, reason))
+                        except Exception as ex:
+                            result = TrackerResult(returncode=1, frames=0, total_frames=0, fps=0.,
+                                                   output=traceback.format_exc(), reason=f'Tracker failed: {ex!r}')
+                        print(f'Tracked {result.frames}/{result.total_frames} frames in {video.name} '
+                              f'at {result.fps:.1f} frames/sec')
+                    elif resident and not debug:
+                        # load the tracker once and keep it for the following videos; a stalled tracker cannot
+                        # be killed, so the video is failed and the container exits to be restarted
+                        if tracker is None:
+                            tracker = ResidentTracker()
+                        result = tracker.run(shlex.split(track_args), stall_secs=stall_minutes * 60,
+                                             on_timeout=lambda reason: processor.message_fail(video, reason))
+                    else:
+                        result = supervise(cmd_track, stall_secs=stall_minutes * 60)
+                        print(f'Tracked {result.frames}/{result.total_frames} frames in {video.name} '
+                              f'at {result.fps:.1f} frames/sec')
+
+                    # fail just this video and continue with the queue
+                    if result.returncode != 0:
+                        processor.message_fail(video, f'{result.reason}\n{result.output}'.strip())
+                        shutil.rmtree(video_tmp_path, ignore_errors=True)
                         continue
 
-                    track_path = in_tmp_path / video.input_path.stem
-                    track_path.mkdir(parents=True, exist_ok=True)
-
-                    # copy any configuration files to further downstream data loading/processing
-                    if processing_job_cfg_path.exists():
-                        print(f'Copying {processing_job_cfg_path} to {track_path}')
-                        shutil.copy2(processing_job_cfg_path.as_posix(), track_path.as_posix())
-                    else:
-                        # create a new job file in the temp_dir with job metadata
-                        with open(f"{track_path.as_posix()}/processingjobconfig.json", "w", encoding="utf-8") as j:
-                            image_uri = os.environ[
-                                'IMAGE_URI'] if 'IMAGE_URI' in os.environ else "mbari/strongsort-yolov5:latest"
-                            processor_name = os.environ[
-                                'PROCESSOR'] if 'PROCESSOR' in os.environ else "strongsort-yolov5"
-                            json.dump({
-                                "UserName": video.user_name,
-                                "ProcessingJobName": f"{processor_name}-{video.job_name}",
-                                "AppSpecification": {
-                                    "ImageUri": image_uri,
-                                    "ContainerArguments": sys.argv
-                                }
-                            }, j)
-
-                    # insert the video path into the processing job config file
-                    with open(f"{track_path.as_posix()}/processingjobconfig.json", "r", encoding="utf-8") as f:
-                        json_dict = json.load(f)
-
-                    json_dict['VideoName'] = video.input_path.name
-
-                    with open(f"{track_path.as_posix()}/processingjobconfig.json", "w", encoding="utf-8") as j:
-                        json.dump(json_dict, j, indent=4)
-
-                    # capture the number of unique tracks
-                    unique_track_ids = set()
-
-                    # convert the yolo output to a more friendly json output
-                    # yolo output is a simple .txt file with the same file prefix as the video_path,
-                    # e.g. myvideo.mov output is myvideo.txt
-                    yolo_results = track_path / 'tracks' / f'{video.input_path.stem}.txt'
-
-                    # handle missing data
-                    if yolo_results.exists():
-
-                        events_sans_uuids = parse_events(yolo_results.as_posix())
-                        events = generate_uuids(events_sans_uuids)
-
-                        # save events aggregated by frame in the same format as deepsea-track to simplify loading
-                        visual_events = []
-                        last_frame = -1
-                        for e in events:
-                            if last_frame == -1:
-                                last_frame = e['frameNum']
-
-                            if e['frameNum'] > last_frame:
-                                with open(f"{track_path}/f{last_frame:06}.json", 'w', encoding='utf-8') as f:
-                                    json.dump(["visualevents", visual_events], f)
-                                    visual_events = []
-
-                            last_frame = e['frameNum']
-
-                            visual_events.append(["visualevent",
-                                                  {
-                                                      'bounding_box': {
-                                                          'height': e['height'],
-                                                          'width': e['width'],
-                                                          'x': e['x'],
-                                                          'y': e['y']
-                                                      },
-                                                      'class_name': e['name'],
-                                                      'confidence': e['confidence'],
-                                                      'frame_num': e['frameNum'],
-                                                      'occlusion': e['occlusion'],
-                                                      'surprise': e['surprise'],
-                                                      'track_uuid': e['track_uuid'],
-                                                      'uuid': str(uuid.uuid4()),
-                                                  }
-                                                  ])
-                            unique_track_ids.add(e['track_uuid'])
-
-                            if len(visual_events) > 0:
-                                with open(f"{track_path}/f{last_frame:06}.json", 'w',
-                                          encoding='utf-8') as f:
-                                    json.dump(["visualevents", visual_events], f)
-
-                    # make the output unique with a timestamp
-                    total_time = datetime.datetime.utcnow() - start_utc
-                    processor.message_save(track_path, out_tar_path, video, len(unique_track_ids), total_time.total_seconds())
-
-                    print(f'Captured {len(unique_track_ids)} in {video.name}. Total processing time {total_time}. Started at {start_utc}')
-
-                    # clean temp input dir and remove output
-                    for i in in_tmp_path.glob('*'):
-                        if not i.is_dir(): i.unlink()
-                    for o in out_tmp_path.glob('*'):
-                        o.unlink()
-                    processor.clean(video)
+                    # post-process in the background while the next video is tracked
+                    # the batch tracker numbers the frames it skips, track.py only the frames it reads
+                    post_processor.submit(video, video_tmp_path, video_tmp_path / 'in' / video.input_path.stem,
+                                          out_tar_path, start_utc, track_format, frame_offset,
+                                          1 if cpu_batch else stride, stream_tar, compress_level)
 
                 except Exception as ex:
                     print(f'System failure exception {ex}')
                     exit(-1)
+
+        if post_processor.failures:
+            exit(-1)
     print('Done')
 
+@cli.command(name="merge")
+@click.argument('chunks', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('-o', '--output', type=click.Path(dir_okay=False), required=True,
+              help='Path to the tar.gz to save the merged tracks to')
+@click.option('--track-format', type=click.Choice(['json', 'npz']), default='json', show_default=True,
+              help='Format to save the tracks in')
+@click.option('--iou-thres', type=click.FloatRange(0, 1), default=default_iou_thres, show_default=True,
+              help='Minimum IoU for the detections of two chunks in an overlap frame to be the same object')
+def merge_command(chunks, output, track_format, iou_thres):
+    """
+    Stitch the tracks of the chunks of a long video processed separately into the tracks of the whole video.
+    CHUNKS are the .chunk<N>.tracks.tar.gz results of each chunk, in order.
+    """
+    output_path = Path(output)
+    stem = output_path.name.split('.')[0]
+    chunk_tracks = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, chunk in enumerate(chunks):
+            with tarfile.open(chunk) as tar:
+                members = [m for m in tar.getmembers() if m.isfile() and Path(m.name).parent.name == 'tracks'
+                           and m.name.endswith('.txt')]
+                if not members:
+                    print(f'No tracks in {chunk}')
+                    continue
+                tracks_path = Path(tmp_dir) / f'{i}.txt'
+                tracks_path.write_bytes(tar.extractfile(members[0]).read())
+            chunk_tracks.append(load_tracks(tracks_path))
+
+    tracks = merge_chunks(chunk_tracks, iou_thres)
+    uuids, uuid_index = track_uuids(tracks['track_id'])
+    with TarFrameWriter(output_path, stem) as writer:
+        if track_format == 'npz':
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                save_npz(Path(tmp_dir) / 'tracks.npz', tracks, uuids, uuid_index)
+                writer.add_file(Path(tmp_dir) / 'tracks.npz')
+        else:
+            for frame_num, rows in group_by_frame(tracks):
+                writer.write_frame(frame_num, visual_events(tracks[rows], uuids[uuid_index[rows]]))
+    print(f'Merged {len(chunks)} chunks into {len(uuids)} tracks in {output_path}')
+
+
+def save_results(processor, video, track_path: Path, out_tar_path: Path, start_utc: datetime.datetime,
+                 track_format: str, frame_offset: int = 0, stride: int = 1, stream_tar: bool = False,
+                 compress_level: int = 1):
+    """
+    Convert the tracker output of a video to visual events and save them with the processing job configuration
+    :param processor: Queue processor to report the results to
+    :param video: Video the tracker ran on
+    :param track_path: Path to the tracker output of the video
+    :param out_tar_path: Path to the tar.gz to save the results to
+    :param start_utc: Time processing of the video started
+    :param track_format: Format to save the tracks in; json or npz
+    :param frame_offset: Number of the first frame in the whole video when the video is a chunk of a longer video
+    :param stride: Frame stride track.py ran with, which numbers only the frames it read
+    :param stream_tar: True to stream the json frame files into frames.tar.gz in track_path
+    :param compress_level: gzip compression level of the streamed frames.tar.gz
+    """
+    track_path.mkdir(parents=True, exist_ok=True)
+
+    # copy any configuration files to further downstream data loading/processing
+    if processing_job_cfg_path.exists():
+        print(f'Copying {processing_job_cfg_path} to {track_path}')
+        shutil.copy2(processing_job_cfg_path.as_posix(), track_path.as_posix())
+    else:
+        # create a new job file in the temp_dir with job metadata
+        with open(f"{track_path.as_posix()}/processingjobconfig.json", "w", encoding="utf-8") as j:
+            image_uri = os.environ['IMAGE_URI'] if 'IMAGE_URI' in os.environ else "mbari/strongsort-yolov5:latest"
+            processor_name = os.environ['PROCESSOR'] if 'PROCESSOR' in os.environ else "strongsort-yolov5"
+            json.dump({
+                "UserName": video.user_name,
+                "ProcessingJobName": f"{processor_name}-{video.job_name}",
+                "AppSpecification": {
+                    "ImageUri": image_uri,
+                    "ContainerArguments": sys.argv
+                }
+            }, j)
+
+    # insert the video path into the processing job config file
+    with open(f"{track_path.as_posix()}/processingjobconfig.json", "r", encoding="utf-8") as f:
+        json_dict = json.load(f)
+
+    json_dict['VideoName'] = video.input_path.name
+
+    with open(f"{track_path.as_posix()}/processingjobconfig.json", "w", encoding="utf-8") as j:
+        json.dump(json_dict, j, indent=4)
+
+    # capture the number of unique tracks
+    num_tracks = 0
+
+    # convert the yolo output to a more friendly json output
+    # yolo output is a simple .txt file with the same file prefix as the video_path,
+    # e.g. myvideo.mov output is myvideo.txt
+    yolo_results = track_path / 'tracks' / f'{video.input_path.stem}.txt'
+
+    # the queue processor still tars track_path into out_tar_path, so streamed frames go in an archive inside it
+    if stream_tar and track_format == 'json':
+        writer = TarFrameWriter(track_path / 'frames.tar.gz', '.', compress_level)
+    else:
+        writer = FrameWriter(track_path)
+
+    with writer:
+        # handle missing data
+        if yolo_results.exists():
+
+            tracks = load_tracks(yolo_results)
+            if frame_offset or stride > 1:
+                # number the frames from the start of the whole video, and keep the tracker output for merging
+                renumber_frames(tracks, stride, frame_offset)
+                save_tracks(yolo_results, tracks)
+            uuids, uuid_index = track_uuids(tracks['track_id'])
+            num_tracks = len(uuids)
+
+            if track_format == 'npz':
+                save_npz(track_path / 'tracks.npz', tracks, uuids, uuid_index)
+            else:
+                # save events aggregated by frame in the same format as deepsea-track to simplify loading
+                for frame_num, rows in group_by_frame(tracks):
+                    writer.write_frame(frame_num, visual_events(tracks[rows], uuids[uuid_index[rows]]))
+
+    # make the output unique with a timestamp
+    total_time = datetime.datetime.utcnow() - start_utc
+    processor.message_save(track_path, out_tar_path, video, num_tracks, total_time.total_seconds())
+
+    print(f'Captured {num_tracks} in {video.name}. Total processing time {total_time}. Started at {start_utc}')
+
 
 def download_s3_file(bucket: str, key: str, local_path: Path) -> bool:
     """
@@ -245,22 +397,28 @@ def download_s3_file(bucket: str, key: str, local_path: Path) -> bool:
     """
     try:
         print(f'Downloading s3://{bucket}/{key} to {local_path.as_posix()}')
-        if 'AWS_DEFAULT_PROFILE' in os.environ:
-            print(f'Using AWS profile {os.environ["AWS_DEFAULT_PROFILE"]}')
-            session = boto3.Session(profile_name=os.environ['AWS_DEFAULT_PROFILE'])
-            s3 = session.resource('s3')
-        else:
-            s3 = boto3.resource('s3')
-        s3.Bucket(bucket).download_file(key, local_path.as_posix())
+        get_s3().Bucket(bucket).download_file(key, local_path.as_posix())
         return True
     except Exception as ex:
         print(f'Exception {ex}')
         return False
 
 
+def get_s3():
+    """
+    Get the S3 resource, using the AWS_DEFAULT_PROFILE profile if set
+    """
+    if 'AWS_DEFAULT_PROFILE' in os.environ:
+        print(f'Using AWS profile {os.environ["AWS_DEFAULT_PROFILE"]}')
+        session = boto3.Session(profile_name=os.environ['AWS_DEFAULT_PROFILE'])
+        return session.resource('s3')
+    return boto3.resource('s3')
+
+
 def download_config(model_uri: str, track_uri: str, output_dir: Path):
     """
-    Downloads and unpacks the model data and optionally a tracker config yaml
+    Downloads and unpacks the model data and optionally a tracker config yaml, through the model cache
+    in MODEL_CACHE_DIR if set
 
     :param model_uri: full path to model bucket object
     :param track_uri: full path to track bucket object or None if using default
@@ -278,6 +436,20 @@ def download_config(model_uri: str, track_uri: str, output_dir: Path):
     track_out_yaml = output_dir / 'strongsort_config.yaml'
 
     try:
+        # use the model cache if there is one, skipping the download and unpacking on a hit
+        cache = ModelCache.from_env()
+        if cache:
+            s3 = get_s3().meta.client
+            model_dir = cache.get(s3, parsed_url_model.netloc, parsed_url_model.path.lstrip('/'))
+            model_out_path = next(model_dir.rglob('*.pt'), model_dir / model_out_path.name)
+            if parsed_track_config:
+                config_dir = cache.get(s3, parsed_track_config.netloc, parsed_track_config.path.lstrip('/'))
+                track_out_yaml = config_dir / Path(parsed_track_config.path).name
+                found_config = True
+            if model_out_path.suffix != '.pt':
+                raise Exception(f'Cannot find model {model_out_path}')
+            return model_out_path, track_out_yaml if found_config else None
+
         if not download_s3_file(parsed_url_model.netloc, parsed_url_model.path.lstrip('/'), model_out_path):
             raise Exception(f'Cannot find model {model_uri}')
 
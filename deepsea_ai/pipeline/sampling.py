@@ -0,0 +1,105 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/sampling.py
+# Description: Selects which frames of a video to detect and track
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# Approximate width in pixels of the thumbnails compared for scene changes
+thumbnail_width = 64
+
+
+def parse_time(value: str) -> float:
+    """
+    Parse a time in seconds, MM:SS or HH:MM:SS
+    :param value: Time string, e.g. 90, 01:30 or 00:01:30.5
+    :return: Time in seconds
+    """
+    secs = 0.
+    for part in value.strip().split(':'):
+        secs = secs * 60 + float(part)
+    return secs
+
+
+def parse_window(value: str) -> Tuple[float, float]:
+    """
+    Parse a time window
+    :param value: Window as START-END, e.g. 00:10:00-00:25:00; END can be omitted to run to the end of the video
+    :return: Start and end time in seconds
+    """
+    start, _, end = value.partition('-')
+    start_secs = parse_time(start) if start.strip() else 0.
+    end_secs = parse_time(end) if end.strip() else math.inf
+    if end_secs <= start_secs:
+        raise ValueError(f'Window {value} ends before it starts')
+    return start_secs, end_secs
+
+
+class FrameSampler:
+    """
+    Selects every stride-th frame inside the time windows, and optionally only the frames that differ from the last
+    selected frame by more than the scene change threshold. Frames keep their index in the video, so the frame
+    numbers of the tracks are the same whichever frames are skipped.
+    """
+
+    def __init__(self, stride: int = 1, windows: List[Tuple[float, float]] = None, scene_threshold: float = 0.):
+        """
+        :param stride: Select every stride-th frame
+        :param windows: Time windows in seconds to select the frames from; None for the whole video
+        :param scene_threshold: Minimum mean absolute difference, from 0 to 1, between a frame and the last selected
+        frame for the frame to be selected; 0 to select every frame
+        """
+        self.stride = max(stride, 1)
+        self.windows = sorted(windows) if windows else None
+        self.scene_threshold = scene_threshold
+        self.last_thumbnail = None
+
+    @property
+    def all_frames(self) -> bool:
+        """
+        True if every frame is selected
+        """
+        return self.stride == 1 and not self.windows and not self.scene_threshold
+
+    def next_frame(self, frame_idx: int, fps: float) -> Optional[int]:
+        """
+        Find the next frame on the stride and inside a time window
+        :param frame_idx: Index of the first frame to consider
+        :param fps: Frame rate of the video
+        :return: Index of the next frame, or None if there are no more frames to select
+        """
+        if not self.windows:
+            return frame_idx + (-frame_idx) % self.stride
+
+        for start_secs, end_secs in self.windows:
+            start = math.ceil(start_secs * fps)
+            end = math.inf if math.isinf(end_secs) else math.ceil(end_secs * fps)
+            candidate = max(frame_idx, start)
+            candidate += (-candidate) % self.stride
+            if candidate < end:
+                return candidate
+        return None
+
+    def changed(self, frame: np.ndarray) -> bool:
+        """
+        Check if a frame differs enough from the last selected frame, selecting it if it does
+        :param frame: Frame as a height x width x channels array
+        :return: True if the frame is selected
+        """
+        if not self.scene_threshold:
+            return True
+
+        step = max(frame.shape[1] // thumbnail_width, 1)
+        thumbnail = frame[::step, ::step].astype(np.float32).mean(axis=-1) / 255
+        if self.last_thumbnail is not None and thumbnail.shape == self.last_thumbnail.shape and \
+                np.abs(thumbnail - self.last_thumbnail).mean() < self.scene_threshold:
+            return False
+        self.last_thumbnail = thumbnail
+        return True
+
+    def reset(self):
+        """
+        Reset the scene change reference for a new video
+        """
+        self.last_thumbnail = None
@@ -0,0 +1,103 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/supervisor.py
+# Description: Runs the tracker in a subprocess, reporting its progress and stopping it if it stalls
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+
+# Frame progress in the tracker output, e.g. video 1/1 (123/5400) /tmp/in/video.mp4: 640x384 3 Sebastes, Done.
+progress_re = re.compile(r'\((\d+)/(\d+)\)')
+
+# Default time with no new frames before the tracker is considered stalled
+default_stall_secs = 10 * 60
+
+
+@dataclass
+class TrackerResult:
+    returncode: int
+    frames: int
+    total_frames: int
+    fps: float
+    output: str
+    reason: str = ''
+
+
+def supervise(cmd, stall_secs: float = default_stall_secs, max_secs: float = None, report_secs: float = 60,
+              poll_secs: float = 1) -> TrackerResult:
+    """
+    Run the tracker, streaming its output and reporting the frames processed per second. The tracker is killed
+    if it makes no progress for stall_secs, or runs for longer than max_secs.
+    :param cmd: Shell command to run the tracker
+    :param stall_secs: Seconds with no new frames before the tracker is killed
+    :param max_secs: Maximum seconds the tracker can run for, or None for no limit
+    :param report_secs: Seconds between progress reports
+    :param poll_secs: Seconds between checks of the tracker
+    :return: The result of the run; returncode is non-zero if the tracker failed or was killed
+    """
+    start = time.monotonic()
+    state = {'frames': 0, 'total_frames': 0, 'last_progress': start}
+    tail = deque(maxlen=50)
+    lock = threading.Lock()
+
+    # start the tracker in its own session so the shell and everything it started can be killed together
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                            errors='replace', bufsize=1, start_new_session=True)
+
+    def read_output():
+        for line in proc.stdout:
+            line = line.rstrip()
+            match = progress_re.search(line)
+            with lock:
+                tail.append(line)
+                if match and int(match.group(1)) != state['frames']:
+                    state['frames'], state['total_frames'] = int(match.group(1)), int(match.group(2))
+                    state['last_progress'] = time.monotonic()
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+
+    reason = ''
+    last_report = start
+    while proc.poll() is None:
+        time.sleep(poll_secs)
+        now = time.monotonic()
+        with lock:
+            frames, total_frames, last_progress = state['frames'], state['total_frames'], state['last_progress']
+        if now - last_report >= report_secs:
+            last_report = now
+            print(f'Tracked {frames}/{total_frames} frames at {frames / (now - start):.1f} frames/sec')
+        if now - last_progress > stall_secs:
+            reason = f'No progress for {now - last_progress:.0f} seconds after {frames}/{total_frames} frames'
+        elif max_secs is not None and now - start > max_secs:
+            reason = f'Exceeded {max_secs} seconds after {frames}/{total_frames} frames'
+        if reason:
+            print(f'Stopping tracker. {reason}')
+            kill(proc)
+            break
+
+    proc.wait()
+    reader.join(timeout=poll_secs)
+    elapsed = time.monotonic() - start
+    with lock:
+        frames, total_frames, output = state['frames'], state['total_frames'], '\n'.join(tail)
+    returncode = proc.returncode if not reason else (proc.returncode or -1)
+    return TrackerResult(returncode=returncode, frames=frames, total_frames=total_frames,
+                         fps=frames / elapsed if elapsed > 0 else 0., output=output, reason=reason)
+
+
+def kill(proc: subprocess.Popen, grace_secs: float = 10):
+    """
+    Terminate a process and its children, killing them if they do not exit within grace_secs
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=grace_secs)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
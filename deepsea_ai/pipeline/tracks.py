@@ -0,0 +1,181 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/tracks.py
+# Description: Vectorized parser for the StrongSort tracks output
+import uuid
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import numpy as np
+
+# One detection per line in the whitespace delimited tracks/<video stem>.txt StrongSort output:
+# frame track_id x y width height confidence class_name occlusion surprise
+track_dtype = np.dtype([('frame', np.int32),
+                        ('track_id', np.int32),
+                        ('x', np.float64),
+                        ('y', np.float64),
+                        ('width', np.float64),
+                        ('height', np.float64),
+                        ('confidence', np.float64),
+                        ('class_name', 'U64'),
+                        ('occlusion', np.float64),
+                        ('surprise', np.float64)])
+
+# The frame-batched CPU tracker has no occlusion or surprise scores, and writes only the first 8 columns
+num_base_columns = 8
+
+
+def load_tracks(path: Path) -> np.ndarray:
+    """
+    Load a tracks file in a single pass into a structured array sorted by frame. Files with only the first 8 columns
+    have no occlusion or surprise, which are set to 0
+    :param path: Path to the tracks .txt file
+    :return: Structured array with the fields in track_dtype
+    :raises ValueError: If the file does not have the columns in track_dtype, e.g. the 10 column MOT format of the
+    upstream track.py, which has no class names or confidences
+    """
+    with open(path) as f:
+        first = next((line.split() for line in f if line.strip()), None)
+    if first is None:
+        return np.empty(0, dtype=track_dtype)
+    if len(first) not in (num_base_columns, len(track_dtype.names)):
+        raise ValueError(f'{path} has {len(first)} columns; expected {num_base_columns} or '
+                         f'{len(track_dtype.names)}: {" ".join(track_dtype.names)}')
+
+    dtype = np.dtype(track_dtype.descr[:len(first)])
+    # a line with a different number of columns than the first fails here
+    rows = np.loadtxt(path.as_posix(), dtype=dtype, ndmin=1)
+    tracks = np.zeros(len(rows), dtype=track_dtype)
+    for name in dtype.names:
+        tracks[name] = rows[name]
+
+    if np.any((tracks['confidence'] < 0) | (tracks['confidence'] > 1)):
+        raise ValueError(f'{path} has confidences outside 0 to 1; expected the columns {" ".join(track_dtype.names)}')
+    if all(is_number(c) for c in np.unique(tracks['class_name']).tolist()):
+        raise ValueError(f'{path} has numeric class names; expected the columns {" ".join(track_dtype.names)}')
+    return tracks[np.argsort(tracks['frame'], kind='stable')]
+
+
+def is_number(value: str) -> bool:
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def save_tracks(path: Path, tracks: np.ndarray):
+    """
+    Save detections in the same layout as the tracks file
+    :param path: Path to the tracks .txt file
+    :param tracks: Structured array with the fields in track_dtype
+    """
+    with open(path, 'w') as f:
+        for frame, track_id, x, y, width, height, confidence, class_name, occlusion, surprise in tracks.tolist():
+            f.write(f'{frame} {track_id} {x:g} {y:g} {width:g} {height:g} {confidence:g} {class_name} '
+                    f'{occlusion:g} {surprise:g}\n')
+
+
+def renumber_frames(tracks: np.ndarray, stride: int = 1, frame_offset: int = 0) -> np.ndarray:
+    """
+    Number the frames of the tracker output from the start of the whole video. track.py run with --vid-stride
+    numbers the frames it read 1, 2, 3..., so each is mapped back to the frame it was read from before the offset
+    of a chunk is added
+    :param tracks: Structured array with the fields in track_dtype, renumbered in place
+    :param stride: Frame stride the tracker ran with
+    :param frame_offset: Number of the first frame in the whole video when the video is a chunk of a longer video
+    :return: The renumbered tracks
+    """
+    tracks['frame'] = (tracks['frame'] - 1) * stride + 1 + frame_offset
+    return tracks
+
+
+def track_uuids(track_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Assign a uuid to each unique track
+    :param track_ids: Track id of each detection
+    :return: Array of the unique track uuids, and the index into it for each detection
+    """
+    unique_ids, index = np.unique(track_ids, return_inverse=True)
+    uuids = np.array([str(uuid.uuid4()) for _ in range(len(unique_ids))], dtype='U36')
+    return uuids, index.reshape(-1)
+
+
+def group_by_frame(tracks: np.ndarray) -> Iterator[Tuple[int, slice]]:
+    """
+    Group the detections by frame
+    :param tracks: Structured array of detections sorted by frame
+    :return: Iterator of the frame number and the slice of the detections in that frame
+    """
+    frame_nums, starts = np.unique(tracks['frame'], return_index=True)
+    ends = np.append(starts[1:], len(tracks))
+    for frame_num, start, end in zip(frame_nums.tolist(), starts.tolist(), ends.tolist()):
+        yield frame_num, slice(start, end)
+
+
+def visual_events(tracks: np.ndarray, uuids: np.ndarray) -> list:
+    """
+    Convert detections to visual events in the same format as deepsea-track
+    :param tracks: Structured array of detections
+    :param uuids: Track uuid of each detection
+    :return: List of visual event dictionaries
+    """
+    events = []
+    for (frame, _, x, y, width, height, confidence, class_name, occlusion, surprise), track_uuid in \
+            zip(tracks.tolist(), uuids.tolist()):
+        events.append({
+            'bounding_box': {
+                'height': height,
+                'width': width,
+                'x': x,
+                'y': y
+            },
+            'class_name': class_name,
+            'confidence': confidence,
+            'frame_num': frame,
+            'occlusion': occlusion,
+            'surprise': surprise,
+            'track_uuid': track_uuid,
+            'uuid': str(uuid.uuid4()),
+        })
+    return events
+
+
+def save_npz(path: Path, tracks: np.ndarray, uuids: np.ndarray, uuid_index: np.ndarray):
+    """
+    Save the detections in a single compressed columnar file. The detections are stored sorted by frame with
+    offsets into them for each frame, and each detection references its track in a table of track uuids.
+    :param path: Path to the .npz file
+    :param tracks: Structured array of detections sorted by frame
+    :param uuids: Array of the unique track uuids
+    :param uuid_index: Index into uuids for each detection
+    """
+    frame_nums, starts = np.unique(tracks['frame'], return_index=True)
+    np.savez_compressed(path,
+                        frame_nums=frame_nums,
+                        frame_offsets=np.append(starts, len(tracks)),
+                        track_index=uuid_index.astype(np.int32),
+                        track_uuids=uuids,
+                        **{name: tracks[name] for name in track_dtype.names if name not in ('frame', 'track_id')})
+
+
+def load_npz(path: Path) -> dict:
+    """
+    Load the detections saved with save_npz
+    :param path: Path to the .npz file
+    :return: Dictionary of the saved arrays
+    """
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def frame_slice(data: dict, frame_num: int) -> slice:
+    """
+    Find the detections of a frame in the arrays loaded with load_npz
+    :param data: Dictionary of the saved arrays
+    :param frame_num: Frame number
+    :return: Slice of the detections in that frame; empty if the frame has no detections
+    """
+    i = np.searchsorted(data['frame_nums'], frame_num)
+    if i == len(data['frame_nums']) or data['frame_nums'][i] != frame_num:
+        return slice(0, 0)
+    return slice(int(data['frame_offsets'][i]), int(data['frame_offsets'][i + 1]))
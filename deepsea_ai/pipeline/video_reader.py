@@ -0,0 +1,140 @@
+# deepsea-ai, Apache-2.0 license
+# Filename: pipeline/video_reader.py
+# Description: Video frame readers for the frame-batched engine, with an ffmpeg pipe reader for fast decoding
+import json
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+
+def probe(video_path: Path) -> dict:
+    """
+    Get the size, frame rate and number of frames of the first video stream with ffprobe
+    :param video_path: Path to the video
+    :return: Dictionary with the width, height, fps and num_frames of the video; num_frames is 0 if unknown
+    """
+    out = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-print_format', 'json',
+                          '-show_entries', 'stream=width,height,avg_frame_rate,r_frame_rate,nb_frames,duration',
+                          video_path.as_posix()], capture_output=True, text=True, check=True).stdout
+    stream = json.loads(out)['streams'][0]
+    num, _, den = (stream.get('avg_frame_rate') or '0/0').partition('/')
+    if not float(num) or not float(den or 0):
+        num, _, den = stream['r_frame_rate'].partition('/')
+    fps = float(num) / float(den or 1)
+    num_frames = int(stream.get('nb_frames') or 0)
+    if not num_frames and stream.get('duration'):
+        num_frames = int(round(float(stream['duration']) * fps))
+    return {'width': int(stream['width']), 'height': int(stream['height']), 'fps': fps, 'num_frames': num_frames}
+
+
+class OpenCVReader:
+    """
+    Reads frames with OpenCV
+    """
+
+    def __init__(self, video_path: Path):
+        import cv2
+        self.cv2 = cv2
+        self.capture = cv2.VideoCapture(video_path.as_posix())
+        if not self.capture.isOpened():
+            raise IOError(f'Cannot open {video_path}')
+        self.total_frames = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.
+        self.scale = 1.
+
+    def read(self):
+        ok, frame = self.capture.read()
+        return frame if ok else None
+
+    def grab(self) -> bool:
+        return self.capture.grab()
+
+    def seek(self, frame_idx: int):
+        self.capture.set(self.cv2.CAP_PROP_POS_FRAMES, frame_idx)
+
+    def release(self):
+        self.capture.release()
+
+
+class FFmpegReader:
+    """
+    Reads BGR frames from an ffmpeg subprocess over a raw video pipe. ffmpeg decodes with multiple threads and
+    optionally hardware acceleration, can downscale while decoding, and each frame is read straight into the memory
+    of its NumPy array.
+    """
+
+    def __init__(self, video_path: Path, width: int = None, threads: int = 0, hwaccel: str = None):
+        """
+        :param video_path: Path to the video
+        :param width: Width to downscale the frames to, keeping the aspect ratio; None for the full size
+        :param threads: Number of decoding threads; 0 to let ffmpeg choose
+        :param hwaccel: ffmpeg hardware acceleration method, e.g. auto, cuda or vaapi; None for software decoding
+        """
+        self.video_path = video_path
+        self.threads = threads
+        self.hwaccel = hwaccel
+        info = probe(video_path)
+        self.fps = info['fps'] or 30.
+        self.total_frames = info['num_frames']
+        if width and width < info['width']:
+            self.width = width - width % 2
+            self.height = int(round(info['height'] * self.width / info['width'] / 2)) * 2
+        else:
+            self.width, self.height = info['width'], info['height']
+        # factor to scale coordinates in the read frames back to the full size video
+        self.scale = info['width'] / self.width
+        self.frame_bytes = self.width * self.height * 3
+        self.scratch = bytearray(self.frame_bytes)
+        self.proc = None
+        self.seek(0)
+
+    def seek(self, frame_idx: int):
+        """
+        Restart decoding at a frame
+        :param frame_idx: Index of the frame to read next
+        """
+        self.release()
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+        if self.hwaccel:
+            cmd += ['-hwaccel', self.hwaccel]
+        cmd += ['-threads', str(self.threads)]
+        if frame_idx > 0:
+            cmd += ['-ss', f'{frame_idx / self.fps:.6f}']
+        cmd += ['-i', self.video_path.as_posix(), '-map', '0:v:0', '-an', '-sn']
+        if self.scale != 1.:
+            cmd += ['-vf', f'scale={self.width}:{self.height}']
+        cmd += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=self.frame_bytes)
+
+    def _read_into(self, buffer) -> bool:
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < self.frame_bytes:
+            n = self.proc.stdout.readinto(view[filled:])
+            if not n:
+                return False
+            filled += n
+        return True
+
+    def read(self):
+        """
+        Read the next frame
+        :return: The frame as a height x width x 3 BGR array, or None at the end of the video
+        """
+        frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        return frame if self._read_into(frame) else None
+
+    def grab(self) -> bool:
+        """
+        Skip the next frame
+        :return: True if there was a frame
+        """
+        return self._read_into(self.scratch)
+
+    def release(self):
+        if self.proc is not None:
+            self.proc.stdout.close()
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
@@ -22,6 +22,20 @@ pytest -s -v test_job_database.py::test_add_one_media
 pytest -s -v test_job_database.py::test_update_one_media
 pytest -s -v test_commands_help.py
 pytest -v test_config.py
+pytest -v test_upload_tag.py
+pytest -v test_batch_submit.py
+pytest -s -v test_frame_writer.py
+pytest -s -v test_tracks.py
+pytest -v test_prefetch.py
+pytest -v test_post_process.py
+pytest -v test_model_cache.py
+pytest -v test_supervisor.py
+pytest -v test_engine.py
+pytest -s -v test_cpu_engine.py
+pytest -v test_sampling.py
+pytest -s -v test_video_reader.py
+pytest -v test_chunks.py
+pytest -v test_schedule.py
 pytest -s -v test_job_monitor.py
 pytest -v test_process_args_dryrun.py
 pytest -v test_ecsprocess_args_dryrun.py
@@ -0,0 +1,237 @@
+# Test batched submission of videos to the ECS video queue with a stubbed SQS client
+import json
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from deepsea_ai.commands import process
+from deepsea_ai.database.job.database import Base, Job, Media
+from deepsea_ai.database.job.misc import Status, json_b64_decode
+from deepsea_ai.logger import CustomLogger
+
+# Set up the logger
+CustomLogger(output_path=Path.cwd() / 'logs', output_prefix=__name__)
+
+resources = {'VIDEO_QUEUE': 'video-queue.fifo', 'CLUSTER': 'test'}
+job_name = 'Dive 1377 batch submit'
+
+
+class StubSQS:
+    """
+    Records the messages sent, failing any message for a video in fail_videos
+    """
+
+    def __init__(self, fail_videos: set = None):
+        self.fail_videos = fail_videos or set()
+        self.batches = []
+        self.num_queue_url = 0
+        self.lock = threading.Lock()
+
+    def get_queue_url(self, QueueName: str) -> dict:
+        with self.lock:
+            self.num_queue_url += 1
+        return {'QueueUrl': f'https://sqs/{QueueName}'}
+
+    def send_message_batch(self, QueueUrl: str, Entries: list) -> dict:
+        with self.lock:
+            self.batches.append(Entries)
+        response = {'Successful': [], 'Failed': []}
+        for e in Entries:
+            if Path(json.loads(e['MessageBody'])['video']).name in self.fail_videos:
+                response['Failed'].append({'Id': e['Id'], 'Code': 'InternalError', 'Message': 'Stub failure'})
+            else:
+                response['Successful'].append({'Id': e['Id'], 'MessageId': f'message-{e["Id"]}'})
+        return response
+
+
+@pytest.fixture
+def session_maker(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'sqlite_job_cache_test.db'}")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def videos(tmp_path):
+    paths = []
+    for i in range(23):
+        path = tmp_path / f'vid{i:02d}.mp4'
+        path.write_bytes(f'video {i}'.encode())
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    stub = StubSQS(fail_videos={'vid03.mp4', 'vid17.mp4'})
+    monkeypatch.setattr(process.boto3, 'client', lambda name: stub)
+    return stub
+
+
+def test_batch_submit(session_maker, videos, sqs, monkeypatch):
+    """
+    Test messages are sent in batches of at most 10, failed entries are reported and not cached,
+    and the job cache is written once
+    """
+    num_writes = []
+    update_medias = process.update_medias
+    monkeypatch.setattr(process, 'update_medias', lambda *args: num_writes.append(1) or update_medias(*args))
+
+    failed = process.batch_submit(session_maker, resources, videos, job_name, 'duane', False, None)
+
+    assert sqs.num_queue_url == 1
+    assert [len(b) for b in sqs.batches] == [10, 10, 3]
+    assert sorted(v.name for v in failed) == ['vid03.mp4', 'vid17.mp4']
+    assert len(num_writes) == 1
+
+    with session_maker.begin() as db:
+        media = db.query(Media).all()
+        assert len(media) == len(videos) - 2
+        assert all(m.status == Status.QUEUED and m.message_uuid for m in media)
+        assert not any(m.name.endswith(('vid03.mp4', 'vid17.mp4')) for m in media)
+        assert db.query(Job).one().name == job_name
+
+
+def test_batch_submitter(session_maker, videos, sqs):
+    """
+    Test the submitter resolves the queue once, and sends any videos still waiting for a batch on close
+    """
+    submitter = process.BatchSubmitter(session_maker, resources, job_name, 'duane', False, None, linger_secs=30)
+    submitter.start()
+    start = time.perf_counter()
+    for v in videos[:5]:
+        submitter.submit(v)
+    submitter.close()
+
+    # the last batch is sent on close without waiting for the linger time
+    assert time.perf_counter() - start < 30
+    assert submitter.num_submitted == 4
+    assert [v.name for v in submitter.failed] == ['vid03.mp4']
+    assert sqs.num_queue_url == 1
+    assert sum(len(b) for b in sqs.batches) == 5
+
+    with session_maker.begin() as db:
+        assert len(db.query(Media).all()) == 4
+
+
+def test_batch_submit_chunks(session_maker, videos, sqs, monkeypatch):
+    """
+    Test a split video is sent as one message per chunk, and is not cleaned as every chunk needs it
+    """
+    monkeypatch.setattr(process, 'video_chunks',
+                        lambda video_path, chunk_minutes: [(0., 1810.), (1800., None)]
+                        if video_path.name == 'vid00.mp4' else [(0., None)])
+    failed = process.batch_submit(session_maker, resources, videos[:2], job_name, 'duane', True, None,
+                                  chunk_minutes=30)
+    assert not failed
+
+    bodies = [json.loads(e['MessageBody']) for b in sqs.batches for e in b]
+    assert [(b['video'].split('/')[-1], b.get('chunk'), b['clean']) for b in bodies] == \
+           [('vid00.mp4', '1/2', 'False'), ('vid00.mp4', '2/2', 'False'), ('vid01.mp4', None, 'True')]
+    assert bodies[1]['start_secs'] == 1800. and 'end_secs' not in bodies[1]
+
+
+def test_batch_submit_partial_chunks(session_maker, videos, sqs, monkeypatch):
+    """
+    Test a split video with only some chunks sent is recorded as failed with its unsent chunks, so the chunks that
+    were sent are still tracked, and can be submitted again
+    """
+    monkeypatch.setattr(process, 'video_chunks', lambda video_path, chunk_minutes: [(0., 1810.), (1800., 3610.),
+                                                                                    (3600., None)])
+    send_message_batch = sqs.send_message_batch
+
+    def fail_second_chunk(QueueUrl: str, Entries: list) -> dict:
+        response = send_message_batch(QueueUrl, Entries)
+        failed = [s for s in response['Successful'] if s['Id'] == '1']
+        response['Successful'] = [s for s in response['Successful'] if s not in failed]
+        response['Failed'] += [{'Id': s['Id'], 'Code': 'InternalError', 'Message': 'Stub failure'} for s in failed]
+        return response
+
+    sqs.send_message_batch = fail_second_chunk
+    failed = process.batch_submit(session_maker, resources, videos[:1], job_name, 'duane', False, None,
+                                  chunk_minutes=30)
+    assert failed == videos[:1]
+
+    with session_maker.begin() as db:
+        media = db.query(Media).one()
+        assert media.status == Status.FAILED
+        metadata = json_b64_decode(media.metadata_b64)
+        assert metadata['num_chunks'] == 3
+        assert metadata['chunk_status'] == {'2': Status.FAILED}
+    assert process.pending_videos(session_maker, job_name, videos[:1]) == videos[:1]
+
+
+def test_batch_submitter_order(session_maker, videos, sqs):
+    """
+    Test videos that become ready out of order are submitted in the given order, and videos waiting on a video
+    that never becomes ready are submitted on close
+    """
+    order = [videos[i] for i in [5, 1, 4, 0, 2, 6]]
+    submitter = process.BatchSubmitter(session_maker, resources, job_name, 'duane', False, None, linger_secs=0.1,
+                                       order=order)
+    submitter.start()
+    for i in [0, 4, 1]:
+        submitter.submit(videos[i])
+    time.sleep(0.5)
+    assert not sqs.batches
+
+    submitter.submit(videos[5])
+    time.sleep(0.5)
+    sent = [Path(json.loads(e['MessageBody'])['video']).name for b in sqs.batches for e in b]
+    assert sent == ['vid05.mp4', 'vid01.mp4', 'vid04.mp4', 'vid00.mp4']
+
+    # vid06 waits on vid02, which never becomes ready, until the submitter is closed
+    submitter.submit(videos[6])
+    time.sleep(0.5)
+    assert sum(len(b) for b in sqs.batches) == 4
+    submitter.close()
+    assert submitter.num_submitted == 5
+    assert Path(json.loads(sqs.batches[-1][-1]['MessageBody'])['video']).name == 'vid06.mp4'
+
+
+def set_status(session_maker, video_path: Path, status: str):
+    with session_maker.begin() as db:
+        job = db.query(Job).filter(Job.name == job_name).one()
+        process.update_medias(db, job, [{'name': f'{process.get_prefix(video_path)}/{video_path.name}',
+                                         'status': status}])
+
+
+def test_pending_videos(session_maker, videos, sqs):
+    """
+    Test videos submitted in the job with the same content are skipped, and renamed, changed, failed videos
+    or videos of another job are submitted again
+    """
+    # vid03 always fails to queue
+    videos = [v for v in videos[:7] if v.name != 'vid03.mp4']
+    assert process.pending_videos(session_maker, job_name, videos) == videos
+    assert not process.batch_submit(session_maker, resources, videos, job_name, 'duane', False, None)
+    assert process.pending_videos(session_maker, job_name, videos) == []
+    assert process.pending_videos(session_maker, 'Another job', videos[:2]) == videos[:2]
+
+    # running and completed videos are skipped, failed videos are submitted again
+    set_status(session_maker, videos[0], Status.RUNNING)
+    set_status(session_maker, videos[1], Status.SUCCESS)
+    set_status(session_maker, videos[2], Status.FAILED)
+    assert process.pending_videos(session_maker, job_name, videos[:3]) == [videos[2]]
+
+    # a renamed video is a new video, and a video replaced with different content is submitted again
+    renamed = videos[3].rename(videos[3].with_name('renamed.mp4'))
+    videos[4].write_bytes(b'a different video')
+    assert process.pending_videos(session_maker, job_name, [renamed, videos[4], videos[5]]) == [renamed, videos[4]]
+
+
+def test_pending_videos_clean(session_maker, videos, sqs):
+    """
+    Test a video submitted with --clean is still skipped once done, although it was removed from s3, and a video
+    that failed to queue is not recorded and is submitted again
+    """
+    failed = process.batch_submit(session_maker, resources, videos[2:5], job_name, 'duane', True, None)
+    assert [v.name for v in failed] == ['vid03.mp4']
+    assert all(json.loads(e['MessageBody'])['clean'] == 'True' for b in sqs.batches for e in b)
+
+    set_status(session_maker, videos[2], Status.SUCCESS)
+    assert process.pending_videos(session_maker, job_name, videos[2:5]) == [videos[3]]
@@ -0,0 +1,93 @@
+# Test splitting long videos into chunks and stitching the tracks of the chunks back together
+import numpy as np
+
+from deepsea_ai.commands import process
+from deepsea_ai.database.job.misc import json_b64_encode
+from deepsea_ai.pipeline.chunks import Chunk, decode_chunk, merge_chunks
+from deepsea_ai.pipeline.tracks import track_dtype
+
+num_frames = 300
+overlap = 20
+
+
+def make_tracks(frames: range, objects: dict) -> np.ndarray:
+    """
+    Create the detections of moving objects as a tracker would report them in the given frames
+    :param frames: Frame numbers
+    :param objects: Dictionary of object number to the track id the tracker gave it
+    """
+    rows = []
+    for frame in frames:
+        for obj, track_id in objects.items():
+            rows.append((frame, track_id, 100. * obj + frame, 50. * obj, 40., 30., 0.9, 'Sebastes', 0., 0.))
+    return np.array(rows, dtype=track_dtype)
+
+
+def test_merge_chunks():
+    """
+    Test tracks that continue across a chunk boundary keep one track id, and overlap frames are not duplicated
+    """
+    first = make_tracks(range(1, 161), {1: 1, 2: 2, 3: 3})
+    # the second chunk starts overlap frames before the end of the first, with its own track ids,
+    # and sees a new object that did not appear in the first chunk
+    second = make_tracks(range(161 - overlap, num_frames + 1), {1: 7, 2: 5, 3: 6, 4: 1})
+
+    merged = merge_chunks([first, second])
+
+    assert merged['frame'].tolist() == sorted(merged['frame'].tolist())
+    assert len(merged) == 3 * 160 + 4 * (num_frames - 160)
+    assert len(np.unique(merged['track_id'])) == 4
+    for obj in [1, 2, 3, 4]:
+        ids = np.unique(merged['track_id'][merged['y'] == 50. * obj])
+        assert len(ids) == 1
+
+
+def test_merge_chunks_no_match():
+    """
+    Test tracks of a chunk that do not overlap the previous chunk's tracks get new track ids
+    """
+    first = make_tracks(range(1, 101), {1: 1})
+    second = make_tracks(range(101 - overlap, 201), {5: 1})
+    merged = merge_chunks([first, second])
+    assert len(np.unique(merged['track_id'])) == 2
+
+
+def test_video_chunks(monkeypatch):
+    """
+    Test chunks start on keyframes and overlap the next chunk, probing only the packets after each cut point
+    """
+    # a keyframe every 2 seconds in a 100 minute video, with none for a while after the third cut point
+    keyframes = [float(t) for t in range(0, 6000, 2) if not 5400 <= t < 5500]
+    probes = []
+
+    def keyframe_times(video_path, start_secs, search_secs):
+        probes.append(start_secs)
+        return [t for t in keyframes if start_secs <= t <= start_secs + search_secs]
+
+    monkeypatch.setattr(process, 'video_duration', lambda video_path: 6000.)
+    monkeypatch.setattr(process, 'keyframe_times', keyframe_times)
+
+    chunks = process.video_chunks(None, 30, overlap_secs=10)
+    assert [start for start, _ in chunks] == [0., 1800., 3600., 5500.]
+    assert [end for _, end in chunks] == [1810., 3610., 5510., None]
+    assert all(start in keyframes for start, _ in chunks)
+    assert probes == [1800., 3600., 5400., 5460.]
+
+    # videos no longer than a chunk are not probed for keyframes
+    probes.clear()
+    assert process.video_chunks(None, 0) == [(0., None)]
+    assert process.video_chunks(None, 100) == [(0., None)]
+    assert process.video_chunks(None, 120) == [(0., None)]
+    assert probes == []
+
+
+def test_decode_chunk():
+    """
+    Test the tracker decodes the chunk from the message metadata the way ecsprocess encodes it
+    """
+    metadata = {"message_uuid": "uuid", "chunk": "2/4", "start_secs": 1800., "end_secs": 3610.}
+    assert decode_chunk(json_b64_encode(metadata)) == Chunk(2, 4, 1800., 3610.)
+    metadata = {"message_uuid": "uuid", "chunk": "4/4", "start_secs": 5400.}
+    assert decode_chunk(json_b64_encode(metadata)) == Chunk(4, 4, 5400., None)
+    assert decode_chunk(json_b64_encode({"message_uuid": "uuid"})) is None
+    assert decode_chunk(None) is None
@@ -0,0 +1,155 @@
+# Test the frame-batched CPU detect and track engine, and benchmark it on a test video
+# Requires torch, opencv and a Yolov5_StrongSORT_OSR checkout in TRACK_DIR with YOLOv5 weights in YOLO_WEIGHTS
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import ModuleType
+
+import numpy as np
+import pytest
+
+from deepsea_ai.pipeline.cpu_engine import FrameDecoder, parse_track_args
+
+requires_tracker = pytest.mark.skipif('TRACK_DIR' not in os.environ or 'YOLO_WEIGHTS' not in os.environ,
+                                      reason='Set TRACK_DIR to a Yolov5_StrongSORT_OSR checkout and YOLO_WEIGHTS')
+
+
+@requires_tracker
+def test_cpu_batch_benchmark():
+    """
+    Test batching frames produces a tracks file the pipeline can load, and report the frames/sec per batch size
+    """
+    pytest.importorskip('torch')
+    pytest.importorskip('cv2')
+    from deepsea_ai.pipeline.cpu_engine import BatchTracker
+    from deepsea_ai.pipeline.tracks import load_tracks
+
+    video = next((Path(__file__).parent / 'data').rglob('*.mp4'))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fps = {}
+        for batch_size in [1, 8]:
+            tracker = BatchTracker(Path(os.environ['YOLO_WEIGHTS']), track_dir=Path(os.environ['TRACK_DIR']),
+                                   batch_size=batch_size, num_threads=os.cpu_count())
+            tracks_path = Path(temp_dir) / f'batch{batch_size}' / f'{video.stem}.txt'
+            result = tracker.run(video, tracks_path)
+            assert result.returncode == 0
+            assert result.frames == result.total_frames > 0
+            tracks = load_tracks(tracks_path)
+            assert len(tracks) == 0 or tracks['frame'].max() <= result.frames
+            fps[batch_size] = result.fps
+
+        print(f'{video.name}: ' + ', '.join(f'batch {b} {f:.1f} frames/sec' for b, f in fps.items()))
+
+
+def test_parse_track_args():
+    """
+    Test the supported track.py options are passed to the batch tracker, and any other option is rejected
+    """
+    assert parse_track_args(None) == {}
+    assert parse_track_args('--conf-thres 0.1 --iou-thres 0.5 --img 1280 --classes 0 2 --agnostic-nms') == \
+           {'conf_thres': 0.1, 'iou_thres': 0.5, 'imgsz': 1280, 'classes': [0, 2], 'agnostic_nms': True}
+    assert parse_track_args('--imgsz 1280 1280 --max-det 100 --device cpu') == {'imgsz': 1280, 'max_det': 100}
+    for args in ['--save-vid', '--imgsz 1280 720', '--device 0', '--conf-thres high']:
+        with pytest.raises(ValueError):
+            parse_track_args(args)
+
+
+class FakeReader:
+    """
+    Video reader with blank frames
+    """
+    total_frames = 1000
+    fps = 30.
+    scale = 1.
+
+    def __init__(self):
+        self.frame_idx = 0
+        self.released = False
+
+    def grab(self) -> bool:
+        self.frame_idx += 1
+        return self.frame_idx <= self.total_frames
+
+    def read(self):
+        self.frame_idx += 1
+        return np.zeros((8, 8, 3), dtype=np.uint8) if self.frame_idx <= self.total_frames else None
+
+    def seek(self, frame_idx: int):
+        self.frame_idx = frame_idx
+
+    def release(self):
+        self.released = True
+
+
+class StalledReader(FakeReader):
+    """
+    Video reader that hangs after the first frames until released
+    """
+
+    def __init__(self, frames: int):
+        super().__init__()
+        self.frames = frames
+        self.resume = threading.Event()
+
+    def read(self):
+        if self.frame_idx >= self.frames:
+            self.resume.wait()
+        return super().read()
+
+    def release(self):
+        self.resume.set()
+        super().release()
+
+
+def fake_letterbox(monkeypatch):
+    """
+    Replace the YOLOv5 letterbox the decoder imports with one that keeps the frame as is
+    """
+    augmentations = ModuleType('yolov5.utils.augmentations')
+    augmentations.letterbox = lambda im, imgsz, stride, auto: (im,)
+    monkeypatch.setitem(sys.modules, 'yolov5', ModuleType('yolov5'))
+    monkeypatch.setitem(sys.modules, 'yolov5.utils', ModuleType('yolov5.utils'))
+    monkeypatch.setitem(sys.modules, 'yolov5.utils.augmentations', augmentations)
+
+
+def test_frame_decoder_stop(monkeypatch):
+    """
+    Test the decoder thread exits when the consumer stops reading, instead of blocking on the full queue
+    """
+    fake_letterbox(monkeypatch)
+    reader = FakeReader()
+    decoder = FrameDecoder(reader, imgsz=8, stride=8, max_queued=4)
+    decoder.start()
+    batch = next(decoder.batches(2))
+    assert [frame_idx for frame_idx, _, _ in batch] == [0, 1]
+
+    # the consumer fails here; the decoder is blocked on the full queue until stopped
+    decoder.stop()
+    decoder.join(timeout=5)
+    assert not decoder.is_alive()
+    assert reader.released
+
+
+def test_frame_decoder_timeout(monkeypatch):
+    """
+    Test waiting on a stalled decoder times out instead of blocking forever, reporting progress for each frame
+    """
+    fake_letterbox(monkeypatch)
+    reader = StalledReader(frames=3)
+    decoder = FrameDecoder(reader, imgsz=8, stride=8, max_queued=4)
+    decoder.start()
+    progress = []
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        for _ in decoder.batches(2, timeout=0.2, on_frame=lambda: progress.append(time.monotonic())):
+            pass
+    assert len(progress) == 3
+    assert time.monotonic() - start < 5
+
+    decoder.stop()
+    reader.release()
+    decoder.join(timeout=5)
+    assert not decoder.is_alive()
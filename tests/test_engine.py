@@ -0,0 +1,128 @@
+# Test running track.py in-process with the detector kept loaded between videos
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from deepsea_ai.pipeline.engine import ResidentTracker
+
+# A minimal stand-in for the StrongSort track.py script that counts how many times the detector is loaded
+fake_track_py = '''
+import argparse
+import time
+from pathlib import Path
+
+loads = []
+
+
+class DetectMultiBackend:
+    def __init__(self, weights, device=None):
+        loads.append(weights)
+
+    def forward(self, im):
+        return im
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', type=str, required=True)
+    parser.add_argument('--project', type=str, required=True)
+    parser.add_argument('--yolo-weights', type=str, default='yolov5s.pt')
+    parser.add_argument('--stall', action='store_true')
+    return parser.parse_args()
+
+
+def run(source, project, yolo_weights, stall):
+    model = DetectMultiBackend(yolo_weights, device='cpu')
+    for frame in range(3):
+        model.forward(frame)
+    if stall:
+        time.sleep(60)
+    (Path(project) / Path(source).with_suffix('.txt').name).write_text(f'1 1 0 0 10 10 0.9 {yolo_weights}\\n')
+'''
+
+
+@pytest.fixture
+def fake_track_dir():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        (Path(temp_dir) / 'track.py').write_text(fake_track_py)
+        yield Path(temp_dir)
+        sys.modules.pop('track', None)
+        if Path(temp_dir).resolve().as_posix() in sys.path:
+            sys.path.remove(Path(temp_dir).resolve().as_posix())
+
+
+def test_resident_tracker(fake_track_dir: Path):
+    """
+    Test the detector is loaded once for all the videos that use the same weights
+    """
+    tracker = ResidentTracker(fake_track_dir)
+    for video in ['a.mp4', 'b.mp4', 'c.mp4']:
+        result = tracker.run(['--source', video, '--project', fake_track_dir.as_posix(), '--yolo-weights', 'best.pt'])
+        assert result.returncode == 0
+        assert (fake_track_dir / Path(video).with_suffix('.txt').name).exists()
+    assert tracker.track.loads == ['best.pt']
+
+    assert tracker.run(['--source', 'd.mp4', '--project', fake_track_dir.as_posix()]).returncode == 0
+    assert tracker.track.loads == ['best.pt', 'yolov5s.pt']
+
+
+def test_resident_tracker_failure(fake_track_dir: Path):
+    """
+    Test invalid arguments fail only that video
+    """
+    tracker = ResidentTracker(fake_track_dir)
+    result = tracker.run(['--source', 'a.mp4'])
+    assert result.returncode != 0
+    assert result.reason
+    assert tracker.run(['--source', 'a.mp4', '--project', fake_track_dir.as_posix()]).returncode == 0
+
+
+def test_resident_tracker_stall(fake_track_dir: Path):
+    """
+    Test the process exits after reporting the video failed if the detector stalls
+    """
+    script = '''
+import sys
+from pathlib import Path
+from deepsea_ai.pipeline.engine import ResidentTracker
+
+tracker = ResidentTracker(Path(sys.argv[1]))
+tracker.run(['--source', 'a.mp4', '--project', sys.argv[1], '--stall'], stall_secs=0.5, poll_secs=0.1,
+            on_timeout=lambda reason: print(f'Failed a.mp4: {reason}'))
+print('Finished')
+'''
+    env = dict(os.environ, PYTHONPATH=Path(__file__).parent.parent.as_posix())
+    proc = subprocess.run([sys.executable, '-c', script, fake_track_dir.as_posix()], env=env, capture_output=True,
+                          text=True, timeout=30)
+    assert proc.returncode == 1
+    assert 'Failed a.mp4: No progress' in proc.stdout
+    assert 'Finished' not in proc.stdout
+
+
+@pytest.mark.skipif('TRACK_DIR' not in os.environ, reason='Set TRACK_DIR to a Yolov5_StrongSORT_OSR checkout')
+def test_resident_equivalence():
+    """
+    Test the in-process tracker produces the same tracks as the track.py subprocess on the CPU
+    """
+    pytest.importorskip('torch')
+    track_dir = Path(os.environ['TRACK_DIR'])
+    video = next((Path(__file__).parent / 'data').rglob('*.mp4'))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        args = ['--source', video.as_posix(), '--save-txt', '--device', 'cpu', '--project', temp_dir]
+        subprocess.run([sys.executable, 'track.py'] + args + ['--name', 'subprocess'], cwd=track_dir, check=True)
+
+        tracker = ResidentTracker(track_dir)
+        cwd = Path.cwd()
+        try:
+            os.chdir(track_dir)
+            assert tracker.run(args + ['--name', 'resident']).returncode == 0
+        finally:
+            os.chdir(cwd)
+
+        name = f'tracks/{video.stem}.txt'
+        expected = (Path(temp_dir) / 'subprocess' / name).read_text()
+        assert (Path(temp_dir) / 'resident' / name).read_text() == expected
@@ -0,0 +1,149 @@
+# Benchmark and test the per-frame writer of the dettrack pipeline on a synthetic StrongSort tracks file
+import json
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from deepsea_ai.pipeline.frame_writer import FrameWriter, TarFrameWriter
+
+num_frames = 200
+detections_per_frame = 30
+
+
+def make_tracks_txt(path: Path):
+    """
+    Create a synthetic tracks file with one detection per line: frame track_id x y width height confidence class
+    """
+    rng = np.random.default_rng(0)
+    with open(path, 'w') as f:
+        for frame in range(1, num_frames + 1):
+            for d in range(detections_per_frame):
+                x, y, w, h = rng.integers(0, 1000, 4)
+                f.write(f'{frame} {d} {x} {y} {w} {h} {rng.random():.3f} Sebastes\n')
+
+
+def read_events(path: Path) -> list:
+    """
+    Read the synthetic tracks file into a list of events
+    """
+    events = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            frame, track_id, x, y, w, h, conf, name = line.split()
+            events.append({'frameNum': int(frame), 'track_uuid': track_id, 'x': int(x), 'y': int(y),
+                           'width': int(w), 'height': int(h), 'confidence': float(conf), 'name': name,
+                           'occlusion': 0, 'surprise': 0, 'uuid': str(i)})
+    return events
+
+
+def to_visual_event(e: dict) -> dict:
+    return {'bounding_box': {'height': e['height'], 'width': e['width'], 'x': e['x'], 'y': e['y']},
+            'class_name': e['name'], 'confidence': e['confidence'], 'frame_num': e['frameNum'],
+            'occlusion': e['occlusion'], 'surprise': e['surprise'], 'track_uuid': e['track_uuid'], 'uuid': e['uuid']}
+
+
+def write_legacy(events: list, output_path: Path):
+    """
+    The previous writer, which rewrote the current frame file after every event
+    """
+    visual_events = []
+    last_frame = -1
+    for e in events:
+        if last_frame == -1:
+            last_frame = e['frameNum']
+        if e['frameNum'] > last_frame:
+            with open(f"{output_path}/f{last_frame:06}.json", 'w', encoding='utf-8') as f:
+                json.dump(["visualevents", visual_events], f)
+                visual_events = []
+        last_frame = e['frameNum']
+        visual_events.append(["visualevent", to_visual_event(e)])
+        if len(visual_events) > 0:
+            with open(f"{output_path}/f{last_frame:06}.json", 'w', encoding='utf-8') as f:
+                json.dump(["visualevents", visual_events], f)
+
+
+def write_streaming(events: list, output_path: Path):
+    with FrameWriter(output_path) as writer:
+        for e in events:
+            writer.add(e['frameNum'], to_visual_event(e))
+
+
+def test_frame_writer_benchmark():
+    """
+    Test the streaming writer produces the same frame files as the previous writer, only faster
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        tracks_txt = temp_path / 'tracks.txt'
+        make_tracks_txt(tracks_txt)
+        events = read_events(tracks_txt)
+
+        legacy_path = temp_path / 'legacy'
+        streaming_path = temp_path / 'streaming'
+        legacy_path.mkdir()
+        streaming_path.mkdir()
+
+        start = time.perf_counter()
+        write_legacy(events, legacy_path)
+        legacy_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        write_streaming(events, streaming_path)
+        streaming_secs = time.perf_counter() - start
+
+        print(f'{len(events)} events in {num_frames} frames: legacy {legacy_secs:.3f}s, '
+              f'streaming {streaming_secs:.3f}s, speedup {legacy_secs / streaming_secs:.1f}x')
+
+        legacy_files = sorted(legacy_path.glob('*.json'))
+        streaming_files = sorted(streaming_path.glob('*.json'))
+        assert len(streaming_files) == num_frames
+        assert [f.name for f in legacy_files] == [f.name for f in streaming_files]
+        for legacy, streaming in zip(legacy_files, streaming_files):
+            assert legacy.read_bytes() == streaming.read_bytes()
+        assert streaming_secs < legacy_secs
+
+
+def test_tar_frame_writer():
+    """
+    Test streaming the frames into a tar.gz produces the same frame files as writing them to disk
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        tracks_txt = temp_path / 'tracks.txt'
+        make_tracks_txt(tracks_txt)
+        events = read_events(tracks_txt)
+
+        streaming_path = temp_path / 'streaming'
+        streaming_path.mkdir()
+        write_streaming(events, streaming_path)
+
+        tar_path = temp_path / 'tracks.tar.gz'
+        with TarFrameWriter(tar_path, 'video', compress_level=1) as writer:
+            for e in events:
+                writer.add(e['frameNum'], to_visual_event(e))
+            writer.add_file(tracks_txt, 'tracks/video.txt')
+
+        with tarfile.open(tar_path, 'r:gz') as tar:
+            names = tar.getnames()
+            assert names[-1] == 'video/tracks/video.txt'
+            assert tar.extractfile('video/tracks/video.txt').read() == tracks_txt.read_bytes()
+            streaming_files = sorted(streaming_path.glob('*.json'))
+            assert names[:-1] == [f'video/{f.name}' for f in streaming_files]
+            for f in streaming_files:
+                assert tar.extractfile(f'video/{f.name}').read() == f.read_bytes()
+
+
+def test_tar_frame_writer_top_level(tmp_path):
+    """
+    Test frames streamed into an archive inside the results directory are stored without a directory prefix
+    """
+    tar_path = tmp_path / 'frames.tar.gz'
+    with TarFrameWriter(tar_path, '.', compress_level=9) as writer:
+        writer.add(1, {'uuid': 'a'})
+        writer.add(2, {'uuid': 'b'})
+    with tarfile.open(tar_path, 'r:gz') as tar:
+        assert tar.getnames() == ['f000001.json', 'f000002.json']
+        assert json.load(tar.extractfile('f000002.json')) == ['visualevents', [['visualevent', {'uuid': 'b'}]]]
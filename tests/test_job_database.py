@@ -1,15 +1,18 @@
 # Test the sqlite database with pydantic
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.orm import Session, sessionmaker
 
 from deepsea_ai.config.config import Config
-from deepsea_ai.database.job.database import Job, PydanticJobWithMedias, PydanticJob, Media, PydanticMedia, init_db
+from deepsea_ai.database.job.database import Job, PydanticJobWithMedias, PydanticJob, Media, PydanticMedia, init_db, \
+    migrate, schema_version, log_sql
 from deepsea_ai.database.job.database_helper import json_b64_encode, json_b64_decode, get_status, get_num_failed, \
-    update_media, get_num_completed
+    update_media, update_medias, get_num_completed, get_submitted_media, get_status_counts, status_from_counts
 from deepsea_ai.database.job.misc import JobType, Status, job_hash
 from deepsea_ai.logger import CustomLogger
 
@@ -66,6 +69,9 @@ def test_pydantic_sqlalchemy(setup_database):
                  "job_id": 1,
                  "status": Status.QUEUED,
                  "updatedAt": None,
+                 "message_uuid": None,
+                 "processing_job_arn": None,
+                 "fingerprint": None,
                  "metadata_b64": json_b64_encode({"job_uuid": job_hash("vid1.mp4")})
                  },
                 {"name": "vid2.mp4",
@@ -73,6 +79,9 @@ def test_pydantic_sqlalchemy(setup_database):
                  "job_id": 1,
                  "status": Status.SUCCESS,
                  "updatedAt": None,
+                 "message_uuid": None,
+                 "processing_job_arn": None,
+                 "fingerprint": None,
                  "metadata_b64": json_b64_encode({"job_uuid": job_hash("vid2.mp4")})
                  }
             ],
@@ -183,6 +192,38 @@ def test_num_completed(setup_database):
         assert num_completed == 1
 
 
+def test_status_counts(setup_database):
+    """
+    Test the media of one or all jobs are counted by status, and the job status follows from the counts
+    """
+    with session_maker.begin() as db:
+        job = Job(name="Dive 1378", engine="test", job_type=JobType.ECS)
+        job.media = [Media(name=f"vid{i}.mp4", status=Status.FAILED if i < 3 else Status.SUCCESS)
+                     for i in range(10)]
+        db.add(job)
+
+    with session_maker.begin() as db:
+        counts = get_status_counts(db)
+        assert counts[1] == {Status.QUEUED: 1, Status.SUCCESS: 1}
+        assert counts[2] == {Status.FAILED: 3, Status.SUCCESS: 7}
+        assert get_status_counts(db, 2) == {2: counts[2]}
+
+        job = db.query(Job).filter(Job.id == 2).one()
+        assert get_status(job) == Status.FAILED
+        assert get_num_failed(job) == 3
+        assert get_num_completed(job) == 7
+
+    # a job that is not in a session counts its media
+    job = Job(name="Dive 1379", engine="test", job_type=JobType.ECS,
+              media=[Media(name="vid1.mp4", status=Status.SUCCESS), Media(name="vid2.mp4", status=Status.FAILED)])
+    assert get_num_failed(job) == 1
+    assert get_status(job) == Status.FAILED
+
+    assert status_from_counts({}) == Status.SUCCESS
+    assert status_from_counts({Status.SUCCESS: 2, Status.UNKNOWN: 1}) == Status.UNKNOWN
+    assert status_from_counts({Status.FAILED: 2, Status.RUNNING: 1}) == Status.RUNNING
+
+
 def add_vid3(db: Session):
     """
     Helper function to add a new media to the database
@@ -232,5 +273,150 @@ def test_update_one_media(setup_database):
         assert media_updated.updatedAt > media.createdAt
 
 
+def test_submitted_media(setup_database):
+    """
+    Test that only QUEUED, RUNNING or SUCCESS media are in the submission ledger, and that their fingerprint is kept
+    when the media is updated from a queue message
+    """
+    with session_maker.begin() as db:
+        job = db.query(Job).first()
+        update_media(db, job, 'vid3.mp4', Status.QUEUED, message_uuid='1234', fingerprint='abcd')
+        update_media(db, job, 'vid4.mp4', Status.FAILED, message_uuid='5678', fingerprint='efgh')
+
+    with session_maker.begin() as db:
+        job = db.query(Job).first()
+        timestamp = datetime.utcnow()
+        update_media(db, job, 'vid3.mp4', Status.RUNNING, timestamp=timestamp,
+                     metadata_b64=json_b64_encode({'message_uuid': '1234'}))
+
+    with session_maker.begin() as db:
+        submitted = get_submitted_media(db, "Dive 1377 with yolov5x-mbay-benthic")
+        assert submitted['vid3.mp4'] == 'abcd'
+        assert 'vid4.mp4' not in submitted
+        assert get_submitted_media(db, "Unknown job") == {}
+
+
+def test_update_medias(setup_database):
+    """
+    Test a list of updates is applied to existing and new media, skipping updates older than the last update
+    """
+    with session_maker.begin() as db:
+        job = db.query(Job).first()
+        update_media(db, job, 'vid1.mp4', Status.RUNNING, message_uuid='1234')
+        update_media(db, job, 'vid2.mp4', Status.SUCCESS)
+
+    with session_maker.begin() as db:
+        job = db.query(Job).first()
+        num_applied = update_medias(db, job, [
+            {'name': 'vid1.mp4', 'status': Status.SUCCESS, 'timestamp': datetime.utcnow(),
+             'metadata_b64': json_b64_encode({'message_uuid': '1234'})},
+            {'name': 'vid2.mp4', 'status': Status.FAILED, 'timestamp': datetime(2000, 1, 1)},
+            {'name': 'vid3.mp4', 'status': Status.QUEUED, 'message_uuid': '5678', 'fingerprint': 'abcd'},
+        ])
+        assert num_applied == 2
+
+    with session_maker.begin() as db:
+        media = {m.name: m for m in db.query(Media).all()}
+        assert media['vid1.mp4'].status == Status.SUCCESS
+        assert media['vid1.mp4'].message_uuid == '1234'
+        assert media['vid2.mp4'].status == Status.SUCCESS
+        assert media['vid3.mp4'].status == Status.QUEUED
+        assert media['vid3.mp4'].fingerprint == 'abcd'
+        assert len(db.query(Job).first().media) == 3
+
+
+def test_concurrent_writers(setup_database):
+    """
+    Benchmark inserting and updating media from several writers at once, e.g. the monitor thread and a submission,
+    each with its own connection to the write-ahead log
+    """
+    num_writers = 4
+    num_media = 500
+    # a second engine on the same database, as a separate ecsprocess command would have
+    session_makers = [session_maker, init_db(Config())]
+
+    with session_maker.begin() as db:
+        assert db.execute('PRAGMA journal_mode').scalar() == 'wal'
+
+    def write(w: int):
+        maker = session_makers[w % len(session_makers)]
+        for i in range(0, num_media, 50):
+            with maker.begin() as db:
+                job = Job(name=f"writer {w}", engine="test", job_type=JobType.ECS) if i == 0 else \
+                    db.query(Job).filter(Job.name == f"writer {w}").one()
+                update_medias(db, job, [{'name': f'vid{j}.mp4', 'status': Status.QUEUED}
+                                        for j in range(i, i + 50)])
+        with maker.begin() as db:
+            job = db.query(Job).filter(Job.name == f"writer {w}").one()
+            update_medias(db, job, [{'name': f'vid{j}.mp4', 'status': Status.SUCCESS} for j in range(num_media)])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_writers) as executor:
+        list(executor.map(write, range(num_writers)))
+    elapsed = time.perf_counter() - start
+    print(f'{num_writers} writers inserted and updated {num_writers * num_media} media in {elapsed:.3f} seconds, '
+          f'{2 * num_writers * num_media / elapsed:.0f} writes/sec')
+
+    with session_maker.begin() as db:
+        for w in range(num_writers):
+            job = db.query(Job).filter(Job.name == f"writer {w}").one()
+            assert len(job.media) == num_media
+            assert all(m.status == Status.SUCCESS for m in job.media)
+
+
+def test_migrate(tmp_path):
+    """
+    Test a job cache created before the metadata columns and indexes is migrated in place
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'sqlite_job_cache_old.db'}")
+    with engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE job (id INTEGER NOT NULL, name VARCHAR NOT NULL, engine VARCHAR NOT NULL, '
+                             'job_type VARCHAR NOT NULL, "createdAt" TIMESTAMP DEFAULT (CURRENT_TIMESTAMP) NOT NULL, '
+                             'PRIMARY KEY (id))')
+        conn.exec_driver_sql('CREATE TABLE media (id INTEGER NOT NULL, name VARCHAR NOT NULL, status VARCHAR NOT NULL, '
+                             'metadata_b64 VARCHAR, "createdAt" TIMESTAMP DEFAULT (CURRENT_TIMESTAMP) NOT NULL, '
+                             '"updatedAt" TIMESTAMP, job_id INTEGER, PRIMARY KEY (id), '
+                             'FOREIGN KEY(job_id) REFERENCES job (id) ON DELETE CASCADE)')
+        conn.exec_driver_sql("INSERT INTO job (id, name, engine, job_type) VALUES (1, 'Dive 1377', 'test', 'ECS')")
+        for media_id, name, metadata in [(1, 'vid1.mp4', {'message_uuid': '1234', 'fingerprint': 'abcd'}),
+                                         (2, 'vid2.mp4', {'processing_job_arn': 'arn', 'error': ''}),
+                                         (3, 'vid1.mp4', {'message_uuid': '5678', 'fingerprint': 'abcd'})]:
+            conn.exec_driver_sql('INSERT INTO media (id, name, status, metadata_b64, job_id) VALUES (?, ?, ?, ?, 1)',
+                                 (media_id, name, Status.QUEUED, json_b64_encode(metadata)))
+
+    migrate(engine)
+    migrate(engine)
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('PRAGMA user_version').scalar() == schema_version
+    indexes = {index['name']: index for index in inspect(engine).get_indexes('media')}
+    assert indexes['ix_media_job_id_name']['unique']
+    assert 'ix_media_message_uuid' in indexes
+    assert 'ix_job_name' in {index['name'] for index in inspect(engine).get_indexes('job')}
+
+    with sessionmaker(bind=engine).begin() as db:
+        media = {m.name: m for m in db.query(Job).first().media}
+        # the newest of the duplicate media is kept
+        assert len(media) == 2
+        assert media['vid1.mp4'].message_uuid == '5678'
+        assert media['vid1.mp4'].fingerprint == 'abcd'
+        assert media['vid2.mp4'].processing_job_arn == 'arn'
+        assert media['vid2.mp4'].message_uuid is None
+
+
 if __name__ == '__main__':
     test_pydantic_sqlalchemy()
+
+
+def test_echo_sql():
+    """
+    Test the echo_sql setting logs each SQL statement, and is off by default
+    """
+    cfg = Config()
+    engine = init_db(cfg).kw['bind']
+    assert not event.contains(engine, 'before_cursor_execute', log_sql)
+
+    cfg.parser.set('database', 'echo_sql', 'True')
+    engine = init_db(cfg).kw['bind']
+    assert event.contains(engine, 'before_cursor_execute', log_sql)
+    assert not event.contains(init_db(cfg, echo=False).kw['bind'], 'before_cursor_execute', log_sql)
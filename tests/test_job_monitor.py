@@ -1,10 +1,12 @@
 # Test job monitoring with sqlite database
+import time
 from pathlib import Path
 
 from deepsea_ai.commands.monitor import Monitor
+from deepsea_ai.commands.monitor_utils import apply_messages
 from deepsea_ai.config.config import Config
 from deepsea_ai.database.job.database import Job, Media, init_db
-from deepsea_ai.database.job.misc import Status, JobType
+from deepsea_ai.database.job.misc import Status, JobType, json_b64_encode
 from datetime import datetime as dt
 
 from deepsea_ai.logger import CustomLogger
@@ -79,3 +81,89 @@ def test_monitor_report():
 
         resources = {'PROCESSOR': 'test'}
         monitor_job(resources)
+
+
+def test_apply_messages():
+    """
+    Test draining a queue's worth of messages applies the newest message of each video in a single transaction
+    """
+    num_videos = 5000
+    cluster = "yolov5x-mbay-benthic30dkfh2=1jt"
+    name = "Dive 1377 with yolov5x-mbay-benthic"
+    session_maker = init_db(Config(), reset=True)
+    with session_maker.begin() as db:
+        job = Job(engine=cluster, name=name, job_type=JobType.ECS)
+        job.media = [Media(name=f"vid{i}.mp4", status=Status.QUEUED, updatedAt=dt(2023, 1, 1))
+                     for i in range(num_videos)]
+        db.add(job)
+
+    def message(i: int, timestamp: str) -> dict:
+        return {"video": f"vid{i}.mp4", "job_name": name, "timestamp": timestamp,
+                "metadata_b64": json_b64_encode({"message_uuid": f"uuid{i}"})}
+
+    # every video completes, the first 100 also failed earlier and the last 100 failed after completing
+    messages = [(message(i, '20230102T000000'), Status.SUCCESS) for i in range(num_videos)]
+    messages += [(message(i, '20230101T120000'), Status.FAILED) for i in range(100)]
+    messages += [(message(i, '20230103T000000'), Status.FAILED) for i in range(num_videos - 100, num_videos)]
+    # a video of a job not in the database
+    messages.append(({"video": "new.mp4", "job_name": "New job", "timestamp": '20230102T000000',
+                      "metadata_b64": json_b64_encode({})}, Status.SUCCESS))
+
+    start = time.perf_counter()
+    with session_maker.begin() as db:
+        num_updated = apply_messages(db, messages, cluster)
+    elapsed = time.perf_counter() - start
+    print(f'Applied {len(messages)} messages in {elapsed:.3f} seconds')
+
+    assert num_updated == num_videos + 1
+    with session_maker.begin() as db:
+        media = {m.name: m for m in db.query(Job).filter(Job.name == name).first().media}
+        assert media['vid0.mp4'].status == Status.SUCCESS
+        assert media['vid0.mp4'].message_uuid == 'uuid0'
+        assert media[f'vid{num_videos - 1}.mp4'].status == Status.FAILED
+        assert sum(m.status == Status.SUCCESS for m in media.values()) == num_videos - 100
+        assert db.query(Job).filter(Job.name == "New job").first().media[0].status == Status.SUCCESS
+
+
+def test_apply_chunk_messages():
+    """
+    Test a video split into chunks succeeds only once all its chunks have, and fails if any chunk fails
+    """
+    cluster = "yolov5x-mbay-benthic30dkfh2=1jt"
+    name = "Dive 1377 with yolov5x-mbay-benthic"
+    session_maker = init_db(Config(), reset=True)
+    with session_maker.begin() as db:
+        job = Job(engine=cluster, name=name, job_type=JobType.ECS)
+        job.media = [Media(name=video, status=Status.QUEUED, message_uuid=f"uuid-{video}", updatedAt=dt(2023, 1, 1))
+                     for video in ["split.mp4", "failed.mp4"]]
+        db.add(job)
+
+    def message(video: str, chunk: str, timestamp: str, message_uuid: str = None) -> dict:
+        return {"video": video, "job_name": name, "timestamp": timestamp,
+                "metadata_b64": json_b64_encode({"message_uuid": message_uuid or f"uuid-{video}", "chunk": chunk})}
+
+    def status(video: str) -> str:
+        with session_maker.begin() as db:
+            return db.query(Media).filter(Media.name == video).one().status
+
+    # the first chunk to finish does not complete the video, and an earlier submission is ignored
+    with session_maker.begin() as db:
+        apply_messages(db, [(message("split.mp4", "1/3", '20230102T000000'), Status.SUCCESS),
+                            (message("split.mp4", "2/3", '20230102T000000', 'uuid-old'), Status.SUCCESS),
+                            (message("split.mp4", "3/3", '20230102T000000', 'uuid-old'), Status.SUCCESS),
+                            (message("failed.mp4", "1/2", '20230102T000000'), Status.FAILED)], cluster)
+    assert status("split.mp4") == Status.RUNNING
+    assert status("failed.mp4") == Status.FAILED
+
+    # a later success of the other chunk does not hide the failed chunk
+    with session_maker.begin() as db:
+        apply_messages(db, [(message("failed.mp4", "2/2", '20230103T000000'), Status.SUCCESS),
+                            (message("split.mp4", "2/3", '20230103T000000'), Status.SUCCESS)], cluster)
+    assert status("failed.mp4") == Status.FAILED
+    assert status("split.mp4") == Status.RUNNING
+
+    # the video succeeds with its last chunk, with the messages of the earlier chunks read again
+    with session_maker.begin() as db:
+        apply_messages(db, [(message("split.mp4", "1/3", '20230102T000000'), Status.SUCCESS),
+                            (message("split.mp4", "3/3", '20230104T000000'), Status.SUCCESS)], cluster)
+    assert status("split.mp4") == Status.SUCCESS
@@ -0,0 +1,98 @@
+# Test the on-host model cache of the dettrack pipeline against an in-memory S3 bucket
+import hashlib
+import io
+import tarfile
+import tempfile
+from pathlib import Path
+
+from deepsea_ai.pipeline.model_cache import ModelCache
+
+
+class MemoryS3:
+    """
+    Minimal S3 client over a dictionary of objects that counts the downloads
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.downloads = 0
+
+    def put(self, key: str, data: bytes):
+        self.objects[key] = data
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        return {'ETag': f'"{hashlib.md5(self.objects[Key]).hexdigest()}"', 'ContentLength': len(self.objects[Key])}
+
+    def download_file(self, bucket: str, key: str, path: str):
+        self.downloads += 1
+        Path(path).write_bytes(self.objects[key])
+
+
+def model_tar(weights: bytes) -> bytes:
+    """
+    Create a model tar.gz with a best.pt file
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        info = tarfile.TarInfo('model/best.pt')
+        info.size = len(weights)
+        tar.addfile(info, io.BytesIO(weights))
+    return buffer.getvalue()
+
+
+def test_model_cache_hit():
+    """
+    Test a cached model is only downloaded and unpacked once
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        s3 = MemoryS3()
+        s3.put('models/yolov5x.tar.gz', model_tar(b'weights'))
+        cache = ModelCache(Path(temp_dir), max_bytes=1024 ** 2)
+
+        entry = cache.get(s3, 'models', 'models/yolov5x.tar.gz')
+        assert (entry / 'model' / 'best.pt').read_bytes() == b'weights'
+        assert not (entry / 'yolov5x.tar.gz').exists()
+
+        assert ModelCache(Path(temp_dir), max_bytes=1024 ** 2).get(s3, 'models', 'models/yolov5x.tar.gz') == entry
+        assert s3.downloads == 1
+
+
+def test_model_cache_integrity():
+    """
+    Test a corrupt or changed model is downloaded again
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        s3 = MemoryS3()
+        s3.put('models/yolov5x.tar.gz', model_tar(b'weights'))
+        cache = ModelCache(Path(temp_dir), max_bytes=1024 ** 2)
+
+        entry = cache.get(s3, 'models', 'models/yolov5x.tar.gz')
+        (entry / 'model' / 'best.pt').write_bytes(b'corrupt')
+        assert (cache.get(s3, 'models', 'models/yolov5x.tar.gz') / 'model' / 'best.pt').read_bytes() == b'weights'
+        assert s3.downloads == 2
+
+        s3.put('models/yolov5x.tar.gz', model_tar(b'retrained weights'))
+        new_entry = cache.get(s3, 'models', 'models/yolov5x.tar.gz')
+        assert new_entry != entry
+        assert (new_entry / 'model' / 'best.pt').read_bytes() == b'retrained weights'
+        assert s3.downloads == 3
+
+
+def test_model_cache_eviction():
+    """
+    Test the least recently used entries are evicted when the cache is over its size limit
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        s3 = MemoryS3()
+        for name in ['a', 'b', 'c']:
+            s3.put(f'configs/{name}.yaml', name.encode('utf-8') * 100)
+        cache = ModelCache(Path(temp_dir), max_bytes=250)
+
+        a = cache.get(s3, 'configs', 'configs/a.yaml')
+        b = cache.get(s3, 'configs', 'configs/b.yaml')
+        cache.get(s3, 'configs', 'configs/a.yaml')
+        c = cache.get(s3, 'configs', 'configs/c.yaml')
+
+        assert a.exists() and c.exists()
+        assert not b.exists()
+        assert (c / 'c.yaml').read_bytes() == b'c' * 100
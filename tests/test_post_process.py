@@ -0,0 +1,99 @@
+# Test post-processing of tracked videos in background workers in the dettrack pipeline
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from deepsea_ai.pipeline.post_process import LockedProcessor, PostProcessor
+
+save_secs = 0.05
+
+
+class FakeProcessor:
+    """
+    Records the videos saved and cleaned, counting the queue updates made while another thread was updating the
+    queue and the most uploads made at the same time
+    """
+
+    def __init__(self):
+        self.saved = Counter()
+        self.cleaned = Counter()
+        self.failed = Counter()
+        self.busy = False
+        self.overlaps = 0
+        self.uploads = 0
+        self.max_uploads = 0
+        self.uploads_lock = threading.Lock()
+
+    def update(self, counter: Counter, name: str):
+        if self.busy:
+            self.overlaps += 1
+        self.busy = True
+        time.sleep(save_secs / 10)
+        counter[name] += 1
+        self.busy = False
+
+    def message_fail(self, video, msg):
+        self.update(self.failed, video.name)
+
+    def message_save(self, video):
+        with self.uploads_lock:
+            self.uploads += 1
+            self.max_uploads = max(self.max_uploads, self.uploads)
+        time.sleep(save_secs)
+        with self.uploads_lock:
+            self.uploads -= 1
+            self.saved[video.name] += 1
+
+    def clean(self, video):
+        with self.uploads_lock:
+            self.cleaned[video.name] += 1
+
+
+def save(processor, video):
+    if video.name == 'video3.mp4':
+        raise Exception('Cannot save video3.mp4')
+    processor.message_fail(video, 'queue update from a worker')
+    processor.message_save(video)
+
+
+def test_post_process_workers(tmp_path):
+    """
+    Test every video is saved and cleaned once from the workers, with the uploads running in parallel but the
+    queue updates one at a time, and failures are reported
+    """
+    processor = FakeProcessor()
+    videos = [SimpleNamespace(name=f'video{i}.mp4') for i in range(8)]
+    threads = set()
+
+    def save_in_thread(processor, video):
+        threads.add(threading.current_thread())
+        save(processor, video)
+
+    with PostProcessor(LockedProcessor(processor), save_in_thread, workers=3) as post_processor:
+        for video in videos:
+            video_tmp_path = tmp_path / video.name
+            video_tmp_path.mkdir()
+            post_processor.submit(video, video_tmp_path)
+
+    saved = [v.name for v in videos if v.name != 'video3.mp4']
+    assert processor.saved == Counter(saved)
+    assert processor.cleaned == Counter(saved)
+    assert processor.overlaps == 0
+    assert processor.max_uploads > 1
+    assert threading.main_thread() not in threads
+    assert [v.name for v, ex in post_processor.failures] == ['video3.mp4']
+    # the temporary directories of the saved videos are removed, and the failed one is kept to debug
+    assert [p.name for p in tmp_path.iterdir()] == ['video3.mp4']
+
+
+def test_post_process_inline(tmp_path):
+    """
+    Test videos are post-processed before submit returns without workers
+    """
+    processor = FakeProcessor()
+    with PostProcessor(LockedProcessor(processor), save) as post_processor:
+        post_processor.submit(SimpleNamespace(name='video0.mp4'), tmp_path / 'video0.mp4')
+        assert processor.saved == Counter(['video0.mp4'])
+        assert processor.cleaned == Counter(['video0.mp4'])
+    assert not post_processor.failures
@@ -0,0 +1,96 @@
+# Test prefetching of the next queued video in the dettrack pipeline
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from deepsea_ai.pipeline.prefetch import Prefetcher
+
+fetch_secs = 0.2
+
+
+class SlowQueue:
+    """
+    Queue of videos that take fetch_secs each to download
+    """
+
+    def __init__(self, num_videos: int):
+        self.num_videos = num_videos
+        self.fetch_threads = []
+
+    def has_video(self) -> bool:
+        return self.num_videos > 0
+
+    def next(self, out_path: Path, debug: bool):
+        if self.num_videos == 0:
+            return None
+        self.num_videos -= 1
+        self.fetch_threads.append(threading.current_thread())
+        time.sleep(fetch_secs)
+        video_path = out_path / f'video{self.num_videos}.mp4'
+        video_path.write_bytes(b'video')
+        return SimpleNamespace(input_path=video_path, name=video_path.name)
+
+
+def track_all(prefetcher: Prefetcher) -> list:
+    """
+    Track each video, taking fetch_secs per video
+    """
+    videos = []
+    while prefetcher.has_video():
+        video, video_tmp_path = prefetcher.next()
+        if video is None:
+            break
+        assert video.input_path.parent == video_tmp_path / 'out'
+        assert video.input_path.exists()
+        videos.append(video.input_path.name)
+        time.sleep(fetch_secs)
+    return videos
+
+
+def test_prefetch():
+    """
+    Test the next video is fetched in the background while the current one is tracked
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        queue = SlowQueue(4)
+        start = time.perf_counter()
+        with Prefetcher(queue, Path(temp_dir), debug=True, min_free=0.) as prefetcher:
+            videos = track_all(prefetcher)
+        elapsed = time.perf_counter() - start
+
+        assert videos == ['video3.mp4', 'video2.mp4', 'video1.mp4', 'video0.mp4']
+        assert queue.fetch_threads[0] == threading.main_thread()
+        assert all(t != threading.main_thread() for t in queue.fetch_threads[1:])
+        # 4 fetches and 4 tracks overlap after the first fetch
+        assert elapsed < 7 * fetch_secs
+
+
+def test_prefetch_disk_guard():
+    """
+    Test videos are fetched when needed if there is not enough free space to prefetch
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        queue = SlowQueue(3)
+        with Prefetcher(queue, Path(temp_dir), debug=True, min_free=1.) as prefetcher:
+            videos = track_all(prefetcher)
+
+        assert len(videos) == 3
+        assert all(t == threading.main_thread() for t in queue.fetch_threads)
+
+
+def test_prefetch_shutdown():
+    """
+    Test a video prefetched but never handed out is failed and its temporary directory removed on shutdown
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        queue = SlowQueue(3)
+        failed = []
+        queue.message_fail = lambda video, msg: failed.append(video.name)
+        with Prefetcher(queue, Path(temp_dir), debug=True, min_free=0.) as prefetcher:
+            video, video_tmp_path = prefetcher.next()
+
+        assert video.input_path.name == 'video2.mp4'
+        assert failed == ['video1.mp4']
+        assert [p for p in Path(temp_dir).iterdir()] == [video_tmp_path]
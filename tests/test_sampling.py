@@ -0,0 +1,76 @@
+# Test the frame sampling options of the dettrack pipeline
+import math
+
+import numpy as np
+import pytest
+
+from deepsea_ai.pipeline.sampling import FrameSampler, parse_time, parse_window
+
+
+def sampled_frames(sampler: FrameSampler, num_frames: int, fps: float) -> list:
+    """
+    Walk a video of num_frames frames the way the frame decoder does, returning the selected frame indexes
+    """
+    frames = []
+    frame_idx = 0
+    while True:
+        frame_idx = sampler.next_frame(frame_idx, fps)
+        if frame_idx is None or frame_idx >= num_frames:
+            break
+        frames.append(frame_idx)
+        frame_idx += 1
+    return frames
+
+
+def test_parse_window():
+    """
+    Test windows can be given in seconds or HH:MM:SS, with an open end
+    """
+    assert parse_time('90') == 90.
+    assert parse_time('01:30') == 90.
+    assert parse_time('01:00:01.5') == 3601.5
+    assert parse_window('00:10:00-00:25:00') == (600., 1500.)
+    assert parse_window('30-') == (30., math.inf)
+    with pytest.raises(ValueError):
+        parse_window('20-10')
+
+
+def test_stride():
+    """
+    Test every Nth frame is selected
+    """
+    assert sampled_frames(FrameSampler(), 5, 30.) == [0, 1, 2, 3, 4]
+    assert sampled_frames(FrameSampler(stride=4), 10, 30.) == [0, 4, 8]
+    assert FrameSampler().all_frames and not FrameSampler(stride=2).all_frames
+
+
+def test_windows():
+    """
+    Test only the frames on the stride inside the windows are selected
+    """
+    sampler = FrameSampler(stride=2, windows=[(3., 4.), (1., 1.5)])
+    assert sampled_frames(sampler, 1000, 10.) == [10, 12, 14, 30, 32, 34, 36, 38]
+    assert sampler.next_frame(40, 10.) is None
+
+    assert sampled_frames(FrameSampler(windows=[(2., math.inf)]), 25, 10.) == [20, 21, 22, 23, 24]
+
+
+def test_scene_change():
+    """
+    Test frames are skipped until the scene changes by more than the threshold
+    """
+    rng = np.random.default_rng(0)
+    seafloor = rng.integers(0, 255, (360, 640, 3), dtype=np.uint8)
+    noisy = np.clip(seafloor.astype(int) + rng.integers(-2, 3, seafloor.shape), 0, 255).astype(np.uint8)
+    fish = seafloor.copy()
+    fish[100:300, 200:500] = 255
+
+    sampler = FrameSampler(scene_threshold=0.02)
+    assert sampler.changed(seafloor)
+    assert not sampler.changed(noisy)
+    assert sampler.changed(fish)
+    assert not sampler.changed(fish)
+    sampler.reset()
+    assert sampler.changed(fish)
+
+    assert FrameSampler().changed(seafloor) and FrameSampler().changed(seafloor)
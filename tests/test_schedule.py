@@ -0,0 +1,89 @@
+# Test longest-first scheduling of video submissions
+from pathlib import Path
+
+import botocore
+
+from deepsea_ai.commands import process
+
+durations = {Path('a.mp4'): 600., Path('b.mp4'): 7200., Path('c.mp4'): 1200., Path('d.mp4'): 3600.}
+
+
+def test_estimate_makespan():
+    """
+    Test each job goes to the first free task
+    """
+    assert process.estimate_makespan([3., 3., 2., 2., 2.], 2) == 7.
+    assert process.estimate_makespan([3., 3., 2., 2., 2.], 1) == 12.
+    assert process.estimate_makespan([3., 3., 2., 2., 2.], 0) == 12.
+    assert process.estimate_makespan([], 4) == 0.
+
+
+def test_schedule_lpt(monkeypatch):
+    """
+    Test videos are ordered longest first, and the longest first order does not lengthen the job
+    """
+    monkeypatch.setattr(process, 'video_duration', lambda video_path: durations[video_path])
+    videos = list(durations.keys())
+    ordered = process.schedule_lpt(videos, 2)
+    assert ordered == [Path('b.mp4'), Path('d.mp4'), Path('c.mp4'), Path('a.mp4')]
+
+    costs = [durations[v] for v in ordered]
+    assert process.estimate_makespan(costs, 2) <= process.estimate_makespan([durations[v] for v in videos], 2)
+    assert process.estimate_makespan(costs, 2) == 7200.
+
+
+def test_schedule_lpt_by_size(monkeypatch, tmp_path):
+    """
+    Test videos are ordered by file size if any of the videos cannot be probed
+    """
+    monkeypatch.setattr(process, 'video_duration', lambda video_path: None)
+    videos = []
+    for name, size in [('small.mp4', 10), ('large.mp4', 1000), ('medium.mp4', 100)]:
+        video = tmp_path / name
+        video.write_bytes(b'\0' * size)
+        videos.append(video)
+
+    costs, unit = process.processing_costs(videos)
+    assert unit == 'bytes'
+    assert [v.name for v in process.schedule_lpt(videos, 4)] == ['large.mp4', 'medium.mp4', 'small.mp4']
+
+
+class StubPaginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        if isinstance(self.pages, Exception):
+            raise self.pages
+        return self.pages(**kwargs)
+
+
+class StubECS:
+    """
+    ECS client with two clusters, and three tasks running in the cluster of the mbari315k stack
+    """
+
+    def __init__(self, list_tasks_error: Exception = None):
+        self.list_tasks_error = list_tasks_error
+
+    def get_paginator(self, name: str):
+        if name == 'list_clusters':
+            return StubPaginator(lambda: [{'clusterArns': ['arn:aws:ecs:us-west-2:123:cluster/other-cluster']},
+                                          {'clusterArns': ['arn:aws:ecs:us-west-2:123:cluster/mbari315k-cluster']}])
+        return StubPaginator(self.list_tasks_error or (
+            lambda cluster, desiredStatus: [{'taskArns': ['t1', 't2']}, {'taskArns': ['t3']}]
+            if cluster == 'arn:aws:ecs:us-west-2:123:cluster/mbari315k-cluster' else []))
+
+
+def test_running_tasks(monkeypatch):
+    """
+    Test tasks are counted in the cluster found by name, and a single task is assumed if they cannot be listed
+    """
+    monkeypatch.setattr(process.boto3, 'client', lambda name: StubECS())
+    assert process.running_tasks('mbari315k') == 3
+    assert process.running_tasks('missing') == 1
+
+    denied = botocore.exceptions.ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'Denied'}},
+                                             'ListTasks')
+    monkeypatch.setattr(process.boto3, 'client', lambda name: StubECS(denied))
+    assert process.running_tasks('mbari315k') == 1
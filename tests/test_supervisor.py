@@ -0,0 +1,54 @@
+# Test supervising the tracker subprocess of the dettrack pipeline with a fake tracker
+import sys
+import time
+
+from deepsea_ai.pipeline.supervisor import supervise
+
+
+def fake_tracker(num_frames: int, frame_secs: float, stall_at: int = None, exit_code: int = 0) -> str:
+    """
+    Shell command for a fake tracker that logs its frame progress like track.py, optionally stalling at a frame
+    """
+    script = f'''
+import sys, time
+for i in range(1, {num_frames} + 1):
+    print(f'video 1/1 ({{i}}/{num_frames}) /tmp/in/video.mp4: 640x384 3 Sebastes, Done.', flush=True)
+    if i == {stall_at}:
+        time.sleep(60)
+    time.sleep({frame_secs})
+sys.exit({exit_code})
+'''
+    return f'{sys.executable} -c "{script}"'
+
+
+def test_supervise_progress():
+    """
+    Test a tracker that completes reports all its frames
+    """
+    result = supervise(fake_tracker(20, 0.01), stall_secs=5, poll_secs=0.1)
+    assert result.returncode == 0
+    assert result.frames == result.total_frames == 20
+    assert result.fps > 0
+    assert result.reason == ''
+    assert '(20/20)' in result.output
+
+
+def test_supervise_failure():
+    """
+    Test a tracker that fails returns its exit code and output
+    """
+    result = supervise(fake_tracker(5, 0.01, exit_code=3), stall_secs=5, poll_secs=0.1)
+    assert result.returncode == 3
+    assert '(5/5)' in result.output
+
+
+def test_supervise_stall():
+    """
+    Test a tracker that stops making progress is killed long before it would have finished
+    """
+    start = time.monotonic()
+    result = supervise(fake_tracker(20, 0.01, stall_at=10), stall_secs=1, poll_secs=0.1)
+    assert time.monotonic() - start < 30
+    assert result.returncode != 0
+    assert result.frames == 10
+    assert result.reason.startswith('No progress')
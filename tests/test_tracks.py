@@ -0,0 +1,213 @@
+# Benchmark and test the vectorized StrongSort tracks parser of the dettrack pipeline
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from deepsea_ai.pipeline.tracks import load_tracks, track_uuids, group_by_frame, visual_events, save_npz, load_npz, \
+    frame_slice, renumber_frames, save_tracks
+
+num_frames = 1000
+detections_per_frame = 50
+
+
+def make_tracks_txt(path: Path):
+    """
+    Create a synthetic tracks file with one detection per line: frame track_id x y width height confidence class.
+    Frames are written out of order to check the parser sorts them.
+    """
+    rng = np.random.default_rng(0)
+    frames = np.repeat(np.arange(1, num_frames + 1), detections_per_frame)
+    track_ids = np.tile(np.arange(detections_per_frame), num_frames) + frames // 100
+    boxes = rng.integers(0, 1000, (len(frames), 4))
+    scores = rng.random(len(frames))
+    order = np.concatenate([np.arange(len(frames) // 2, len(frames)), np.arange(len(frames) // 2)])
+    with open(path, 'w') as f:
+        for i in order:
+            x, y, w, h = boxes[i]
+            f.write(f'{frames[i]} {track_ids[i]} {x} {y} {w} {h} {scores[i]:.3f} Sebastes\n')
+
+
+def read_events(path: Path) -> list:
+    """
+    Reference parser that builds one dictionary per detection
+    """
+    events = []
+    with open(path) as f:
+        for line in f:
+            frame, track_id, x, y, w, h, conf, name = line.split()
+            events.append({'frameNum': int(frame), 'track_id': int(track_id), 'x': float(x), 'y': float(y),
+                           'width': float(w), 'height': float(h), 'confidence': float(conf), 'name': name})
+    return sorted(events, key=lambda e: e['frameNum'])
+
+
+def test_tracks_benchmark():
+    """
+    Test the vectorized parser loads the same detections as a per-line parser, only faster
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tracks_txt = Path(temp_dir) / 'tracks.txt'
+        make_tracks_txt(tracks_txt)
+
+        start = time.perf_counter()
+        events = read_events(tracks_txt)
+        unique_ids = {e['track_id'] for e in events}
+        reference_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tracks = load_tracks(tracks_txt)
+        uuids, index = track_uuids(tracks['track_id'])
+        vectorized_secs = time.perf_counter() - start
+
+        print(f'{len(events)} detections: per-line {reference_secs:.3f}s, vectorized {vectorized_secs:.3f}s')
+
+        assert len(tracks) == len(events) == num_frames * detections_per_frame
+        assert len(uuids) == len(unique_ids)
+        assert tracks['frame'].tolist() == [e['frameNum'] for e in events]
+        assert tracks['confidence'].tolist() == [e['confidence'] for e in events]
+        assert tracks['class_name'].tolist() == [e['name'] for e in events]
+
+
+def test_group_by_frame():
+    """
+    Test detections are grouped by frame and each track keeps the same uuid across frames
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tracks_txt = Path(temp_dir) / 'tracks.txt'
+        make_tracks_txt(tracks_txt)
+        tracks = load_tracks(tracks_txt)
+        uuids, index = track_uuids(tracks['track_id'])
+
+        frames = list(group_by_frame(tracks))
+        assert [f for f, _ in frames] == list(range(1, num_frames + 1))
+
+        track_uuid = {}
+        for frame_num, rows in frames:
+            events = visual_events(tracks[rows], uuids[index[rows]])
+            assert len(events) == detections_per_frame
+            for e, track_id in zip(events, tracks['track_id'][rows].tolist()):
+                assert e['frame_num'] == frame_num
+                assert track_uuid.setdefault(track_id, e['track_uuid']) == e['track_uuid']
+        assert len(set(track_uuid.values())) == len(uuids)
+
+
+def test_npz_round_trip():
+    """
+    Test the single file npz output holds the same detections per frame as the per-frame json output
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        tracks_txt = temp_path / 'tracks.txt'
+        make_tracks_txt(tracks_txt)
+        tracks = load_tracks(tracks_txt)
+        uuids, index = track_uuids(tracks['track_id'])
+
+        save_npz(temp_path / 'tracks.npz', tracks, uuids, index)
+        data = load_npz(temp_path / 'tracks.npz')
+
+        for frame_num, rows in group_by_frame(tracks):
+            events = visual_events(tracks[rows], uuids[index[rows]])
+            s = frame_slice(data, frame_num)
+            assert data['track_uuids'][data['track_index'][s]].tolist() == [e['track_uuid'] for e in events]
+            assert data['x'][s].tolist() == [e['bounding_box']['x'] for e in events]
+            assert data['confidence'][s].tolist() == [e['confidence'] for e in events]
+            assert data['class_name'][s].tolist() == [e['class_name'] for e in events]
+        assert frame_slice(data, num_frames + 1) == slice(0, 0)
+
+
+def test_empty_tracks():
+    """
+    Test an empty tracks file has no detections
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tracks_txt = Path(temp_dir) / 'tracks.txt'
+        tracks_txt.touch()
+        tracks = load_tracks(tracks_txt)
+        uuids, _ = track_uuids(tracks['track_id'])
+        assert len(tracks) == 0
+        assert len(uuids) == 0
+        assert list(group_by_frame(tracks)) == []
+
+
+def test_renumber_frames():
+    """
+    Test the frames track.py numbers over a strided chunk are mapped back to the frames of the whole video
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # track.py with --vid-stride 3 reads frames 1, 4, 7 and 10 of the chunk and numbers them 1 to 4
+        tracks_txt = Path(temp_dir) / 'tracks.txt'
+        tracks_txt.write_text('1 1 10 10 5 5 0.9 Sebastes\n'
+                              '2 1 11 10 5 5 0.9 Sebastes\n'
+                              '4 2 50 50 5 5 0.8 Pycnopodia\n')
+        tracks = load_tracks(tracks_txt)
+        assert renumber_frames(tracks.copy(), 3)['frame'].tolist() == [1, 4, 10]
+
+        # a chunk starting at frame 9000 of the whole video
+        save_tracks(tracks_txt, renumber_frames(tracks, 3, 9000))
+        assert load_tracks(tracks_txt)['frame'].tolist() == [9001, 9004, 9010]
+        assert renumber_frames(load_tracks(tracks_txt))['frame'].tolist() == [9001, 9004, 9010]
+
+
+def reference_visual_events(path: Path) -> list:
+    """
+    Visual events of each detection as built line by line before the vectorized parser, without the uuids
+    """
+    events = []
+    with open(path) as f:
+        for line in f:
+            frame, track_id, x, y, w, h, conf, name, occlusion, surprise = line.split()
+            events.append({'bounding_box': {'height': float(h), 'width': float(w), 'x': float(x), 'y': float(y)},
+                           'class_name': name,
+                           'confidence': float(conf),
+                           'frame_num': int(frame),
+                           'occlusion': float(occlusion),
+                           'surprise': float(surprise),
+                           'track_id': int(track_id)})
+    return sorted(events, key=lambda e: e['frame_num'])
+
+
+def test_visual_events_fixture():
+    """
+    Test the visual events of a tracks file in the track.py layout match the events built line by line, including
+    the occlusion and surprise of each detection
+    """
+    tracks_txt = Path(__file__).parent / 'data' / 'tracks' / 'V4361_20211006T162656Z_h265_1sec.txt'
+    tracks = load_tracks(tracks_txt)
+    uuids, index = track_uuids(tracks['track_id'])
+    events = []
+    for frame_num, rows in group_by_frame(tracks):
+        events += visual_events(tracks[rows], uuids[index[rows]])
+
+    expected = reference_visual_events(tracks_txt)
+    assert len(events) == len(expected)
+    track_uuid = {}
+    for e, r in zip(events, expected):
+        assert track_uuid.setdefault(r.pop('track_id'), e['track_uuid']) == e['track_uuid']
+        assert {k: v for k, v in e.items() if k not in ('track_uuid', 'uuid')} == r
+    assert len(set(track_uuid.values())) == 3
+
+
+def test_load_tracks_layout():
+    """
+    Test files in other layouts fail to load rather than load into the wrong fields, and tracks without occlusion
+    and surprise, as written by the batch tracker, load with them set to 0
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tracks_txt = Path(temp_dir) / 'tracks.txt'
+
+        # the upstream track.py --save-txt MOT format: frame id left top width height -1 -1 -1 index
+        tracks_txt.write_text('1 1 812 402 64 38 -1 -1 -1 0\n2 1 815 403 64 39 -1 -1 -1 0\n')
+        with pytest.raises(ValueError):
+            load_tracks(tracks_txt)
+
+        for text in ['1 1 812 402 64 38 0.91\n', '1 1 812 402 64 38 0.91 Sebastes 0 0.1\n2 1 815 403 64 39 0.9\n']:
+            tracks_txt.write_text(text)
+            with pytest.raises(ValueError):
+                load_tracks(tracks_txt)
+
+        tracks_txt.write_text('1 1 812 402 64 38 0.91 Sebastes\n')
+        tracks = load_tracks(tracks_txt)
+        assert tracks['class_name'].tolist() == ['Sebastes']
+        assert tracks['occlusion'].tolist() == tracks['surprise'].tolist() == [0.]
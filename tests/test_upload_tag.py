@@ -0,0 +1,106 @@
+# Test the upload helpers that do not require a valid AWS account
+from pathlib import Path
+
+import botocore
+
+from deepsea_ai.commands.upload_tag import needs_upload, local_etag, tags_match, tagging_query, list_objects, MB
+from deepsea_ai.logger import CustomLogger
+
+# Set up the logger
+CustomLogger(output_path=Path.cwd() / 'logs', output_prefix=__name__)
+
+# Get the path of this file
+video_path = Path(__file__).parent / 'data'
+
+tags = [{'Key': 'mbari:owner', 'Value': 'duane'},
+        {'Key': 'mbari:description', 'Value': 'Video uploaded from /Volumes/M3'},
+        {'Key': 'mbari:deletion-date', 'Value': '20250101T120000Z'}]
+
+
+def test_needs_upload():
+    """
+    Test that missing and truncated objects are uploaded and complete objects are skipped
+    """
+    video = next(video_path.rglob('*.mp4'))
+    size = video.stat().st_size
+    part_size = 64 * 1024 * 1024
+    key = f'data/{video.name}'
+
+    assert needs_upload(video, key, {})
+    assert needs_upload(video, key, {key: (size // 2, 'abc')})
+    assert not needs_upload(video, key, {key: (size, 'abc')})
+    assert needs_upload(video, key, {key: (size, 'abc')}, verify_checksum=True, part_size=part_size)
+    assert not needs_upload(video, key, {key: (size, local_etag(video, part_size))}, verify_checksum=True,
+                            part_size=part_size)
+
+
+def test_local_etag_multipart():
+    """
+    Test that the ETag of a file larger than the part size has the multipart form <md5>-<number of parts>
+    """
+    video = next(video_path.rglob('*.mp4'))
+    part_size = 256 * 1024
+    num_parts = -(-video.stat().st_size // part_size)
+    assert local_etag(video, part_size).endswith(f'-{num_parts}')
+
+
+def test_needs_upload_part_size(tmp_path):
+    """
+    Test that objects uploaded with a different part size are verified from the number of parts in their ETag
+    """
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(bytes(range(256)) * (20 * MB // 256))
+    key = f'data/{video.name}'
+    size = video.stat().st_size
+
+    for uploaded_part_size in [8 * MB, 5 * MB, 64 * MB]:
+        etag = local_etag(video, uploaded_part_size)
+        assert not needs_upload(video, key, {key: (size, etag)}, verify_checksum=True, part_size=16 * MB)
+    assert not needs_upload(video, key, {key: (size, local_etag(video))}, verify_checksum=True, part_size=16 * MB)
+    assert needs_upload(video, key, {key: (size, f'{"0" * 32}-3')}, verify_checksum=True, part_size=16 * MB)
+
+
+class DeniedPaginator:
+    def paginate(self, Bucket, Prefix):
+        if Prefix == 'denied/':
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}},
+                                                  'ListObjectsV2')
+        yield {'Contents': [{'Key': f'{Prefix}video.mp4', 'Size': 10, 'ETag': '"abc"'}]}
+
+
+class DeniedS3:
+    def get_paginator(self, name):
+        return DeniedPaginator()
+
+
+def test_list_objects_denied():
+    """
+    Test that prefixes without permission to list are reported rather than treated as empty
+    """
+    index, denied = list_objects(DeniedS3(), 'bucket', {'denied/', 'allowed/'})
+    assert index == {'allowed/video.mp4': (10, 'abc')}
+    assert denied == {'denied/'}
+
+
+def test_tags_match():
+    """
+    Test that tags match regardless of order, and deletion dates only need to match to the day
+    """
+    same_day = [dict(t) for t in reversed(tags)]
+    same_day[0]['Value'] = '20250101T180000Z'
+    assert tags_match(same_day, tags)
+
+    next_day = [dict(t) for t in tags]
+    next_day[2]['Value'] = '20250102T120000Z'
+    assert not tags_match(next_day, tags)
+
+    assert not tags_match(tags[:2], tags)
+    assert not tags_match([], tags)
+
+
+def test_tagging_query():
+    """
+    Test that tags are URL encoded for the upload request
+    """
+    assert tagging_query(tags[:1]) == 'mbari%3Aowner=duane'
+    assert tagging_query(tags[1:2]) == 'mbari%3Adescription=Video%20uploaded%20from%20%2FVolumes%2FM3'
@@ -0,0 +1,69 @@
+# Test and benchmark the ffmpeg pipe video reader on the test videos
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from deepsea_ai.pipeline.video_reader import FFmpegReader, probe
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                                reason='Requires ffmpeg and ffprobe')
+
+video = next((Path(__file__).parent / 'data').rglob('*.mp4'))
+
+
+def read_all(reader) -> list:
+    frames = []
+    while True:
+        frame = reader.read()
+        if frame is None:
+            break
+        frames.append(frame)
+    reader.release()
+    return frames
+
+
+def test_ffmpeg_reader():
+    """
+    Test all the frames are read at the probed size
+    """
+    info = probe(video)
+    start = time.perf_counter()
+    frames = read_all(FFmpegReader(video))
+    elapsed = time.perf_counter() - start
+    print(f'{video.name}: {len(frames)} {info["width"]}x{info["height"]} frames at {len(frames) / elapsed:.1f} '
+          f'frames/sec')
+
+    assert len(frames) > 0
+    assert abs(len(frames) - info['num_frames']) <= 1
+    assert frames[0].shape == (info['height'], info['width'], 3)
+    assert frames[0].flags.writeable
+
+
+def test_ffmpeg_reader_downscale():
+    """
+    Test frames are downscaled in the decoder keeping the aspect ratio
+    """
+    info = probe(video)
+    reader = FFmpegReader(video, width=info['width'] // 4)
+    frame = reader.read()
+    reader.release()
+    assert frame.shape[1] == reader.width <= info['width'] // 4
+    assert abs(frame.shape[0] / frame.shape[1] - info['height'] / info['width']) < 0.02
+    assert reader.scale == pytest.approx(info['width'] / reader.width)
+
+
+def test_ffmpeg_reader_seek():
+    """
+    Test seeking and grabbing land on the same frame
+    """
+    reader = FFmpegReader(video)
+    for _ in range(5):
+        assert reader.grab()
+    grabbed = reader.read()
+    reader.seek(5)
+    seeked = reader.read()
+    reader.release()
+    assert np.abs(grabbed.astype(int) - seeked.astype(int)).mean() < 2